@@ -0,0 +1,77 @@
+"""
+    Recall/speed benchmark of the IVF index against the exact search.
+
+        python benchmarks/bench_ann_recall.py [--embed vectors.npy]
+            [--n 20000] [--dim 300] [--topk 16] [--nprobe 1 4 8 16 32]
+
+    Without `--embed`, clustered random vectors are used. Prints one JSON
+    line per nprobe with recall@topk and queries per second.
+"""
+import argparse
+import json
+import sys
+import time
+from pathlib import Path
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from fastaug.ann import IVFIndex
+from fastaug.knn import blocked_topk
+
+
+def synthetic(n, dim, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((max(1, n // 100), dim))
+    return (centers[rng.integers(len(centers), size=n)] +
+            0.5 * rng.standard_normal((n, dim))).astype(np.float32)
+
+
+def recall(exact, approx):
+    hits = sum(
+        len(set(e.tolist()) & set(a.tolist())) for e, a in zip(exact, approx))
+    return hits / exact.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--embed", default=None, help="a .npy matrix")
+    parser.add_argument("--n", type=int, default=20000)
+    parser.add_argument("--dim", type=int, default=300)
+    parser.add_argument("--queries", type=int, default=1000)
+    parser.add_argument("--topk", type=int, default=16)
+    parser.add_argument("--measure", default="cos", choices=["cos", "euc"])
+    parser.add_argument("--nlist", type=int, default=None)
+    parser.add_argument("--nprobe", type=int, nargs="+",
+                        default=[1, 4, 8, 16, 32])
+    args = parser.parse_args()
+
+    if args.embed is not None:
+        data = np.load(args.embed, mmap_mode="r")
+    else:
+        data = synthetic(args.n, args.dim)
+    rng = np.random.default_rng(1)
+    queries = np.asarray(data[rng.choice(len(data), args.queries,
+                                         replace=False)])
+
+    start = time.perf_counter()
+    _, exact = blocked_topk(data, args.topk, queries=queries,
+                            measure=args.measure)
+    exact_qps = len(queries) / (time.perf_counter() - start)
+
+    start = time.perf_counter()
+    index = IVFIndex.build(data, measure=args.measure, nlist=args.nlist)
+    build_seconds = time.perf_counter() - start
+    print(json.dumps({"n": len(data), "nlist": index.nlist,
+                      "build_seconds": round(build_seconds, 3),
+                      "exact_qps": round(exact_qps, 1)}))
+    for nprobe in args.nprobe:
+        start = time.perf_counter()
+        _, approx = index.search(queries, args.topk, nprobe=nprobe)
+        qps = len(queries) / (time.perf_counter() - start)
+        print(json.dumps({"nprobe": nprobe,
+                          "recall": round(recall(exact, approx), 4),
+                          "qps": round(qps, 1)}))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+"""
+    Import-time regression benchmark.
+
+    Measures `import fastaug` in fresh interpreters and fails when it gets
+    slower than `--max-seconds` or when a heavy dependency is imported
+    eagerly again.
+
+        python benchmarks/bench_import.py [--repeat 5] [--max-seconds 1.0]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+# the probes import the fastaug of this checkout
+ROOT = Path(__file__).parent.parent
+
+# only loaded on first use of EmbeddingNbrUtil, DownloadUtil or WordNetSub
+LAZY_MODULES = ["torch", "nltk", "tabulate", "requests", "urllib.request"]
+
+PROBE = """
+import sys, time
+t = time.perf_counter()
+import fastaug
+t = time.perf_counter() - t
+import json
+print(json.dumps({"seconds": t, "loaded": [m for m in %r if m in sys.modules]}))
+""" % (LAZY_MODULES, )
+
+
+def measure(repeat):
+    runs = []
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, "-c", PROBE],
+                             cwd=ROOT,
+                             check=True,
+                             capture_output=True,
+                             text=True).stdout
+        runs.append(json.loads(out.strip().splitlines()[-1]))
+    return {
+        "median_seconds": statistics.median(r["seconds"] for r in runs),
+        "min_seconds": min(r["seconds"] for r in runs),
+        "eager_modules": sorted(set(m for r in runs for m in r["loaded"])),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--max-seconds", type=float, default=1.0)
+    args = parser.parse_args()
+
+    result = measure(args.repeat)
+    print(json.dumps(result, indent=2))
+    if result["eager_modules"]:
+        print(f"FAIL: {result['eager_modules']} imported by `import fastaug`")
+        sys.exit(1)
+    if result["median_seconds"] > args.max_seconds:
+        print(f"FAIL: `import fastaug` took {result['median_seconds']:.3f}s "
+              f"> {args.max_seconds}s")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,357 @@
+"""
+    Benchmark suite of fastaug.
+
+        python benchmarks/bench_suite.py [--quick] [--filter op/]
+            [--out results.json] [--baseline benchmarks/baseline.json]
+            [--tolerance 0.4] [--save-baseline]
+
+    Measures every op on sentences of several lengths, one by one and in
+    batches, full Augmentor pipelines (string and id mode), tokenizer
+    throughput, lexicon load time, import time and the peak memory of the
+    pipelines. Results are written as JSON and compared with a baseline:
+    the run fails when a metric is worse than the baseline by more than
+    `--tolerance`. Baselines depend on the machine, regenerate yours with
+    `--save-baseline` before comparing changes.
+"""
+from typing import Callable, Dict, List
+import argparse
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from pathlib import Path
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from bench_import import measure as measure_import
+
+HERE = Path(__file__).parent
+BASELINE = HERE / "baseline.json"
+
+TEXT = ("Five score years ago, a great American, in whose symbolic shadow we "
+        "stand today, signed the Emancipation Proclamation. This momentous "
+        "decree came as a great beacon light of hope to millions of Negro "
+        "slaves who had been seared in the flames of withering injustice. "
+        "It came as a joyous daybreak to end the long night of captivity.")
+MULTILINGUAL = ("The quick brown fox, jumped over the lazy dog! "
+                "我们今天去公园玩。 Это тест, да? ¿Qué tal?")
+
+
+def sentence(n_tokens: int, seed: int = 0) -> str:
+    words = TEXT.split()
+    rng = random.Random(seed)
+    return " ".join(rng.choice(words) for _ in range(n_tokens))
+
+
+def rate(fn: Callable[[], int], min_time: float, repeat: int = 5) -> float:
+    """
+        Items per second of `fn`, which returns the number of items it
+        processed: the best of `repeat` runs of at least `min_time /
+        repeat` seconds each, which filters out most of the noise.
+    """
+    fn()
+    best = 0.0
+    for _ in range(repeat):
+        count = 0
+        start = time.perf_counter()
+        while True:
+            count += fn()
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time / repeat:
+                break
+        best = max(best, count / elapsed)
+    return best
+
+
+def peak_kb(fn: Callable[[], object]) -> float:
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1] / 1024
+    finally:
+        tracemalloc.stop()
+
+
+def make_ops():
+    import fastaug
+    ops = {
+        "WordRandomMask": lambda: fastaug.WordRandomMask(0.1, seed=0),
+        "WordRandomSwap": lambda: fastaug.WordRandomSwap(0.1, seed=0),
+        "WordRandomDelete": lambda: fastaug.WordRandomDelete(0.1, seed=0),
+        "WordMorphSub": lambda: fastaug.WordMorphSub(0.1, seed=0),
+        "WordEmbedSub": lambda: fastaug.WordEmbedSub(0.1, seed=0),
+        "CharRandomSwap": lambda: fastaug.CharRandomSwap(0.1, seed=0),
+        "CharRandomDelete": lambda: fastaug.CharRandomDelete(0.1, seed=0),
+        "CharTypoSub": lambda: fastaug.CharTypoSub(0.1, seed=0),
+        "SpanRandomMask": lambda: fastaug.SpanRandomMask(0.1, seed=0),
+    }
+    return ops
+
+
+def make_pipelines():
+    import fastaug
+    return {
+        "word":
+        lambda: fastaug.Augmentor([
+            fastaug.WordMorphSub(0.1),
+            fastaug.WordEmbedSub(0.1),
+            fastaug.WordRandomDelete(0.1),
+            fastaug.WordRandomMask(0.1)
+        ],
+                                  seed=0),
+        "char":
+        lambda: fastaug.Augmentor([
+            fastaug.CharRandomSwap(0.1),
+            fastaug.CharRandomDelete(0.1),
+            fastaug.CharTypoSub(0.1)
+        ],
+                                  seed=0),
+        "mixed":
+        lambda: fastaug.Augmentor([
+            fastaug.WordMorphSub(0.1),
+            fastaug.WordRandomDelete(0.1),
+            fastaug.CharRandomSwap(0.1),
+            fastaug.CharRandomDelete(0.1),
+            fastaug.SpanRandomMask(0.05)
+        ],
+                                  seed=0),
+    }
+
+
+def bench_ops(lengths, batch_sizes, min_time) -> Dict[str, dict]:
+    results = {}
+    for name, make in make_ops().items():
+        op = make()
+        for n_tokens in lengths:
+            tokens = sentence(n_tokens).split()
+            results[f"op/{name}/len{n_tokens}"] = {
+                "value": rate(lambda: (op(tokens), 1)[1], min_time),
+                "unit": "sentences/s",
+            }
+            for batch_size in batch_sizes:
+                batch = [
+                    sentence(n_tokens, i).split() for i in range(batch_size)
+                ]
+
+                def run():
+                    op.apply_batch([list(tokens) for tokens in batch])
+                    return batch_size
+
+                results[f"op/{name}/len{n_tokens}/batch{batch_size}"] = {
+                    "value": rate(run, min_time),
+                    "unit": "sentences/s",
+                }
+    return results
+
+
+def bench_pipelines(lengths, batch_sizes, min_time) -> Dict[str, dict]:
+    results = {}
+    for name, make in make_pipelines().items():
+        aug = make()
+        for n_tokens in lengths:
+            sent = sentence(n_tokens)
+            results[f"pipeline/{name}/len{n_tokens}/n3"] = {
+                "value": rate(lambda: (aug.augment(sent, 3), 1)[1], min_time),
+                "unit": "sentences/s",
+            }
+            for batch_size in batch_sizes:
+                sents = [sentence(n_tokens, i) for i in range(batch_size)]
+                for mode in ("str", "ids"):
+
+                    def run():
+                        aug.augment_batch(sents,
+                                          n=3,
+                                          num_workers=0,
+                                          chunk_size=batch_size,
+                                          id_mode=mode == "ids")
+                        return batch_size
+
+                    key = f"pipeline/{name}/len{n_tokens}/batch{batch_size}"
+                    results[f"{key}/{mode}"] = {
+                        "value": rate(run, min_time),
+                        "unit": "sentences/s",
+                    }
+                    results[f"{key}/{mode}/peak_memory"] = {
+                        "value": peak_kb(run),
+                        "unit": "KiB",
+                        "lower_is_better": True,
+                    }
+    return results
+
+
+def bench_tokenizer(min_time) -> Dict[str, dict]:
+    from fastaug.tokenizer import (better_tokenize, tokenize,
+                                   tokenize_with_offsets,
+                                   tokenize_with_spacing)
+    texts = [TEXT, MULTILINGUAL * 4]
+    n_chars = sum(len(text) for text in texts)
+    cases = {
+        "tokenize": tokenize,
+        "better_tokenize": better_tokenize,
+        "spacing/space": lambda t: tokenize_with_spacing(t, "space"),
+        "spacing/better": lambda t: tokenize_with_spacing(t, "better"),
+        "offsets/better": lambda t: tokenize_with_offsets(t, "better"),
+    }
+    results = {}
+    for name, fn in cases.items():
+
+        def run():
+            for text in texts:
+                fn(text)
+            return n_chars
+
+        results[f"tokenizer/{name}"] = {
+            "value": rate(run, min_time),
+            "unit": "chars/s",
+        }
+    return results
+
+
+def bench_lexicons() -> Dict[str, dict]:
+    from fastaug.lexicon import compile_lexicon
+    from fastaug.util import load_resource
+    results = {}
+    for name in ("morphs.json", "embed_top_16_dist_dot25.json"):
+        with tempfile.TemporaryDirectory() as tmp:
+            out = os.path.join(tmp, "lexicon.lex")
+            start = time.perf_counter()
+            compile_lexicon([str(load_resource(name))], out)
+            results[f"lexicon/{name}/compile"] = {
+                "value": time.perf_counter() - start,
+                "unit": "s",
+                "lower_is_better": True,
+            }
+            # loading is timed in a fresh interpreter, cold caches apart,
+            # once fastaug is imported
+            probe = ("import time; from fastaug.lexicon import Lexicon; "
+                     "t = time.perf_counter(); "
+                     f"lex = Lexicon({out!r}); lex.get('good'); "
+                     "print(time.perf_counter() - t)")
+            out_s = subprocess.run([sys.executable, "-c", probe],
+                                   cwd=HERE.parent,
+                                   check=True,
+                                   capture_output=True,
+                                   text=True).stdout
+            results[f"lexicon/{name}/load"] = {
+                "value": float(out_s.strip().splitlines()[-1]),
+                "unit": "s",
+                "lower_is_better": True,
+            }
+    return results
+
+
+def run_suite(args) -> Dict[str, dict]:
+    if args.quick:
+        lengths, batch_sizes, min_time = [32], [64], 0.1
+    else:
+        lengths, batch_sizes, min_time = [8, 32, 128], [1, 64, 1024], 0.3
+    groups = {
+        "import": lambda: {
+            "import/seconds": {
+                "value": measure_import(3)["median_seconds"],
+                "unit": "s",
+                "lower_is_better": True,
+            }
+        },
+        "lexicon": bench_lexicons,
+        "tokenizer": lambda: bench_tokenizer(min_time),
+        "op": lambda: bench_ops(lengths, batch_sizes, min_time),
+        "pipeline": lambda: bench_pipelines(lengths, batch_sizes, min_time),
+    }
+    results = {}
+    for group, fn in groups.items():
+        if args.filter and not any(f.split("/")[0] == group
+                                   for f in args.filter):
+            continue
+        print(f"running {group} benchmarks...", file=sys.stderr)
+        for key, result in fn().items():
+            if not args.filter or any(key.startswith(f) for f in args.filter):
+                results[key] = result
+    return results
+
+
+def compare(results: Dict[str, dict], baseline: Dict[str, dict],
+            tolerance: float) -> List[str]:
+    """
+        Print the change of every metric against the baseline and return
+        the regressed ones.
+    """
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        old, new = baseline[key]["value"], result["value"]
+        if old == 0:
+            continue
+        if result.get("lower_is_better"):
+            change = old / new - 1 if new else float("inf")
+        else:
+            change = new / old - 1
+        flag = ""
+        if change < -tolerance:
+            flag = "  REGRESSION"
+            regressions.append(key)
+        print(f"{key:60s} {old:14.4g} -> {new:14.4g} {result['unit']:12s} "
+              f"{change:+7.1%}{flag}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--quick",
+                        action="store_true",
+                        help="one length and batch size, short timings")
+    parser.add_argument("--filter",
+                        nargs="+",
+                        default=None,
+                        help="only run the metrics starting with these "
+                        "prefixes, e.g. op/CharTypoSub tokenizer")
+    parser.add_argument("--out", default=None, help="write results here")
+    parser.add_argument("--baseline", default=str(BASELINE))
+    parser.add_argument("--tolerance",
+                        type=float,
+                        default=0.4,
+                        help="relative slowdown tolerated before failing")
+    parser.add_argument("--save-baseline",
+                        action="store_true",
+                        help="store the results as the new baseline")
+    args = parser.parse_args()
+
+    results = run_suite(args)
+    report = {
+        "meta": {
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "quick": args.quick,
+        },
+        "results": results,
+    }
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(report, f, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"baseline written to {args.baseline}", file=sys.stderr)
+        return
+    if not os.path.exists(args.baseline):
+        print(json.dumps(report, indent=2))
+        return
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)["results"]
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"FAIL: {len(regressions)} metrics regressed by more than "
+              f"{args.tolerance:.0%}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+"""
+    Load test of the augmentation server.
+
+        python benchmarks/load_test.py --url http://127.0.0.1:8000 \\
+            --pipeline default [--clients 32] [--duration 10] [--texts 1]
+
+    Without `--url` or `--unix`, a server is started in this process with
+    a mixed word/char pipeline. `--clients` threads send requests of
+    `--texts` sentences back to back for `--duration` seconds; the
+    throughput, the latency percentiles and the micro-batches formed by
+    the server are reported.
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent.parent))
+from fastaug.client import AugmentClient
+from fastaug.cli import build_augmentor
+from fastaug.server import AugmentServer
+
+SPEC = {
+    "ops": [{
+        "op": "WordMorphSub",
+        "aug_p": 0.1
+    }, {
+        "op": "WordRandomDelete",
+        "aug_p": 0.1
+    }, {
+        "op": "CharRandomSwap",
+        "aug_p": 0.1
+    }],
+    "seed": 0
+}
+SENTENCE = ("Five score years ago, a great American, in whose symbolic shadow "
+            "we stand today, signed the Emancipation Proclamation.")
+
+
+def start_local_server(unix_path: str, workers: int, max_batch: int,
+                       max_delay: float):
+    server = AugmentServer({"default": build_augmentor(SPEC)},
+                           workers=workers,
+                           max_batch=max_batch,
+                           max_delay=max_delay)
+    ready = threading.Event()
+
+    def run():
+        loop = asyncio.new_event_loop()
+        loop.run_until_complete(server.start(unix_path=unix_path))
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+    return server
+
+
+def client_loop(args, latencies, stop_at):
+    texts = [SENTENCE] * args.texts
+    with AugmentClient(args.url, unix_path=args.unix) as client:
+        while time.perf_counter() < stop_at:
+            start = time.perf_counter()
+            client.augment(args.pipeline, texts, n=args.n)
+            latencies.append(time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--url", default=None)
+    parser.add_argument("--unix", default=None)
+    parser.add_argument("--pipeline", default="default")
+    parser.add_argument("--clients", type=int, default=32)
+    parser.add_argument("--duration", type=float, default=10.0)
+    parser.add_argument("--texts", type=int, default=1)
+    parser.add_argument("-n", type=int, default=1)
+    parser.add_argument("--workers",
+                        type=int,
+                        default=None,
+                        help="workers of the local server")
+    parser.add_argument("--max-batch", type=int, default=256)
+    parser.add_argument("--max-delay-ms", type=float, default=5.0)
+    args = parser.parse_args()
+
+    server = None
+    if args.url is None and args.unix is None:
+        args.unix = os.path.join(tempfile.mkdtemp(), "fastaug.sock")
+        server = start_local_server(args.unix, args.workers
+                                    or os.cpu_count() or 1, args.max_batch,
+                                    args.max_delay_ms / 1000)
+
+    per_client = [[] for _ in range(args.clients)]
+    stop_at = time.perf_counter() + args.duration
+    threads = [
+        threading.Thread(target=client_loop, args=(args, lat, stop_at))
+        for lat in per_client
+    ]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(x for lat in per_client for x in lat)
+    if not latencies:
+        sys.exit("no request completed")
+    pct = lambda q: latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+    report = {
+        "requests": len(latencies),
+        "requests_per_s": len(latencies) / elapsed,
+        "sentences_per_s": len(latencies) * args.texts / elapsed,
+        "latency_ms": {
+            "mean": statistics.mean(latencies) * 1000,
+            "p50": pct(0.5) * 1000,
+            "p95": pct(0.95) * 1000,
+            "p99": pct(0.99) * 1000,
+        },
+    }
+    if server is not None:
+        report["server"] = server.stats()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""
+    Walker alias tables, for weighted sampling in O(1).
+
+    The table of `n` weights is a list of probabilities `prob` and of
+    indices `alias`, built in O(n) with Vose's method. A uniform `u` in
+    [0, 1) picks `k = int(u * n)`, then keeps `k` if the fractional part
+    of `u * n` is below `prob[k]`, else takes `alias[k]`. A single draw
+    per pick is enough, and equal weights pick `int(u * n)` exactly like
+    uniform sampling does.
+
+    Many tables are stored in CSR form, aligned with candidate arrays, so
+    that picks can be vectorized over a batch (see `pick_batch`).
+"""
+from typing import Sequence, Tuple
+import numpy as np
+
+AliasTable = Tuple[Sequence[float], Sequence[int]]
+
+
+def alias_table(weights: Sequence[float]) -> AliasTable:
+    n = len(weights)
+    total = float(sum(weights))
+    if n == 0:
+        return [], []
+    if total <= 0 or any(w < 0 for w in weights):
+        raise ValueError("weights must be non-negative, with a positive sum")
+    scaled = [w * n / total for w in weights]
+    prob = [1.0] * n
+    alias = list(range(n))
+    small = [i for i, p in enumerate(scaled) if p < 1.0]
+    large = [i for i, p in enumerate(scaled) if p >= 1.0]
+    while small and large:
+        s, l = small.pop(), large.pop()
+        prob[s] = scaled[s]
+        alias[s] = l
+        scaled[l] -= 1.0 - scaled[s]
+        if scaled[l] < 1.0:
+            small.append(l)
+        else:
+            large.append(l)
+    # leftovers are 1 up to rounding errors
+    return prob, alias
+
+
+def alias_tables(offsets: np.ndarray,
+                 weights: Sequence[Sequence[float]]
+                 ) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        The tables of CSR rows, `weights[i]` having `offsets[i + 1] -
+        offsets[i]` weights: probabilities and row-local alias indices
+        aligned with the candidates.
+    """
+    size = int(offsets[-1])
+    prob = np.ones(size, dtype=np.float32)
+    alias = np.zeros(size, dtype=np.int32)
+    for i, row in enumerate(weights):
+        start, end = int(offsets[i]), int(offsets[i + 1])
+        if len(row) != end - start:
+            raise ValueError(f"row {i} has {end - start} candidates but "
+                             f"{len(row)} weights")
+        p, a = alias_table(row)
+        prob[start:end] = p
+        alias[start:end] = a
+    return prob, alias
+
+
+def pick(table: AliasTable, u: float) -> int:
+    prob, alias = table
+    x = u * len(prob)
+    k = int(x)
+    return k if x - k < prob[k] else alias[k]
+
+
+def pick_batch(u: np.ndarray, counts: np.ndarray, starts: np.ndarray,
+               prob: np.ndarray, alias: np.ndarray) -> np.ndarray:
+    """
+        Vectorized `pick` of the rows at `starts` (of `counts` entries) of
+        CSR tables. Returns row-local indices.
+    """
+    x = u * counts
+    k = x.astype(np.int64)
+    keep = (x - k) < prob[starts + k]
+    return np.where(keep, k, alias[starts + k])
@@ -0,0 +1,171 @@
+"""
+    Approximate nearest neighbour search with an inverted file (IVF)
+    index in pure numpy.
+
+    The vectors are clustered with k-means into `nlist` lists; a query
+    only scans the lists of its `nprobe` nearest centroids. Larger
+    `nprobe` means higher recall and slower queries, `nprobe == nlist` is
+    an exact search.
+
+    An index is saved as a directory of `.npy` files plus `meta.json` and
+    memory-mapped when loaded, so processes share its pages.
+"""
+from typing import Optional, Tuple
+from pathlib import Path
+import json
+import numpy as np
+from .knn import MEASURES, as_numpy, blocked_topk, normalize
+
+ARRAYS = ("centroids", "list_offsets", "ids", "vectors", "sq_norms")
+
+
+class IVFIndex:
+    def __init__(self, measure: str, centroids: np.ndarray,
+                 list_offsets: np.ndarray, ids: np.ndarray,
+                 vectors: np.ndarray, sq_norms: np.ndarray, nprobe: int):
+        self.measure = measure
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.ids = ids
+        self.vectors = vectors
+        self.sq_norms = sq_norms
+        self.nprobe = nprobe
+
+    @property
+    def nlist(self) -> int:
+        return len(self.centroids)
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @staticmethod
+    def build(data,
+              measure: str = "cos",
+              nlist: Optional[int] = None,
+              nprobe: int = 8,
+              niter: int = 10,
+              max_train_size: Optional[int] = None,
+              seed: Optional[int] = 0,
+              num_threads: Optional[int] = None) -> "IVFIndex":
+        """
+            Cluster `data` (N x d) into `nlist` lists, 4 * sqrt(N) by
+            default. k-means runs `niter` iterations on at most
+            `max_train_size` random rows (256 per list by default).
+        """
+        if measure not in MEASURES:
+            raise ValueError(
+                f"measure must be one of {MEASURES}, got {measure}")
+        data = as_numpy(data[:])
+        if measure == "cos":
+            data = normalize(data)
+        if nlist is None:
+            nlist = max(1, int(4 * np.sqrt(len(data))))
+        nlist = min(nlist, len(data))
+        if max_train_size is None:
+            max_train_size = 256 * nlist
+        rng = np.random.default_rng(seed)
+        train = data
+        if len(data) > max_train_size:
+            train = data[rng.choice(len(data), max_train_size, replace=False)]
+        centroids = _kmeans(train, nlist, niter, measure, rng, num_threads)
+
+        _, assign = blocked_topk(centroids,
+                                 1,
+                                 queries=data,
+                                 measure=measure,
+                                 num_threads=num_threads)
+        assign = assign[:, 0]
+        ids = np.argsort(assign, kind="stable")
+        list_offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assign, minlength=nlist), out=list_offsets[1:])
+        vectors = np.ascontiguousarray(data[ids])
+        sq_norms = np.einsum("ij,ij->i", vectors, vectors)
+        return IVFIndex(measure, centroids, list_offsets, ids, vectors,
+                        sq_norms, min(nprobe, nlist))
+
+    def save(self, path: str):
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        for name in ARRAYS:
+            np.save(path / f"{name}.npy", getattr(self, name))
+        with open(path / "meta.json", "w") as f:
+            json.dump({"measure": self.measure, "nprobe": self.nprobe}, f)
+
+    @staticmethod
+    def load(path: str, mmap: bool = True) -> "IVFIndex":
+        path = Path(path)
+        with open(path / "meta.json", "r") as f:
+            meta = json.load(f)
+        arrays = {
+            name: np.load(path / f"{name}.npy",
+                          mmap_mode="r" if mmap else None)
+            for name in ARRAYS
+        }
+        return IVFIndex(meta["measure"], nprobe=meta["nprobe"], **arrays)
+
+    def search(self,
+               queries,
+               topk: int,
+               nprobe: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+        """
+            Return `(D, I)` like `fastaug.knn.blocked_topk`. Rows with less
+            than `topk` candidates in their probed lists are padded with
+            `inf` distances and `-1` indices.
+        """
+        nprobe = min(nprobe or self.nprobe, self.nlist)
+        queries = as_numpy(queries)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        if self.measure == "cos":
+            queries = normalize(queries)
+        _, probes = blocked_topk(self.centroids,
+                                 nprobe,
+                                 queries=queries,
+                                 measure=self.measure,
+                                 num_threads=1)
+        D = np.full((len(queries), topk), np.inf, dtype=np.float32)
+        I = np.full((len(queries), topk), -1, dtype=np.int64)
+        offsets = self.list_offsets
+        for i, query in enumerate(queries):
+            rows = np.concatenate(
+                [np.arange(offsets[l], offsets[l + 1]) for l in probes[i]])
+            if len(rows) == 0:
+                continue
+            sim = self.vectors[rows] @ query
+            if self.measure == "cos":
+                dist = 1.0 - sim
+            else:
+                dist = np.maximum(self.sq_norms[rows] - 2 * sim + query @ query,
+                                  0.0)
+            k = min(topk, len(rows))
+            top = np.argpartition(dist, k - 1)[:k]
+            top = top[np.argsort(dist[top], kind="stable")]
+            D[i, :k] = dist[top] if self.measure == "cos" else np.sqrt(
+                dist[top])
+            I[i, :k] = self.ids[rows[top]]
+        return D, I
+
+
+def _kmeans(data: np.ndarray, k: int, niter: int, measure: str,
+            rng: np.random.Generator, num_threads: Optional[int]):
+    centroids = data[rng.choice(len(data), k, replace=False)].copy()
+    for _ in range(niter):
+        _, assign = blocked_topk(centroids,
+                                 1,
+                                 queries=data,
+                                 measure=measure,
+                                 num_threads=num_threads)
+        assign = assign[:, 0]
+        order = np.argsort(assign, kind="stable")
+        counts = np.bincount(assign, minlength=k)
+        nonempty = np.flatnonzero(counts)
+        starts = (np.cumsum(counts) - counts)[nonempty]
+        sums = np.add.reduceat(data[order], starts, axis=0)
+        centroids[nonempty] = sums / counts[nonempty, None]
+        # empty lists are restarted from random points
+        empty = np.flatnonzero(counts == 0)
+        if len(empty):
+            centroids[empty] = data[rng.choice(len(data), len(empty))]
+        if measure == "cos":
+            centroids = normalize(centroids)
+    return centroids.astype(np.float32)
@@ -1,64 +1,136 @@
-import random
-from typing import List
-import copy
-from .defs import AugOp
-import json
-from ..util import load_resource, randint
-
-
-class CharRandomSwap(AugOp):
-    def __call__(self, tokens: List[str]) -> List[str]:
-        ret = copy.copy(tokens)
-        for _ in range(self.aug_len(tokens)):
-            pos = randint(0, len(ret))
-            word = ret[pos]
-            if len(word) > 4:
-                # only allow char not at the boundary
-                cpos = randint(1, len(word) - 1)
-                word = word[:cpos] \
-                        + word[cpos + 1] + word[cpos] \
-                        + word[cpos + 2:]
-                ret[pos] = word
-        return ret
-
-
-class CharRandomDelete(AugOp):
-    def __call__(self, tokens: List[str]) -> List[str]:
-        ret = copy.copy(tokens)
-        for _ in range(self.aug_len(tokens)):
-            pos = randint(0, len(ret))
-            word = ret[pos]
-            if len(word) > 2:
-                # only allow char not at the boundary
-                cpos = randint(1, len(word) - 1)
-                word = word[:cpos + 1] + word[cpos + 2:]
-                ret[pos] = word
-        return ret
-
-
-class CharTypoSub(AugOp):
-    def __init__(self, aug_p: float) -> None:
-        super().__init__(aug_p)
-        a = json.load(open(load_resource("typo_ocr.json")))
-        b = json.load(open(load_resource("typo_keyboard.json")))
-        self.mapping = {}
-        for k in set(a.keys()).union(set(b.keys())):
-            vals = []
-            if k in a:
-                vals.extend(a[k])
-            if k in b:
-                vals.extend(b[k])
-            self.mapping[k] = list(set(vals))
-
-    def __call__(self, tokens: List[str]) -> List[str]:
-        ret = copy.copy(tokens)
-        for _ in range(self.aug_len(tokens)):
-            pos = randint(0, len(ret))
-            word = ret[pos]
-            # allow modifying any char
-            cpos = randint(0, len(word))
-            if word[cpos] in self.mapping:
-                word = word[:cpos] + random.choice(
-                    self.mapping[word[cpos]]) + word[cpos + 1:]
-            ret[pos] = word
-        return ret
+from typing import List, Tuple
+import numpy as np
+from .defs import AugOp, CharOp, Seed
+from ..codepoints import (encode_words, decode_words, load_confusion_table,
+                          load_typo_table)
+from ..lexicon import load_resource_lexicon
+
+
+class CharRandomSwap(CharOp):
+    def edit(self, word: str, u: float) -> str:
+        if len(word) > 4:
+            # only allow char not at the boundary
+            cpos = 1 + int(u * (len(word) - 2))
+            word = word[:cpos] \
+                    + word[cpos + 1] + word[cpos] \
+                    + word[cpos + 2:]
+        return word
+
+    def edit_batch(self, cps: np.ndarray, lengths: np.ndarray,
+                   draws: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        r = np.flatnonzero(lengths > 4)
+        cpos = 1 + (draws[r, 0] * (lengths[r] - 2)).astype(np.int64)
+        cps[r, cpos], cps[r, cpos + 1] = cps[r, cpos + 1], cps[r, cpos]
+        return cps, lengths
+
+
+class CharRandomDelete(CharOp):
+    def edit(self, word: str, u: float) -> str:
+        if len(word) > 2:
+            # only allow char not at the boundary
+            cpos = 1 + int(u * (len(word) - 2))
+            word = word[:cpos + 1] + word[cpos + 2:]
+        return word
+
+    def edit_batch(self, cps: np.ndarray, lengths: np.ndarray,
+                   draws: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        r = np.flatnonzero(lengths > 2)
+        dpos = 2 + (draws[r, 0] * (lengths[r] - 2)).astype(np.int64)
+        # shift the chars after `dpos` one step left
+        cols = np.arange(cps.shape[1])
+        src = cols[None, :] + (cols[None, :] >= dpos[:, None])
+        cps[r] = np.take_along_axis(cps[r],
+                                    np.minimum(src, len(cols) - 1),
+                                    axis=1)
+        cps[r, lengths[r] - 1] = 0
+        lengths[r] -= 1
+        return cps, lengths
+
+
+class CharTypoSub(CharOp):
+    n_draws = 2
+
+    def __init__(self, aug_p: float, seed: Seed = None) -> None:
+        super().__init__(aug_p, seed)
+        self.mapping = load_resource_lexicon("typo_ocr.json",
+                                             "typo_keyboard.json")
+        self.table = load_typo_table("typo_ocr.json", "typo_keyboard.json")
+
+    def edit(self, word: str, u: float, v: float) -> str:
+        # allow modifying any char
+        cpos = int(u * len(word))
+        cands = self.mapping.get(word[cpos])
+        if cands:
+            word = word[:cpos] + cands[int(v * len(cands))] + word[cpos + 1:]
+        return word
+
+    def edit_batch(self, cps: np.ndarray, lengths: np.ndarray,
+                   draws: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        table = self.table
+        r = np.flatnonzero(lengths > 0)
+        cpos = (draws[r, 0] * lengths[r]).astype(np.int64)
+        c = cps[r, cpos]
+        counts = table.lookup_counts(c)
+        has = counts > 0
+        r, cpos, c = r[has], cpos[has], c[has]
+        i = (draws[r, 1] * counts[has]).astype(np.int64)
+        new = table.cands[table.offsets[c] + i]
+        short = new != 0
+        cps[r[short], cpos[short]] = new[short]
+        if short.all():
+            return cps, lengths
+        # candidates of several chars change the length of the word
+        r, cpos, c, i = r[~short], cpos[~short], c[~short], i[~short]
+        words = decode_words(cps, lengths)
+        for row, pos, char, idx in zip(r.tolist(), cpos.tolist(), c.tolist(),
+                                       i.tolist()):
+            word = words[row]
+            words[row] = word[:pos] + table.long_cands[(char, idx)] \
+                + word[pos + 1:]
+        return encode_words(words, cps.shape[1])
+
+
+class CharConfusionSub(AugOp):
+    """
+        Substitutes characters, e.g. of Chinese text, by visually or
+        phonetically confusable ones (confusion_zh.json by default).
+        Unlike the other char ops, it edits `aug_p` of the characters of
+        the whole text which have candidates, whatever its tokenization,
+        so it also works on untokenized text (see `augment_text`). Texts
+        are processed as arrays of code points.
+    """
+    def __init__(self,
+                 aug_p: float,
+                 seed: Seed = None,
+                 confusion: str = "confusion_zh.json") -> None:
+        super().__init__(aug_p, seed)
+        self.table = load_confusion_table(confusion)
+
+    def augment_text(self, text: str) -> str:
+        cps = np.frombuffer(text.encode("utf-32-le"), dtype=np.uint32)
+        return self._sub(cps).tobytes().decode("utf-32-le")
+
+    def apply(self, tokens: List[str]) -> List[str]:
+        if not tokens:
+            return tokens
+        text = self.augment_text("".join(tokens))
+        start = 0
+        for i, token in enumerate(tokens):
+            # substitutions keep the number of characters
+            tokens[i] = text[start:start + len(token)]
+            start += len(token)
+        return tokens
+
+    def _sub(self, cps: np.ndarray) -> np.ndarray:
+        table = self.table
+        counts = table.lookup_counts(cps)
+        pos = np.flatnonzero(counts)
+        if len(pos) == 0:
+            return cps
+        k = max(1, int(len(pos) * self.aug_p))
+        pos = pos[self.rng.choice(len(pos), k, replace=False)]
+        c = cps[pos]
+        i = (np.array(self.uniform(k)) * counts[pos]).astype(np.int64)
+        cps = cps.copy()
+        cps[pos] = table.cands[table.offsets[c] + i]
+        return cps
@@ -1,12 +1,233 @@
-from typing import List
+from typing import List, Tuple, Union
+import copy
+import numpy as np
+from ..codepoints import decode_words, encode_words
+from ..vocab import Vocab, pad
 
+Seed = Union[None, int, np.random.SeedSequence]
 
-class AugOp:
-    def __init__(self, aug_p):
+# number of uniforms drawn from numpy at once by `Seedable.uniform`
+DRAW_CHUNK = 4096
+
+
+class Seedable:
+    """
+        Owner of a `numpy.random.Generator` stream, `rng`, created from
+        `seed_seq`.
+    """
+    def seed(self, seed: Seed = None):
+        """
+            Reset the random stream. `seed` may be an int, a
+            `numpy.random.SeedSequence` or None for fresh OS entropy.
+        """
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.seed_seq = seed
+        self.rng = np.random.default_rng(seed)
+        self._draws = []
+        self._draw_pos = 0
+        return self
+
+    def uniform(self, k: int) -> List[float]:
+        """
+            Return `k` uniform numbers in [0, 1) from `rng`. They are drawn
+            in bulk and buffered, so short sentences do not pay a numpy
+            call per edit.
+        """
+        pos = self._draw_pos
+        if pos + k > len(self._draws):
+            self._draws = self._draws[pos:] + self.rng.random(
+                max(k, DRAW_CHUNK)).tolist()
+            pos = 0
+        self._draw_pos = pos + k
+        return self._draws[pos:pos + k]
+
+
+class AugOp(Seedable):
+    def __init__(self, aug_p, seed: Seed = None):
         self.aug_p = aug_p
+        self.seed(seed)
+
+    def spawn(self, n: int) -> List["AugOp"]:
+        """
+            Return `n` copies of the op with independent child streams.
+            Resources such as lexicons are shared, not copied.
+        """
+        ret = []
+        for child in self.seed_seq.spawn(n):
+            op = copy.copy(self)
+            op.seed(child)
+            ret.append(op)
+        return ret
 
     def aug_len(self, tokens: List[str]):
+        """
+            The number of edits of `tokens`, at least 1, 0 when empty.
+        """
+        if not tokens:
+            return 0
         return max(1, int(len(tokens) * self.aug_p))
 
+    def aug_lens(self, lengths: np.ndarray) -> np.ndarray:
+        """
+            `aug_len` of sentences of the given lengths, 0 when empty.
+        """
+        return np.where(lengths > 0,
+                        np.maximum(1, (lengths * self.aug_p).astype(np.int64)),
+                        0)
+
+    def apply(self, tokens: List[str]) -> List[str]:
+        """
+            Augment `tokens` in place and return the result. Ops changing
+            the number of tokens may return a new list instead. Augmentor
+            calls this on a buffer it owns, so no defensive copy is needed.
+        """
+        raise NotImplementedError
+
+    def apply_batch(self, batch: List[List[str]]) -> List[List[str]]:
+        """
+            Augment every token list of `batch`, in place when possible.
+            Ops may override this to draw for the whole batch at once.
+        """
+        return [self.apply(tokens) for tokens in batch]
+
+    def apply_ids(self, ids: np.ndarray, lengths: np.ndarray,
+                  vocab: Vocab) -> Tuple[np.ndarray, np.ndarray]:
+        """
+            Augment a batch of token ids padded with `fastaug.vocab.PAD`,
+            in place when possible, and return the ids with their lengths.
+            By default the tokens are decoded, augmented by `apply_batch`
+            and encoded again.
+        """
+        batch = self.apply_batch(vocab.decode_batch(ids, lengths))
+        return pad([vocab.encode(tokens) for tokens in batch])
+
     def __call__(self, tokens: List[str]) -> List[str]:
-        raise NotImplementedError
\ No newline at end of file
+        return self.apply(copy.copy(tokens))
+
+
+class CharOp(AugOp):
+    """
+        An op editing `aug_len` randomly chosen words independently. 
+        Consecutive char ops are fused by Augmentor into a single pass.
+        `edit` receives `n_draws` uniform numbers in [0, 1) drawn in bulk
+        with the positions instead of calling the RNG itself.
+    """
+    n_draws = 1
+    # below this many edits, `apply_batch` edits sentence by sentence,
+    # with the same results
+    batch_min_edits = 256
+
+    def edit(self, word: str, *draws: float) -> str:
+        raise NotImplementedError
+
+    def edit_batch(self, cps: np.ndarray, lengths: np.ndarray,
+                   draws: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+            Edit every word of a batch of code points (see
+            `fastaug.codepoints`), row `i` with the draws `draws[i]`, and
+            return the code points and lengths. By default the words are
+            decoded and given to `edit`.
+        """
+        words = [
+            self.edit(word, *row) for word, row in zip(
+                decode_words(cps, lengths), draws.tolist())
+        ]
+        return encode_words(words, cps.shape[1])
+
+    def apply(self, tokens: List[str]) -> List[str]:
+        return apply_char_ops([self], tokens)
+
+    def apply_batch(self, batch: List[List[str]]) -> List[List[str]]:
+        n_edits = sum(self.aug_len(tokens) for tokens in batch if tokens)
+        if n_edits < self.batch_min_edits:
+            return [self.apply(tokens) for tokens in batch]
+        return apply_char_ops_batch([self], batch)
+
+
+def apply_char_ops(ops: List[CharOp], tokens: List[str]) -> List[str]:
+    tk_len = len(tokens)
+    if tk_len == 0:
+        return tokens
+    for op in ops:
+        edit = op.edit
+        n_draws = op.n_draws
+        k = op.aug_len(tokens)
+        draws = op.uniform(k * (1 + n_draws))
+        # the first k draws pick the words, the others are given to `edit`
+        if n_draws == 1:
+            for u, v in zip(draws[:k], draws[k:]):
+                pos = int(u * tk_len)
+                tokens[pos] = edit(tokens[pos], v)
+        else:
+            for i, u in enumerate(draws[:k]):
+                pos = int(u * tk_len)
+                start = k + i * n_draws
+                tokens[pos] = edit(tokens[pos], *draws[start:start + n_draws])
+    return tokens
+
+
+def apply_char_ops_batch(ops: List[CharOp],
+                         batch: List[List[str]]) -> List[List[str]]:
+    """
+        `apply_char_ops` on every sentence of `batch`, in place. The words
+        to edit are gathered from the whole batch into a single code-point
+        matrix. Draws are taken in the same order, so the results are the
+        same as sentence by sentence.
+    """
+    tk_lens = np.array([len(tokens) for tokens in batch], dtype=np.int64)
+    offsets = np.cumsum(tk_lens) - tk_lens
+    plans = []
+    for op in ops:
+        n_draws = op.n_draws
+        k = op.aug_lens(tk_lens)
+        sizes = k * (1 + n_draws)
+        draws = np.array(op.uniform(int(sizes.sum())))
+        # the draws of a sentence are its k positions then k * n_draws
+        # draws given to the edits
+        sent = np.repeat(np.arange(len(batch)), k)
+        rank = np.arange(len(sent)) - (np.cumsum(k) - k)[sent]
+        block = (np.cumsum(sizes) - sizes)[sent]
+        words = offsets[sent] + (draws[block + rank] *
+                                 tk_lens[sent]).astype(np.int64)
+        edit_draws = draws[(block + k[sent] + rank * n_draws)[:, None] +
+                           np.arange(n_draws)[None, :]]
+        plans.append((op, words, edit_draws))
+    if not plans or sum(len(words) for _, words, _ in plans) == 0:
+        return batch
+
+    # only the edited words are converted to code points
+    edited, inverse = np.unique(np.concatenate(
+        [words for _, words, _ in plans]),
+                                return_inverse=True)
+    sents = np.searchsorted(offsets, edited, side="right") - 1
+    poss = edited - offsets[sents]
+    sents, poss = sents.tolist(), poss.tolist()
+    cps, lengths = encode_words(
+        [batch[s][p] for s, p in zip(sents, poss)])
+    start = 0
+    for op, words, edit_draws in plans:
+        rows = inverse[start:start + len(words)]
+        start += len(words)
+        # edits of the same word are applied in draw order, one round for
+        # the i-th edits of all the words
+        order = np.argsort(rows, kind="stable")
+        sorted_rows = rows[order]
+        firsts = np.flatnonzero(
+            np.concatenate([[True], sorted_rows[1:] != sorted_rows[:-1]]))
+        occ = np.empty(len(rows), dtype=np.int64)
+        occ[order] = np.arange(len(rows)) - np.repeat(
+            firsts, np.diff(np.append(firsts, len(rows))))
+        for i in range(int(occ.max(initial=-1)) + 1):
+            sel = occ == i
+            r = rows[sel]
+            sub, sub_lengths = op.edit_batch(cps[r], lengths[r],
+                                             edit_draws[sel])
+            if sub.shape[1] > cps.shape[1]:
+                cps = np.pad(cps, ((0, 0), (0, sub.shape[1] - cps.shape[1])))
+            cps[r, :sub.shape[1]] = sub
+            cps[r, sub.shape[1]:] = 0
+            lengths[r] = sub_lengths
+    for s, p, word in zip(sents, poss, decode_words(cps, lengths)):
+        batch[s][p] = word
+    return batch
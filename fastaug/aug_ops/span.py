@@ -1,28 +1,123 @@
-import random
 from typing import List
-import copy
+from itertools import chain
+import math
 import numpy as np
-from .defs import AugOp
+from .defs import AugOp, Seed
 
 
 class SpanRandomMask(AugOp):
-    def __init__(self, aug_p: float, mask: str = '_'):
-        super().__init__(aug_p)
+    """
+        Replace random spans of tokens by a single `mask` each, masking
+        `aug_len` tokens at most. Span lengths follow a geometric
+        distribution of parameter `p`, capped at `max_span_len`; spans
+        which overlap are merged.
+
+        Short sentences are masked in pure Python, long ones and batches
+        with numpy. Both take the draws of every sentence in the same
+        order, so a batch gives the results of its sentences one by one.
+    """
+    # sentences longer than this are masked with numpy
+    vectorize_len = 256
+
+    def __init__(self,
+                 aug_p: float,
+                 mask: str = '_',
+                 seed: Seed = None,
+                 p: float = 0.3,
+                 max_span_len: int = 8):
+        super().__init__(aug_p, seed)
+        if not 0 < p <= 1:
+            raise ValueError(f"p must be in (0, 1], got {p}")
+        if max_span_len < 1:
+            raise ValueError(
+                f"max_span_len must be positive, got {max_span_len}")
         self.mask = mask
+        self.p = p
+        self.max_span_len = max_span_len
+
+    def span_len(self, v: float) -> int:
+        if self.p >= 1:
+            return 1
+        # inverse CDF of the geometric distribution
+        length = math.floor(math.log1p(-v) / math.log1p(-self.p)) + 1
+        return min(length, self.max_span_len)
 
-    def __call__(self, tokens: List[str]) -> List[str]:
-        ret = copy.copy(tokens)
-        max_mask_len = self.aug_len(tokens)
-        total_mask_len = 0
-        while total_mask_len < max_mask_len:
-            length = len(ret)
-            start_idx = random.choice(range(length))
-            cur_mask_len = min(
-                np.random.geometric(p=0.3, size=1)[0],  # 
-                length - start_idx - 1,
-                max_mask_len - total_mask_len,
-                8)
-            total_mask_len += cur_mask_len
-            ret = ret[:start_idx] + [self.mask] + ret[start_idx + cur_mask_len:]
+    def apply(self, tokens: List[str]) -> List[str]:
+        tk_len = len(tokens)
+        if tk_len == 0:
+            return tokens
+        if tk_len > self.vectorize_len:
+            return self.apply_batch([tokens])[0]
+        budget = self.aug_len(tokens)
+        draws = self.uniform(2 * budget)
+        covered = [False] * tk_len
+        for u, v in zip(draws[:budget], draws[budget:]):
+            if budget == 0:
+                break
+            start = int(u * tk_len)
+            length = min(self.span_len(v), tk_len - start, budget)
+            budget -= length
+            covered[start:start + length] = [True] * length
+        ret = []
+        prev = False
+        for token, cov in zip(tokens, covered):
+            if not cov:
+                ret.append(token)
+            elif not prev:
+                ret.append(self.mask)
+            prev = cov
         return ret
 
+    def apply_batch(self, batch: List[List[str]]) -> List[List[str]]:
+        lens = np.array([len(tokens) for tokens in batch], dtype=np.int64)
+        budgets = self.aug_lens(lens)
+        # every span masks a token at least, so there are at most
+        # `budget` spans per sentence, all drawn at once
+        n_spans = int(budgets.sum())
+        if n_spans == 0:
+            return batch
+        owner = np.repeat(np.arange(len(batch)), budgets)
+        draws = np.array(self.uniform(2 * n_spans))
+        # the draws of a sentence are its `budget` starts then its
+        # `budget` lengths, as in `apply`
+        first = np.cumsum(budgets) - budgets
+        rank = np.arange(n_spans) - first[owner]
+        block = 2 * first[owner]
+        u = draws[block + rank]
+        v = draws[block + budgets[owner] + rank]
+        starts = (u * lens[owner]).astype(np.int64)
+        if self.p < 1:
+            lengths = np.floor(np.log1p(-v) / np.log1p(-self.p)) + 1
+            lengths = np.minimum(lengths, self.max_span_len).astype(np.int64)
+        else:
+            lengths = np.ones(n_spans, dtype=np.int64)
+        lengths = np.minimum(lengths, lens[owner] - starts)
+        # spans beyond the budget of their sentence are shortened or dropped
+        used = np.cumsum(lengths) - lengths
+        used -= np.repeat(used[first[budgets > 0]], budgets[budgets > 0])
+        lengths = np.clip(budgets[owner] - used, 0, lengths)
+
+        # coverage of the flattened batch, by a difference array
+        offsets = np.cumsum(lens) - lens
+        starts += offsets[owner]
+        delta = np.zeros(int(lens.sum()) + 1, dtype=np.int64)
+        np.add.at(delta, starts, 1)
+        np.add.at(delta, starts + lengths, -1)
+        covered = np.cumsum(delta[:-1]) > 0
+        run_start = covered.copy()
+        run_start[1:] &= ~covered[:-1]
+        run_start[offsets[lens > 0]] = covered[offsets[lens > 0]]
+        keep = np.flatnonzero(~covered | run_start)
+        bounds = np.searchsorted(keep, np.append(offsets, len(covered)))
+
+        flat = list(chain.from_iterable(batch))
+        covered = covered.tolist()
+        keep = keep.tolist()
+        mask = self.mask
+        ret = []
+        for i in range(len(batch)):
+            ret.append([
+                mask if covered[j] else flat[j]
+                for j in keep[bounds[i]:bounds[i + 1]]
+            ])
+        return ret
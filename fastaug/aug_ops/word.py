@@ -1,11 +1,17 @@
-import random
-from typing import List, Dict
-import copy
-from .defs import AugOp
-from functools import lru_cache
-from nltk.corpus import wordnet as wn
-from ..util import load_resource, randint
-import json
+from typing import (Callable, List, Dict, Mapping, Optional, Sequence, Tuple,
+                    Union)
+import numpy as np
+from .defs import AugOp, Seed
+from ..alias import AliasTable, alias_table, pick, pick_batch
+from ..cache import DEFAULT_CACHE_SIZE, shared_cache
+from ..embedding import EmbeddingNeighbours, EmbeddingStore
+from ..lexicon import Lexicon, load_resource_lexicon
+from ..vocab import PAD, CandidateTable, Vocab
+from ..wordnet import load_wordnet_lexicon
+
+# weights of candidates, by word or as a function of the word and candidates
+Weights = Union[Mapping[str, Sequence[float]], Callable[[str, List[str]],
+                                                       Sequence[float]]]
 
 # extracted from nltk
 STOPWORDS = {
@@ -27,42 +33,90 @@ STOPWORDS = {
 
 
 class WordRandomMask(AugOp):
-    def __init__(self, aug_p: float, mask: str = '_'):
-        super().__init__(aug_p)
+    def __init__(self, aug_p: float, mask: str = '_', seed: Seed = None):
+        super().__init__(aug_p, seed)
         self.mask = mask
 
-    def __call__(self, tokens: List[str]) -> List[str]:
-        ret = copy.copy(tokens)
+    def apply(self, tokens: List[str]) -> List[str]:
         tk_len = len(tokens)
-        for _ in range(self.aug_len(tokens)):
-            pos = randint(0, tk_len)
-            ret[pos] = self.mask
-        return ret
+        if tk_len == 0:
+            return tokens
+        for u in self.uniform(self.aug_len(tokens)):
+            tokens[int(u * tk_len)] = self.mask
+        return tokens
+
+    def apply_ids(self, ids: np.ndarray, lengths: np.ndarray,
+                  vocab: Vocab) -> Tuple[np.ndarray, np.ndarray]:
+        rows, _, draws = _draw_rounds(self, self.aug_lens(lengths))
+        ids[rows, (draws * lengths[rows]).astype(np.int64)] = vocab.add(
+            self.mask)
+        return ids, lengths
 
 
 class WordRandomSwap(AugOp):
-    def __call__(self, tokens: List[str]) -> List[str]:
-        ret = copy.copy(tokens)
+    def apply(self, tokens: List[str]) -> List[str]:
         tk_len = len(tokens)
         if tk_len > 2:
-            for _ in range(self.aug_len(tokens)):
-                pos = randint(0, tk_len - 1)
-                ret[pos], ret[pos + 1] = ret[pos + 1], ret[pos]
-        return ret
+            for u in self.uniform(self.aug_len(tokens)):
+                pos = int(u * (tk_len - 1))
+                tokens[pos], tokens[pos + 1] = tokens[pos + 1], tokens[pos]
+        return tokens
+
+    def apply_ids(self, ids: np.ndarray, lengths: np.ndarray,
+                  vocab: Vocab) -> Tuple[np.ndarray, np.ndarray]:
+        counts = np.where(lengths > 2, self.aug_lens(lengths), 0)
+        rows, rounds, draws = _draw_rounds(self, counts)
+        pos = (draws * (lengths[rows] - 1)).astype(np.int64)
+        # swaps may overlap, the i-th swaps of all the rows are done at once
+        for i in range(int(counts.max(initial=0))):
+            sel = rounds == i
+            r, p = rows[sel], pos[sel]
+            ids[r, p], ids[r, p + 1] = ids[r, p + 1], ids[r, p]
+        return ids, lengths
 
 
 class WordRandomDelete(AugOp):
-    def __call__(self, tokens: List[str]) -> List[str]:
-        ret = copy.copy(tokens)
-        for _ in range(self.aug_len(tokens)):
-            pos = randint(0, len(ret))
-            del ret[pos]
-        return ret
+    def apply(self, tokens: List[str]) -> List[str]:
+        if not tokens:
+            return tokens
+        for u in self.uniform(self.aug_len(tokens)):
+            del tokens[int(u * len(tokens))]
+        return tokens
+
+    def apply_ids(self, ids: np.ndarray, lengths: np.ndarray,
+                  vocab: Vocab) -> Tuple[np.ndarray, np.ndarray]:
+        counts = self.aug_lens(lengths)
+        rows, rounds, draws = _draw_rounds(self, counts)
+        cols = np.arange(ids.shape[1])
+        for i in range(int(counts.max(initial=0))):
+            sel = rounds == i
+            r = rows[sel]
+            cur = lengths[r]
+            r, u, cur = r[cur > 0], draws[sel][cur > 0], cur[cur > 0]
+            pos = (u * cur).astype(np.int64)
+            # shift the tokens after `pos` one step left
+            src = cols[None, :] + (cols[None, :] >= pos[:, None])
+            shifted = np.take_along_axis(ids[r],
+                                         np.minimum(src, len(cols) - 1),
+                                         axis=1)
+            shifted[np.arange(len(r)), cur - 1] = PAD
+            ids[r] = shifted
+            lengths[r] -= 1
+        return ids, lengths
 
 
 class WordSub(AugOp):
-    def __init__(self, aug_p: float):
-        super().__init__(aug_p)
+    """
+        Substitutes words by one of their candidates, uniformly, or in
+        proportion to their weights for the words whose `get_alias`
+        returns an alias table (see `fastaug.alias`). Ops with weights set
+        `weighted`.
+    """
+    weighted = False
+
+    def __init__(self, aug_p: float, seed: Seed = None):
+        super().__init__(aug_p, seed)
+        self._id_table = None
 
     def has_cands(self, word: str) -> bool:
         raise NotImplementedError
@@ -70,115 +124,213 @@ class WordSub(AugOp):
     def get_cands(self, word: str) -> List[str]:
         raise NotImplementedError
 
-    def __call__(self, tokens: List[str]) -> List[str]:
-        ret = copy.copy(tokens)
-        all_idxs = list(range(len(tokens)))
-        random.shuffle(all_idxs)
+    def get_alias(self, word: str) -> Optional[AliasTable]:
+        return None
+
+    def apply(self, tokens: List[str]) -> List[str]:
+        if not tokens:
+            return tokens
+        all_idxs = self.rng.permutation(len(tokens)).tolist()
+        aug_len = self.aug_len(tokens)
         can_sub_idxs = []
         for idx in all_idxs:
             if self.has_cands(tokens[idx]):
                 #  and tokens[idx] not in STOPWORDS:
                 can_sub_idxs.append(idx)
-            if len(can_sub_idxs) > self.aug_len(tokens):
+            if len(can_sub_idxs) > aug_len:
                 break
-        for idx in can_sub_idxs:
-            ret[idx] = random.choice(self.get_cands(tokens[idx]))
-        return ret
-
-
-class WordNetSub(WordSub):
-    @lru_cache(maxsize=None)
-    def has_cands(self, word):
-        return len(self.get_cands(word)) != 0
-
-    @lru_cache(maxsize=None)
-    def get_cands(self, word, only_unigram=True):
-        synonyms = []
-        for syn in wn.synsets(word):
-            for synonym in syn.lemma_names():
-                if "_" in synonym and only_unigram:
-                    continue
-                else:
-                    synonym = synonym.replace("_", " ")
-                if synonym in synonyms:
+        weighted = self.weighted
+        for idx, u in zip(can_sub_idxs, self.uniform(len(can_sub_idxs))):
+            cands = self.get_cands(tokens[idx])
+            if weighted:
+                table = self.get_alias(tokens[idx])
+                if table is not None:
+                    if len(table[0]) != len(cands):
+                        raise ValueError(
+                            f"{tokens[idx]!r} has {len(cands)} candidates "
+                            f"but {len(table[0])} weights")
+                    tokens[idx] = cands[pick(table, u)]
                     continue
-                synonyms.append(synonym)
-        return synonyms
+            tokens[idx] = cands[int(u * len(cands))]
+        return tokens
+
+    def id_table(self, vocab: Vocab) -> CandidateTable:
+        """
+            The candidates of the words of `vocab` as a CSR table of ids.
+        """
+        table = self._id_table
+        if table is None or table.vocab is not vocab:
+            table = self._id_table = CandidateTable(
+                vocab, self._table_cands,
+                self.get_alias if self.weighted else None)
+        return table
+
+    def _table_cands(self, word: str) -> List[str]:
+        return self.get_cands(word) if self.has_cands(word) else []
+
+    def apply_ids(self, ids: np.ndarray, lengths: np.ndarray,
+                  vocab: Vocab) -> Tuple[np.ndarray, np.ndarray]:
+        n_rows, width = ids.shape
+        if ids.size == 0:
+            return ids, lengths
+        table = self.id_table(vocab)
+        table.ensure(int(ids.max()) + 1)
+        valid = np.arange(width)[None, :] < lengths[:, None]
+        counts = np.where(valid, table.counts[np.where(valid, ids, 0)], 0)
+        draws = np.array(self.uniform(2 * ids.size)).reshape(2, n_rows, width)
+        # a random order of the substitutable positions of each row, like
+        # the permutation of `apply`, which also picks `aug_len + 1`
+        keys = np.where(counts > 0, draws[0], 2.0)
+        rank = np.empty_like(ids, dtype=np.int64)
+        np.put_along_axis(rank, np.argsort(keys, axis=1),
+                          np.arange(width)[None, :].repeat(n_rows, 0), 1)
+        chosen = (counts > 0) & (rank <= self.aug_lens(lengths)[:, None])
+        r, c = np.nonzero(chosen)
+        starts = table.offsets[ids[r, c]]
+        if table.prob is None:
+            picks = (draws[1][r, c] * counts[r, c]).astype(np.int64)
+        else:
+            picks = pick_batch(draws[1][r, c], counts[r, c], starts,
+                               table.prob, table.alias)
+        ids[r, c] = table.cand_ids[starts + picks]
+        return ids, lengths
 
 
-class WordMorphSub(WordSub):
-    def __init__(self, aug_p: float) -> None:
-        super().__init__(aug_p)
-        self.morphs = json.load(open(load_resource("morphs.json"), "r"))
+class WordDictSub(WordSub):
+    """
+        `cands` is a dict of candidates, a compiled `Lexicon` or the path
+        of a compiled lexicon file. Lookups go through a cache shared by
+        all ops using the same lexicon and cache settings, see
+        `fastaug.cache`.
+
+        Candidates are sampled uniformly, unless `weights` gives their
+        weights (e.g. similarities or corpus frequencies): a dict from
+        words to lists of weights aligned with their candidates, compiled
+        into alias tables here, or a function `weights(word, cands)`
+        whose tables are compiled on first use of every word. Weighted
+        lexicons (see `fastaug.lexicon`) are used as such by default.
+    """
+    def __init__(self,
+                 aug_p: float,
+                 cands: Union[Dict[str, List[str]], Lexicon, str],
+                 seed: Seed = None,
+                 cache_size: Optional[int] = DEFAULT_CACHE_SIZE,
+                 cache_policy: str = "lru",
+                 weights: Optional[Weights] = None) -> None:
+        super().__init__(aug_p, seed)
+        if isinstance(cands, str):
+            cands = Lexicon.load(cands)
+        self.cands = cands
+        self.cache = shared_cache(cands, cache_size, cache_policy)
+        self.weights = weights
+        self._alias = None
+        if weights is None:
+            if isinstance(cands, Lexicon) and cands.weighted:
+                self._alias = cands.alias
+        elif callable(weights):
+            self._alias_memo = {}
+            self._alias = self._weigh
+        else:
+            tables = {word: alias_table(w) for word, w in weights.items()}
+            self._alias = tables.get
+        self.weighted = self._alias is not None
+
+    def _weigh(self, word: str) -> Optional[AliasTable]:
+        table = self._alias_memo.get(word)
+        if table is None:
+            cands = self.get_cands(word)
+            if not cands:
+                return None
+            table = alias_table(self.weights(word, cands))
+            self._alias_memo[word] = table
+        return table
+
+    def get_alias(self, word):
+        return self._alias(word)
 
-    @lru_cache(maxsize=None)
     def has_cands(self, word):
-        return word in self.morphs
+        return bool(self.cache.lookup(word))
 
-    @lru_cache(maxsize=None)
     def get_cands(self, word):
-        return self.morphs[word]
-
-
-# class WordEmbedSub(WordSub):
-#     def __init__(self, aug_p: float) -> None:
-#         super().__init__(aug_p)
-#         embed_path = DownloadUtil.download_counter_fitting_if_not_exists()
-#         df = pandas.read_csv(embed_path, sep=" ", header=None)
-#         words = list(map(str, df.values[:, 0]))
-#         vecs = torch.tensor(df.values[:, 1:].astype(np.float32))
-#         self._word2idx = {words[i]: i for i in range(len(words))}
-#         self._idx2word = {i: words[i] for i in range(len(words))}
-#         self.embed_util = EmbeddingNbrUtil(
-#             vecs,
-#             word2idx=self._word2idx,
-#             idx2word=self._idx2word,
-#         )
-
-#     @lru_cache(maxsize=None)
-#     def has_cands(self, word):
-#         return word in self._word2idx
-
-#     @lru_cache(maxsize=None)
-#     def get_cands(self, word):
-#         return self.embed_util.find_neighbours(
-#             word,
-#             measure='cos',  #
-#             topk=10,  #
-#             return_words=True  #
-#         )
-
-# class WordEmbedSub(WordSub):
-#     def __init__(self, aug_p: float) -> None:
-#         super().__init__(aug_p)
-#         self.cands = json.load(
-#             open(load_resource("embed_top_16_dist_dot25.json"), "r"))
-
-#     @lru_cache(maxsize=None)
-#     def has_cands(self, word):
-#         return word in self.cands
-
-#     @lru_cache(maxsize=None)
-#     def get_cands(self, word):
-#         return self.cands[word]
+        return self.cache.lookup(word) or []
+
+
+class WordNetSub(WordDictSub):
+    """
+        Synonyms are looked up in a table exported offline from WordNet
+        (see `fastaug.wordnet`), `lexicon` defaults to the export of
+        `python -m fastaug.wordnet`, which must have been run.
+    """
+    def __init__(self,
+                 aug_p: float,
+                 seed: Seed = None,
+                 lexicon: Union[Lexicon, str, None] = None,
+                 cache_size: Optional[int] = DEFAULT_CACHE_SIZE,
+                 cache_policy: str = "lru",
+                 weights: Optional[Weights] = None) -> None:
+        if lexicon is None:
+            lexicon = load_wordnet_lexicon()
+        super().__init__(aug_p, lexicon, seed, cache_size, cache_policy,
+                         weights)
+
+    # like wn.synsets, lookups are case-insensitive
+    def has_cands(self, word):
+        return super().has_cands(word.lower())
 
+    def get_cands(self, word):
+        return super().get_cands(word.lower())
 
-class WordDictSub(WordSub):
-    def __init__(self, aug_p: float, cands: Dict[str, List[str]]) -> None:
-        super().__init__(aug_p)
-        self.cands = cands
+    def get_alias(self, word):
+        return super().get_alias(word.lower())
 
-    @lru_cache(maxsize=None)
-    def has_cands(self, word):
-        return word in self.cands
 
-    @lru_cache(maxsize=None)
-    def get_cands(self, word):
-        return self.cands[word]
+class WordMorphSub(WordDictSub):
+    def __init__(self,
+                 aug_p: float,
+                 seed: Seed = None,
+                 cache_size: Optional[int] = DEFAULT_CACHE_SIZE,
+                 cache_policy: str = "lru",
+                 weights: Optional[Weights] = None) -> None:
+        super().__init__(aug_p, load_resource_lexicon("morphs.json"), seed,
+                         cache_size, cache_policy, weights)
 
 
 class WordEmbedSub(WordDictSub):
-    def __init__(self, aug_p: float) -> None:
-        super().__init__(aug_p, cands=None)
-        self.cands = json.load(
-            open(load_resource("embed_top_16_dist_dot25.json"), "r"))
+    """
+        By default, candidates are the precomputed neighbours of
+        embed_top_16_dist_dot25.json. Given an `EmbeddingStore` (see
+        `fastaug.embedding`), neighbours are instead searched on the fly
+        with the `topk`/`dist` thresholds, and `weights="similarity"`
+        samples them in proportion to their cosine similarity.
+    """
+    def __init__(self,
+                 aug_p: float,
+                 seed: Seed = None,
+                 cache_size: Optional[int] = DEFAULT_CACHE_SIZE,
+                 cache_policy: str = "lru",
+                 embed: Optional[EmbeddingStore] = None,
+                 topk: int = 16,
+                 dist: float = 0.25,
+                 measure: str = "cos",
+                 weights: Union[Weights, str, None] = None) -> None:
+        if embed is None:
+            cands = load_resource_lexicon("embed_top_16_dist_dot25.json")
+        else:
+            cands = EmbeddingNeighbours(embed, topk, dist, measure)
+        if weights == "similarity":
+            if embed is None:
+                raise ValueError('weights="similarity" requires embed')
+            weights = cands.similarities
+        super().__init__(aug_p, cands, seed, cache_size, cache_policy,
+                         weights)
+
+
+def _draw_rounds(op: AugOp, counts: np.ndarray):
+    """
+        Draw `counts[i]` uniforms for row `i` in one bulk draw, in the
+        order `apply` draws them. Return the row and the rank within its
+        row of every draw, and the draws.
+    """
+    rows = np.repeat(np.arange(len(counts)), counts)
+    rounds = np.arange(len(rows)) - (np.cumsum(counts) - counts)[rows]
+    return rows, rounds, np.array(op.uniform(len(rows)))
@@ -1,23 +1,453 @@
-from typing import List, Union
-from .tokenizer import tokenize, detokenize
-from .aug_ops.defs import AugOp
-import random
+from typing import Any, Iterable, Iterator, List, Optional, Tuple, Union
+from collections import deque
+from itertools import islice
+import multiprocessing as mp
+import copy
+import os
+import time
+import numpy as np
+from .tokenizer import MODES, detokenize, tokenize_with_spacing
+from .aug_ops.defs import AugOp, CharOp, Seed, Seedable, apply_char_ops
+from .metrics import Instrumentation, count_edits, count_edits_ids
+from .vocab import PAD, Vocab, pad
 
+# augment_ids starts a new vocab (and candidate tables) past this size, as
+# typos and other generated words are interned too
+MAX_VOCAB = 1 << 18
 
-class Augmentor:
-    def __init__(self, aug_ops: List[AugOp], pipeline_p: float = 1.0):
+
+class Augmentor(Seedable):
+    def __init__(self,
+                 aug_ops: List[AugOp],
+                 pipeline_p: float = 1.0,
+                 seed: Seed = None,
+                 tokenizer: str = "space"):
+        """
+            Sentences are split on whitespace (`tokenizer="space"`), or
+            also on punctuation and CJK characters ("better"). Augmented
+            sentences keep the original spacing of the tokens.
+        """
+        if tokenizer not in MODES:
+            raise ValueError(
+                f"tokenizer must be one of {MODES}, got {tokenizer}")
+        self.metrics: Optional[Instrumentation] = None
         self.aug_ops = aug_ops
         self.pipeline_p = pipeline_p
+        self.tokenizer = tokenizer
+        self.vocab = Vocab()
+        if seed is None:
+            # keep the streams of the given ops untouched
+            super().seed()
+        else:
+            self.seed(seed)
+
+    @property
+    def aug_ops(self) -> List[AugOp]:
+        return self._aug_ops
+
+    @aug_ops.setter
+    def aug_ops(self, aug_ops: List[AugOp]):
+        self._aug_ops = aug_ops
+        self._plan = _compile(aug_ops)
+        if self.metrics is not None:
+            self.metrics.bind(aug_ops)
+
+    def instrument(self, sample_rate: float = 1.0) -> Instrumentation:
+        """
+            Start collecting per-op metrics, see `fastaug.metrics`. Only
+            one augment call in `1 / sample_rate` is timed, e.g. 0.01 is
+            cheap enough to stay on in production. Metrics of pool workers
+            are merged into those of this augmentor. Set `self.metrics` to
+            None to stop.
+        """
+        self.metrics = Instrumentation(sample_rate)
+        self.metrics.bind(self.aug_ops)
+        return self.metrics
+
+    def seed(self, seed: Seed = None) -> "Augmentor":
+        """
+            Reset the random streams of the augmentor and of all its ops,
+            which get independent children of `seed`.
+        """
+        super().seed(seed)
+        for op, child in zip(self.aug_ops,
+                             self.seed_seq.spawn(len(self.aug_ops))):
+            op.seed(child)
+        return self
+
+    def spawn(self, n: int) -> List["Augmentor"]:
+        """
+            Return `n` copies of the augmentor with independent streams,
+            e.g. one per thread. Resources of the ops are shared.
+        """
+        return [self._clone().seed(child) for child in self.seed_seq.spawn(n)]
+
+    def _clone(self) -> "Augmentor":
+        aug = copy.copy(self)
+        aug.aug_ops = [copy.copy(op) for op in self.aug_ops]
+        # the vocab and the candidate tables keyed by it grow as clones
+        # augment, they are not shared between them
+        aug.vocab = Vocab()
+        return aug
 
     def augment(self, sent: str, n: int = 1) -> Union[str, List[str]]:
-        ret = []
-        for _ in range(n):
-            tokens = tokenize(sent)
-            for op in self.aug_ops:
-                if random.random() < self.pipeline_p:
-                    tokens = op(tokens)
-            ret.append(detokenize(tokens))
+        tokens, gaps = tokenize_with_spacing(sent, self.tokenizer)
+        ret = [
+            detokenize(buf, tokens, gaps)
+            for buf in self._variants(tokens, n)
+        ]
         if n == 1:
             return ret[0]
         else:
             return ret
+
+    def augment_unique(self,
+                       sent: str,
+                       n: int = 1,
+                       max_tries: Optional[int] = None) -> List[str]:
+        """
+            Up to `n` distinct variants of `sent`, all different from it.
+            Variants are generated in rounds until `n` are found or
+            `max_tries` (`4 * n` by default) were generated, and compared
+            as token tuples before being detokenized. The result is
+            shorter than `n` when fewer variants could be found, e.g. when
+            few tokens have candidates.
+        """
+        if max_tries is None:
+            max_tries = 4 * n
+        tokens, gaps = tokenize_with_spacing(sent, self.tokenizer)
+        if not tokens:
+            return []
+        seen = {tuple(tokens)}
+        ret = []
+        tries = 0
+        while len(ret) < n and tries < max_tries:
+            k = min(n - len(ret), max_tries - tries)
+            for buf in self._variants(tokens, k):
+                key = tuple(buf)
+                if key not in seen:
+                    seen.add(key)
+                    ret.append(detokenize(buf, tokens, gaps))
+            tries += k
+        return ret
+
+    def _variants(self, tokens: List[str], n: int) -> Iterator[List[str]]:
+        """
+            Yield `n` augmented copies of `tokens`.
+        """
+        if self.pipeline_p >= 1.0:
+            keep = None
+        else:
+            # decide which ops run for all the variants in a single draw
+            n_ops = len(self.aug_ops)
+            draws = self.uniform(n * n_ops)
+            keep = [[u < self.pipeline_p for u in draws[i:i + n_ops]]
+                    for i in range(0, n * n_ops, n_ops)]
+        metrics = self.metrics
+        if metrics is not None and metrics.sample():
+            for i in range(n):
+                yield self._apply_measured(list(tokens),
+                                           None if keep is None else keep[i])
+            return
+        for i in range(n):
+            if metrics is not None:
+                metrics.count(None if keep is None else keep[i])
+            # every op edits this buffer in place
+            buf = list(tokens)
+            for kind, start, ops in self._plan:
+                if keep is not None:
+                    ops = [op for j, op in enumerate(ops, start) if keep[i][j]]
+                    if not ops:
+                        continue
+                if kind == "char":
+                    buf = apply_char_ops(ops, buf)
+                elif kind == "apply":
+                    buf = ops[0].apply(buf)
+                else:
+                    buf = ops[0](buf)
+            yield buf
+
+    def _apply_measured(self, buf: List[str],
+                        keep: Optional[List[bool]]) -> List[str]:
+        """
+            Apply the ops one by one, as `augment` would, recording their
+            time and edits.
+        """
+        metrics = self.metrics
+        metrics.count(keep)
+        for j, op in enumerate(self.aug_ops):
+            if keep is not None and not keep[j]:
+                continue
+            before = list(buf)
+            start = time.perf_counter()
+            if isinstance(op, CharOp) and type(op).apply is CharOp.apply:
+                buf = apply_char_ops([op], buf)
+            elif type(op).apply is not AugOp.apply:
+                buf = op.apply(buf)
+            else:
+                buf = op(buf)
+            seconds = time.perf_counter() - start
+            metrics.record(j, seconds, op.aug_len(before),
+                           count_edits(before, buf))
+        return buf
+
+    def augment_ids(self, sents: List[str],
+                    n: int = 1) -> List[Union[str, List[str]]]:
+        """
+            Augment a batch of sentences as padded arrays of token ids, see
+            `fastaug.vocab`: tokens are interned into `self.vocab`, ops run
+            `apply_ids` on the whole batch and strings are only rebuilt at
+            the end. Results are distributed like those of `augment` but
+            come from other draws. The vocab is started anew once it holds
+            more than `MAX_VOCAB` words.
+        """
+        if len(self.vocab) > MAX_VOCAB:
+            self.vocab = Vocab()
+        vocab = self.vocab
+        split = [tokenize_with_spacing(sent, self.tokenizer) for sent in sents]
+        ids, lengths = pad(
+            [vocab.encode(tokens) for tokens, _ in split for _ in range(n)])
+        n_ops = len(self.aug_ops)
+        keep = None
+        if self.pipeline_p < 1.0:
+            keep = np.array(self.uniform(len(ids) * n_ops)).reshape(
+                len(ids), n_ops) < self.pipeline_p
+        metrics = self.metrics
+        measured = metrics is not None and metrics.sample()
+        if metrics is not None:
+            kept = len(ids) if keep is None else keep.sum(axis=0).tolist()
+            for j, stats in enumerate(metrics.ops):
+                k = kept if keep is None else kept[j]
+                stats.calls += k
+                stats.pipeline_skips += len(ids) - k
+        for j, op in enumerate(self.aug_ops):
+            if keep is None:
+                if measured:
+                    before, before_lengths = ids.copy(), lengths.copy()
+                    start = time.perf_counter()
+                ids, lengths = op.apply_ids(ids, lengths, vocab)
+                if measured:
+                    self._record_ids(j, start, before, before_lengths, ids,
+                                     lengths)
+                continue
+            rows = np.flatnonzero(keep[:, j])
+            if len(rows) == 0:
+                continue
+            sub_ids, sub_lengths = ids[rows], lengths[rows]
+            if measured:
+                before, before_lengths = sub_ids.copy(), sub_lengths.copy()
+                start = time.perf_counter()
+            sub_ids, sub_lengths = op.apply_ids(sub_ids, sub_lengths, vocab)
+            if measured:
+                self._record_ids(j, start, before, before_lengths, sub_ids,
+                                 sub_lengths)
+            if sub_ids.shape[1] > ids.shape[1]:
+                extra = sub_ids.shape[1] - ids.shape[1]
+                ids = np.pad(ids, ((0, 0), (0, extra)), constant_values=PAD)
+            ids[rows, :sub_ids.shape[1]] = sub_ids
+            ids[rows, sub_ids.shape[1]:] = PAD
+            lengths[rows] = sub_lengths
+        ret = []
+        for i, (tokens, gaps) in enumerate(split):
+            variants = [
+                detokenize(vocab.decode(ids[k, :lengths[k]]), tokens, gaps)
+                for k in range(i * n, (i + 1) * n)
+            ]
+            ret.append(variants[0] if n == 1 else variants)
+        return ret
+
+    def _record_ids(self, j: int, start: float, before: np.ndarray,
+                    before_lengths: np.ndarray, after: np.ndarray,
+                    after_lengths: np.ndarray):
+        seconds = time.perf_counter() - start
+        attempted = self.aug_ops[j].aug_lens(before_lengths)
+        edits = count_edits_ids(before, before_lengths, after, after_lengths)
+        self.metrics.record(j, seconds, int(attempted.sum()),
+                            int(np.minimum(edits, attempted).sum()),
+                            k=len(before))
+
+    def augment_batch(
+        self,
+        sents: Iterable[str],
+        n: int = 1,
+        num_workers: Optional[int] = None,
+        chunk_size: int = 256,
+        id_mode: bool = False,
+        unique: bool = False,
+        max_tries: Optional[int] = None,
+    ) -> List[Union[str, List[str]]]:
+        """
+            Augment a list of sentences on a process pool, the i-th result
+            is what `augment(sents[i], n)` returns, or with `unique` what
+            `augment_unique(sents[i], n, max_tries)` returns.
+        """
+        return list(
+            self.augment_corpus(sents,
+                                n=n,
+                                num_workers=num_workers,
+                                chunk_size=chunk_size,
+                                id_mode=id_mode,
+                                unique=unique,
+                                max_tries=max_tries))
+
+    def augment_corpus(
+        self,
+        sents: Iterable[str],
+        n: int = 1,
+        num_workers: Optional[int] = None,
+        chunk_size: int = 256,
+        max_pending: Optional[int] = None,
+        id_mode: bool = False,
+        unique: bool = False,
+        max_tries: Optional[int] = None,
+    ) -> Iterator[Union[str, List[str]]]:
+        """
+            Lazily augment a (possibly unbounded) iterable of sentences.
+            The input is split into chunks of `chunk_size` sentences which
+            are dispatched to `num_workers` processes (all cores by default,
+            0 runs in the current process). At most `max_pending` chunks
+            are in flight, so memory stays bounded whatever the input size.
+            Results are yielded in input order. Every chunk is augmented
+            with its own child stream of `seed_seq`, so a seeded augmentor
+            gives the same results whatever the number of workers.
+            With `id_mode`, chunks are augmented by `augment_ids`, with
+            `unique` by `augment_unique`.
+        """
+        if id_mode and unique:
+            raise ValueError("unique is not supported in id_mode")
+        mode = (id_mode, unique, max_tries)
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        chunks = _chunked(sents, chunk_size)
+        if num_workers == 0:
+            # streams of the clone are reset for every chunk
+            worker = self._clone()
+            for chunk in chunks:
+                yield from _augment_chunk(worker, chunk, n,
+                                          self.seed_seq.spawn(1)[0], *mode)
+            return
+        if max_pending is None:
+            max_pending = 2 * num_workers
+        # fork shares the already loaded lexicons with the workers,
+        # other start methods pickle the augmentor once per worker
+        if "fork" in mp.get_all_start_methods():
+            ctx = mp.get_context("fork")
+        else:
+            ctx = mp.get_context()
+        with ctx.Pool(num_workers,
+                      initializer=_init_worker,
+                      initargs=(self, )) as pool:
+            pending = deque()
+            for chunk in chunks:
+                pending.append(
+                    pool.apply_async(
+                        _augment_worker_chunk,
+                        (chunk, n, self.seed_seq.spawn(1)[0], *mode)))
+                if len(pending) >= max_pending:
+                    yield from self._collect(pending.popleft().get())
+            while pending:
+                yield from self._collect(pending.popleft().get())
+
+    def augment_array(self,
+                      values: Any,
+                      n: int = 1,
+                      layout: str = "list",
+                      **kwargs) -> Any:
+        """
+            Augment an Arrow string array, a NumPy array or a pandas Series
+            in bulk, returning a columnar result, see
+            `fastaug.columnar.augment_array`.
+        """
+        from .columnar import augment_array
+        return augment_array(self, values, n, layout, **kwargs)
+
+    def augment_record_batches(self,
+                               batches: Iterable[Any],
+                               column: str,
+                               n: int = 1,
+                               layout: str = "list",
+                               **kwargs) -> Iterator[Any]:
+        """
+            Lazily augment the `column` of a stream of Arrow record
+            batches, see `fastaug.columnar.augment_record_batches`.
+        """
+        from .columnar import augment_record_batches
+        return augment_record_batches(self, batches, column, n, layout,
+                                      **kwargs)
+
+    def _collect(self, result: Tuple[list, Optional[dict]]) -> list:
+        results, counts = result
+        if counts is not None and self.metrics is not None:
+            self.metrics.merge(counts)
+        return results
+
+
+def _compile(aug_ops: List[AugOp]) -> List[Tuple[str, int, List[AugOp]]]:
+    """
+        Compile the ops into a list of (kind, index of the first op, ops)
+        stages. Consecutive char ops form one "char" stage applied in a
+        single pass, ops implementing `apply` run in place, other
+        (user-defined) ops are simply called.
+    """
+    plan = []
+    for i, op in enumerate(aug_ops):
+        if isinstance(op, CharOp) and type(op).apply is CharOp.apply:
+            if plan and plan[-1][0] == "char":
+                plan[-1][2].append(op)
+            else:
+                plan.append(("char", i, [op]))
+        elif type(op).apply is not AugOp.apply:
+            plan.append(("apply", i, [op]))
+        else:
+            plan.append(("call", i, [op]))
+    return plan
+
+
+def _chunked(iterable: Iterable, size: int) -> Iterator[list]:
+    it = iter(iterable)
+    while True:
+        chunk = list(islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def _augment_chunk(augmentor: Augmentor,
+                   sents: List[str],
+                   n: int,
+                   seed: np.random.SeedSequence,
+                   id_mode: bool = False,
+                   unique: bool = False,
+                   max_tries: Optional[int] = None):
+    augmentor.seed(seed)
+    if id_mode:
+        return augmentor.augment_ids(sents, n)
+    if unique:
+        return [
+            augmentor.augment_unique(sent, n, max_tries) for sent in sents
+        ]
+    return [augmentor.augment(sent, n) for sent in sents]
+
+
+# The augmentor owned by a pool worker, set once when the worker starts
+_worker_augmentor = None
+
+
+def _init_worker(augmentor: Augmentor):
+    global _worker_augmentor
+    _worker_augmentor = augmentor
+    # the counts inherited from the parent are already in its metrics
+    if augmentor.metrics is not None:
+        augmentor.metrics.reset()
+
+
+def _augment_worker_chunk(sents: List[str],
+                          n: int,
+                          seed: np.random.SeedSequence,
+                          id_mode: bool = False,
+                          unique: bool = False,
+                          max_tries: Optional[int] = None):
+    results = _augment_chunk(_worker_augmentor, sents, n, seed, id_mode,
+                             unique, max_tries)
+    metrics = _worker_augmentor.metrics
+    return results, None if metrics is None else metrics.pop_counts()
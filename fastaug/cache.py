@@ -0,0 +1,132 @@
+"""
+    Bounded caches for candidate lookups.
+
+    One cache is shared by all ops looking up the same lexicon with the
+    same settings, instead of a per-method `lru_cache` keyed by the op.
+    Caches only live as long as an op uses them.
+"""
+from typing import Any, Dict, Hashable, Optional
+from functools import lru_cache
+import weakref
+
+DEFAULT_CACHE_SIZE = 1 << 16
+POLICIES = ("lru", "fifo")
+
+_MISSING = object()
+
+
+class CandidateCache:
+    """
+        Caches `source.get(key)` for at most `maxsize` keys (None for
+        unbounded, 0 to disable caching), evicting the least recently used
+        ("lru") or the oldest ("fifo") key when full. Look keys up with
+        `cache.lookup(key)`.
+    """
+    def __init__(self,
+                 source: Any,
+                 name: str,
+                 maxsize: Optional[int] = DEFAULT_CACHE_SIZE,
+                 policy: str = "lru"):
+        if policy not in POLICIES:
+            raise ValueError(f"policy must be one of {POLICIES}, got {policy}")
+        self.source = source
+        self.name = name
+        self.maxsize = maxsize
+        self.policy = policy
+        if policy == "lru":
+            # the C implementation keeps hits as cheap as a dict lookup
+            self.lookup = lru_cache(maxsize)(source.get)
+        else:
+            self.lookup = self._fifo_lookup
+            self._data = {}
+            self._hits = 0
+            self._misses = 0
+
+    def _fifo_lookup(self, key: Hashable) -> Any:
+        data = self._data
+        value = data.get(key, _MISSING)
+        if value is not _MISSING:
+            self._hits += 1
+            return value
+        self._misses += 1
+        value = self.source.get(key)
+        if self.maxsize != 0:
+            data[key] = value
+            if self.maxsize is not None and len(data) > self.maxsize:
+                # dicts keep the insertion order
+                try:
+                    del data[next(iter(data))]
+                except (KeyError, RuntimeError, StopIteration):
+                    pass
+        return value
+
+    def __reduce__(self):
+        # unpickled caches join the shared cache of the new process
+        return shared_cache, (self.source, self.maxsize, self.policy)
+
+    def clear(self):
+        if self.policy == "lru":
+            self.lookup.cache_clear()
+        else:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        if self.policy == "lru":
+            return self.lookup.cache_info().currsize
+        return len(self._data)
+
+    def stats(self) -> Dict[str, Any]:
+        if self.policy == "lru":
+            info = self.lookup.cache_info()
+            hits, misses, size = info.hits, info.misses, info.currsize
+        else:
+            hits, misses, size = self._hits, self._misses, len(self._data)
+        lookups = hits + misses
+        return {
+            "name": self.name,
+            "policy": self.policy,
+            "maxsize": self.maxsize,
+            "size": size,
+            "hits": hits,
+            "misses": misses,
+            # every miss inserts a key unless caching is disabled
+            "evictions": misses - size if self.maxsize != 0 else 0,
+            "hit_rate": hits / lookups if lookups else 0.0,
+        }
+
+
+_caches = weakref.WeakValueDictionary()
+
+
+def shared_cache(source: Any,
+                 maxsize: Optional[int] = DEFAULT_CACHE_SIZE,
+                 policy: str = "lru") -> CandidateCache:
+    """
+        Return the cache of lookups into `source`, a compiled `Lexicon`
+        (shared by file) or any mapping (shared by identity).
+    """
+    path = getattr(source, "path", None)
+    if path is not None:
+        source_key = ("file", path)
+        name = path
+    else:
+        source_key = ("object", id(source))
+        name = f"{type(source).__name__}@{id(source):x}"
+    key = (source_key, maxsize, policy)
+    cache = _caches.get(key)
+    if cache is None:
+        # the cache keeps the source alive, so its id cannot be reused
+        cache = CandidateCache(source, name, maxsize, policy)
+        _caches[key] = cache
+    return cache
+
+
+def cache_stats() -> Dict[str, Dict[str, Any]]:
+    """
+        Statistics of all the live candidate caches.
+    """
+    ret = {}
+    for cache in list(_caches.values()):
+        stats = cache.stats()
+        ret[f"{stats['name']}:{stats['policy']}:{stats['maxsize']}"] = stats
+    return ret
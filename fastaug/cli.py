@@ -0,0 +1,341 @@
+"""
+    The `fastaug` command: augment a large file, or stdin, in a streaming
+    fashion.
+
+        fastaug corpus.jsonl -o out.jsonl --field text \\
+            --ops WordMorphSub:0.1,CharRandomSwap:0.1 -n 3 --workers 8
+
+    Input is plain text (one sentence per line), JSONL (the sentence is
+    the `--field` of every record) or TSV (the sentence is the `--column`
+    of every row); other fields are copied as they are and every input
+    record gives `n` output records, in input order. Lines are read
+    lazily and at most `--max-pending` chunks are in flight, so memory
+    stays bounded whatever the size of the input. Throughput is reported
+    on stderr.
+
+    The pipeline is given with `--ops NAME:AUG_P,...` or with `--spec`, a
+    JSON file such as
+
+        {"ops": [{"op": "WordRandomMask", "aug_p": 0.1, "mask": "[MASK]"},
+                 {"op": "CharTypoSub", "aug_p": 0.05}],
+         "pipeline_p": 0.8, "seed": 0}
+"""
+from typing import Any, Dict, Iterable, Iterator, List, Optional, TextIO
+from collections import deque
+import argparse
+import json
+import os
+import sys
+import time
+from .augmentor import Augmentor
+from .aug_ops.defs import AugOp
+from .tokenizer import MODES
+
+FORMATS = ("text", "jsonl", "tsv")
+
+
+def op_classes() -> Dict[str, type]:
+    """
+        The ops available by name in a pipeline spec.
+    """
+    from .aug_ops import char, span, word
+    ret = {}
+    for module in (word, char, span):
+        for name, obj in vars(module).items():
+            if isinstance(obj, type) and issubclass(obj, AugOp) \
+                    and obj.__module__ == module.__name__:
+                ret[name] = obj
+    # abstract
+    ret.pop("WordSub", None)
+    return ret
+
+
+def parse_ops(text: str) -> List[Dict[str, Any]]:
+    """
+        Parse "NAME:AUG_P,NAME:AUG_P,..." into op specs.
+    """
+    specs = []
+    for item in text.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        name, _, aug_p = item.partition(":")
+        if not aug_p:
+            raise ValueError(f"missing aug_p in {item!r}, expected NAME:AUG_P")
+        specs.append({"op": name.strip(), "aug_p": float(aug_p)})
+    return specs
+
+
+def build_augmentor(spec: Dict[str, Any]) -> Augmentor:
+    """
+        Build an augmentor from a spec: {"ops": [{"op": NAME, "aug_p": P,
+        ...keyword arguments of the op}], "pipeline_p": ..., "seed": ...,
+        "tokenizer": ...}.
+    """
+    classes = op_classes()
+    ops = []
+    for op_spec in spec["ops"]:
+        op_spec = dict(op_spec)
+        name = op_spec.pop("op")
+        if name not in classes:
+            raise ValueError(f"unknown op {name!r}, "
+                             f"available ops: {', '.join(sorted(classes))}")
+        ops.append(classes[name](**op_spec))
+    return Augmentor(ops,
+                     pipeline_p=spec.get("pipeline_p", 1.0),
+                     seed=spec.get("seed"),
+                     tokenizer=spec.get("tokenizer", "space"))
+
+
+def guess_format(path: str) -> str:
+    if path.endswith(".jsonl") or path.endswith(".json"):
+        return "jsonl"
+    if path.endswith(".tsv"):
+        return "tsv"
+    return "text"
+
+
+class Codec:
+    """
+        Extracts the sentence of an input line and writes the output lines
+        of its augmentations.
+    """
+    def __init__(self, fmt: str, field: str = "text", column: int = 0):
+        self.fmt = fmt
+        self.field = field
+        self.column = column
+
+    def decode(self, line: str) -> Any:
+        line = line.rstrip("\r\n")
+        if self.fmt == "jsonl":
+            return json.loads(line)
+        if self.fmt == "tsv":
+            return line.split("\t")
+        return line
+
+    def sentence(self, record: Any) -> Optional[str]:
+        """
+            The sentence of `record`, None when it has none.
+        """
+        if self.fmt == "jsonl":
+            sent = record.get(self.field) if isinstance(record,
+                                                        dict) else None
+            return sent if isinstance(sent, str) else None
+        if self.fmt == "tsv":
+            return record[self.column] if self.column < len(record) else None
+        return record
+
+    def encode(self, record: Any, sent: str) -> str:
+        if self.fmt == "jsonl":
+            record = dict(record)
+            record[self.field] = sent
+            return json.dumps(record, ensure_ascii=False)
+        if self.fmt == "tsv":
+            record = list(record)
+            record[self.column] = sent
+            return "\t".join(record)
+        return sent
+
+
+class Throughput:
+    """
+        Reports the number of sentences done and the rate on `stream`
+        every `every` seconds.
+    """
+    def __init__(self, every: float = 5.0, stream: TextIO = sys.stderr):
+        self.every = every
+        self.stream = stream
+        self.count = 0
+        self.start = time.perf_counter()
+        self.last = self.start
+
+    def update(self, k: int = 1):
+        self.count += k
+        now = time.perf_counter()
+        if self.every > 0 and now - self.last >= self.every:
+            self.last = now
+            self.report(now)
+
+    def report(self, now: Optional[float] = None, final: bool = False):
+        now = now or time.perf_counter()
+        elapsed = max(now - self.start, 1e-9)
+        prefix = "done: " if final else ""
+        print(f"{prefix}{self.count} sentences in {elapsed:.1f}s, "
+              f"{self.count / elapsed:.1f} sentences/s",
+              file=self.stream,
+              flush=True)
+
+
+def augment_stream(augmentor: Augmentor,
+                   lines: Iterable[str],
+                   codec: Codec,
+                   n: int = 1,
+                   num_workers: Optional[int] = None,
+                   chunk_size: int = 256,
+                   max_pending: Optional[int] = None,
+                   id_mode: bool = False,
+                   unique: bool = False,
+                   max_tries: Optional[int] = None,
+                   progress: Optional[Throughput] = None) -> Iterator[str]:
+    """
+        Yield the output lines for `lines`, in input order. Records wait
+        in a queue bounded by the chunks in flight of `augment_corpus`.
+        With `unique`, a record gives at most `n` lines, one per distinct
+        variant found. Malformed records (invalid JSON, no `--field`, fewer
+        than `--column` columns) are skipped with a warning on stderr.
+    """
+    records = deque()
+
+    def sentences():
+        for lineno, line in enumerate(lines, 1):
+            if codec.fmt == "jsonl" and not line.strip():
+                continue
+            try:
+                record = codec.decode(line)
+            except ValueError:
+                record = None
+            sent = None if record is None else codec.sentence(record)
+            if sent is None:
+                print(f"skipping malformed line {lineno}",
+                      file=sys.stderr,
+                      flush=True)
+                continue
+            records.append(record)
+            yield sent
+
+    results = augmentor.augment_corpus(sentences(),
+                                       n=n,
+                                       num_workers=num_workers,
+                                       chunk_size=chunk_size,
+                                       max_pending=max_pending,
+                                       id_mode=id_mode,
+                                       unique=unique,
+                                       max_tries=max_tries)
+    for result in results:
+        record = records.popleft()
+        for sent in [result] if n == 1 and not unique else result:
+            yield codec.encode(record, sent)
+        if progress is not None:
+            progress.update()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="fastaug",
+        description="Augment a text, JSONL or TSV file line by line.")
+    parser.add_argument("input",
+                        nargs="?",
+                        default="-",
+                        help="input file, - for stdin (default)")
+    parser.add_argument("-o",
+                        "--output",
+                        default="-",
+                        help="output file, - for stdout (default)")
+    parser.add_argument("--format",
+                        choices=FORMATS,
+                        default=None,
+                        help="input format, guessed from the extension "
+                        "by default")
+    parser.add_argument("--field",
+                        default="text",
+                        help="the field to augment in JSONL records")
+    parser.add_argument("--column",
+                        type=int,
+                        default=0,
+                        help="the column to augment in TSV rows")
+    pipeline = parser.add_mutually_exclusive_group(required=True)
+    pipeline.add_argument("--ops", help="NAME:AUG_P,NAME:AUG_P,...")
+    pipeline.add_argument("--spec", help="a JSON pipeline spec file")
+    parser.add_argument("--pipeline-p", type=float, default=None)
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--tokenizer", choices=MODES, default=None)
+    parser.add_argument("-n",
+                        type=int,
+                        default=1,
+                        help="augmentations per sentence")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=None,
+                        help="worker processes, all cores by default, "
+                        "0 to run in this process")
+    parser.add_argument("--chunk-size", type=int, default=256)
+    parser.add_argument("--max-pending",
+                        type=int,
+                        default=None,
+                        help="chunks in flight, twice the workers by "
+                        "default")
+    parser.add_argument("--id-mode",
+                        action="store_true",
+                        help="run the word ops on arrays of token ids")
+    parser.add_argument("--unique",
+                        action="store_true",
+                        help="only output distinct variants, different "
+                        "from the input")
+    parser.add_argument("--max-tries",
+                        type=int,
+                        default=None,
+                        help="variants generated per sentence with "
+                        "--unique, 4n by default")
+    parser.add_argument("--report-every",
+                        type=float,
+                        default=5.0,
+                        help="seconds between throughput reports, 0 to "
+                        "only report at the end")
+    parser.add_argument("--quiet", action="store_true")
+    args = parser.parse_args(argv)
+    if args.unique and args.id_mode:
+        parser.error("--unique is not supported with --id-mode")
+
+    try:
+        if args.spec is not None:
+            with open(args.spec, "r") as f:
+                spec = json.load(f)
+        else:
+            spec = {"ops": parse_ops(args.ops)}
+        for key in ("pipeline_p", "seed", "tokenizer"):
+            if getattr(args, key) is not None:
+                spec[key] = getattr(args, key)
+        augmentor = build_augmentor(spec)
+    except (TypeError, ValueError, KeyError) as e:
+        parser.error(f"invalid pipeline: {e}")
+
+    fmt = args.format or guess_format(args.input)
+    codec = Codec(fmt, args.field, args.column)
+    fin = sys.stdin if args.input == "-" else open(
+        args.input, "r", encoding="utf-8")
+    fout = sys.stdout if args.output == "-" else open(
+        args.output, "w", encoding="utf-8")
+    progress = None if args.quiet else Throughput(args.report_every)
+    try:
+        try:
+            for line in augment_stream(augmentor,
+                                       fin,
+                                       codec,
+                                       n=args.n,
+                                       num_workers=args.workers,
+                                       chunk_size=args.chunk_size,
+                                       max_pending=args.max_pending,
+                                       id_mode=args.id_mode,
+                                       unique=args.unique,
+                                       max_tries=args.max_tries,
+                                       progress=progress):
+                fout.write(line)
+                fout.write("\n")
+        finally:
+            if fin is not sys.stdin:
+                fin.close()
+            if fout is not sys.stdout:
+                fout.close()
+            else:
+                fout.flush()
+    except BrokenPipeError:
+        # the reader went away (e.g. `fastaug ... | head`): stop quietly,
+        # pointing stdout at devnull so that its final flush cannot fail
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        sys.exit(1)
+    if progress is not None:
+        progress.report(final=True)
+
+
+if __name__ == "__main__":
+    main()
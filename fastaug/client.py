@@ -0,0 +1,105 @@
+"""
+    A blocking client of the augmentation server, see `fastaug.server`.
+
+        client = AugmentClient("http://127.0.0.1:8000")
+        client = AugmentClient(unix_path="/tmp/fastaug.sock")
+        client.augment("default", ["a sentence", "another one"], n=3)
+
+    A client keeps its connection open between requests; use one client
+    per thread.
+"""
+from typing import Any, List, Optional, Union
+from urllib.parse import quote, urlsplit
+import http.client
+import json
+import socket
+
+
+class _UnixConnection(http.client.HTTPConnection):
+    def __init__(self, path: str, timeout: Optional[float] = None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        if self.timeout is not None:
+            self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+
+class ServerError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(f"{status}: {message}")
+        self.status = status
+
+
+class AugmentClient:
+    def __init__(self,
+                 url: str = "http://127.0.0.1:8000",
+                 unix_path: Optional[str] = None,
+                 timeout: Optional[float] = 60.0):
+        if unix_path is not None:
+            self._conn = _UnixConnection(unix_path, timeout)
+        else:
+            parts = urlsplit(url)
+            self._conn = http.client.HTTPConnection(parts.hostname,
+                                                    parts.port or 80,
+                                                    timeout=timeout)
+
+    def _request(self, method: str, path: str, payload: Any = None):
+        body = None if payload is None else json.dumps(payload).encode(
+            "utf-8")
+        headers = {"Content-Type": "application/json"} if body else {}
+        try:
+            self._conn.request(method, path, body, headers)
+            response = self._conn.getresponse()
+        except (http.client.HTTPException, ConnectionError):
+            # the server closed an idle connection, retry once
+            self._conn.close()
+            self._conn.request(method, path, body, headers)
+            response = self._conn.getresponse()
+        data = response.read()
+        if response.headers.get_content_type() == "application/json":
+            data = json.loads(data)
+        else:
+            data = data.decode("utf-8")
+        if response.status != 200:
+            message = data.get("error") if isinstance(data, dict) else data
+            raise ServerError(response.status, message)
+        return data
+
+    def augment(self,
+                pipeline: str,
+                texts: Union[str, List[str]],
+                n: int = 1,
+                unique: bool = False) -> list:
+        """
+            Augment a sentence, or a list of them, with the pipeline named
+            `pipeline`. Results are those of `Augmentor.augment` (or of
+            `augment_unique` with `unique`).
+        """
+        single = isinstance(texts, str)
+        results = self._request("POST", f"/augment/{quote(pipeline)}", {
+            "texts": [texts] if single else texts,
+            "n": n,
+            "unique": unique
+        })["results"]
+        return results[0] if single else results
+
+    def pipelines(self) -> List[str]:
+        return self._request("GET", "/pipelines")["pipelines"]
+
+    def metrics(self) -> str:
+        return self._request("GET", "/metrics")
+
+    def health(self) -> bool:
+        return self._request("GET", "/health")["status"] == "ok"
+
+    def close(self):
+        self._conn.close()
+
+    def __enter__(self) -> "AugmentClient":
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,84 @@
+"""
+    Words as padded arrays of unicode code points, for the batch char
+    engine (see `fastaug.aug_ops.defs.apply_char_ops_batch`).
+
+    A batch of words is a `(n_words, width)` uint32 matrix padded with 0
+    plus the lengths. Conversions go through a single UTF-32 encode or
+    decode of the whole batch.
+"""
+from typing import Dict, List, Mapping, Tuple
+from functools import lru_cache
+import numpy as np
+from .lexicon import load_resource_lexicon
+
+
+def encode_words(words: List[str],
+                 width: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    lengths = np.fromiter(map(len, words), dtype=np.int64, count=len(words))
+    width = max(width, int(lengths.max(initial=0)))
+    if width == 0:
+        return np.zeros((len(words), 0), dtype=np.uint32), lengths
+    buf = "".join([word.ljust(width, "\0") for word in words])
+    cps = np.frombuffer(buf.encode("utf-32-le"), dtype=np.uint32)
+    return cps.reshape(len(words), width).copy(), lengths
+
+
+def decode_words(cps: np.ndarray, lengths: np.ndarray) -> List[str]:
+    width = cps.shape[1]
+    text = np.ascontiguousarray(cps, dtype=np.uint32).tobytes().decode(
+        "utf-32-le")
+    return [
+        text[start:start + n]
+        for start, n in zip(range(0, len(text), width), lengths.tolist())
+    ] if width else [""] * len(cps)
+
+
+class CodepointTable:
+    """
+        Candidates of single characters indexed by code point: the
+        candidates of `c` are `cands[offsets[c]:offsets[c] + counts[c]]`,
+        `counts[c]` being 0 for characters beyond the table or without
+        candidates. Candidates longer than one character are stored as
+        0 and kept as strings in `long_cands[(c, i)]`.
+    """
+    def __init__(self, mapping: Mapping[str, List[str]]):
+        keys = [key for key in mapping.keys() if len(key) == 1]
+        size = max(map(ord, keys), default=-1) + 1
+        self.counts = np.zeros(size, dtype=np.int64)
+        self.offsets = np.zeros(size, dtype=np.int64)
+        cands = []
+        self.long_cands: Dict[Tuple[int, int], str] = {}
+        for key in keys:
+            c = ord(key)
+            values = mapping.get(key) or []
+            self.offsets[c] = len(cands)
+            self.counts[c] = len(values)
+            for i, value in enumerate(values):
+                if len(value) == 1:
+                    cands.append(ord(value))
+                else:
+                    self.long_cands[(c, i)] = value
+                    cands.append(0)
+        self.cands = np.array(cands, dtype=np.uint32)
+
+    def lookup_counts(self, cps: np.ndarray) -> np.ndarray:
+        inside = cps < len(self.counts)
+        return np.where(inside, self.counts[np.where(inside, cps, 0)], 0)
+
+
+@lru_cache(maxsize=None)
+def load_typo_table(*names: str) -> CodepointTable:
+    return CodepointTable(load_resource_lexicon(*names))
+
+
+@lru_cache(maxsize=None)
+def load_confusion_table(name: str = "confusion_zh.json") -> CodepointTable:
+    """
+        The table of a confusion set mapping characters to the string of
+        their confusable characters, the character itself excluded.
+    """
+    lexicon = load_resource_lexicon(name)
+    return CodepointTable({
+        key: [cand for cand in cands if cand != key]
+        for key, cands in lexicon.items()
+    })
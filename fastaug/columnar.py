@@ -0,0 +1,218 @@
+"""
+    Columnar input and output: augment Arrow string arrays, NumPy arrays
+    or pandas Series in bulk, and streams of Arrow record batches.
+    Arrow and pandas are optional, only imported when given.
+
+    Results come in one of two layouts:
+
+        "list"  one entry per input, the list of its `n` variants (a
+                FixedSizeListArray for Arrow, a `(len, n)` object array for
+                NumPy), or the variant itself when `n == 1`
+        "rows"  `n` rows per input, with the index of their source row
+
+    With `unique`, inputs have up to `n` variants: "list" entries are
+    lists of variable size and "rows" follow the variants found.
+
+    Null inputs give null entries in the "list" layout and no rows in the
+    "rows" layout. Values are augmented with `Augmentor.augment_corpus`,
+    so the i-th input gets what `augment_batch` would give it.
+"""
+from typing import Any, Iterable, Iterator, List, Optional, Tuple
+from collections import deque
+import sys
+import numpy as np
+
+LAYOUTS = ("list", "rows")
+
+
+def _is_arrow(values: Any) -> bool:
+    if "pyarrow" not in sys.modules:
+        return False
+    import pyarrow as pa
+    return isinstance(values, (pa.Array, pa.ChunkedArray))
+
+
+def _is_pandas(values: Any) -> bool:
+    return type(values).__module__.startswith("pandas") and hasattr(
+        values, "index")
+
+
+def _is_null(value: Any) -> bool:
+    # pandas represents missing strings as None, NaN or pd.NA
+    if value is None or (isinstance(value, float) and value != value):
+        return True
+    return "pandas" in sys.modules and value is sys.modules["pandas"].NA
+
+
+def _texts(values: Any) -> List[Optional[str]]:
+    if _is_arrow(values):
+        return values.to_pylist()
+    if _is_pandas(values):
+        values = values.to_numpy(dtype=object)
+    if isinstance(values, np.ndarray):
+        values = values.tolist()
+    return [None if _is_null(value) else value for value in values]
+
+
+def _augment(augmentor, texts: List[Optional[str]], n: int,
+             **kwargs) -> List[Any]:
+    valid = [text for text in texts if text is not None]
+    results = iter(augmentor.augment_corpus(valid, n=n, **kwargs))
+    return [None if text is None else next(results) for text in texts]
+
+
+def _to_rows(results: List[Any],
+             nested: bool) -> Tuple[np.ndarray, List[str]]:
+    src = []
+    flat = []
+    for i, result in enumerate(results):
+        if result is None:
+            continue
+        if nested:
+            src.extend([i] * len(result))
+            flat.extend(result)
+        else:
+            src.append(i)
+            flat.append(result)
+    return np.array(src, dtype=np.int64), flat
+
+
+def _arrow_type(n: int, unique: bool):
+    import pyarrow as pa
+    if unique:
+        return pa.list_(pa.string())
+    return pa.string() if n == 1 else pa.list_(pa.string(), n)
+
+
+def augment_array(augmentor,
+                  values: Any,
+                  n: int = 1,
+                  layout: str = "list",
+                  **kwargs) -> Any:
+    """
+        Augment an Arrow string array (or chunked array), a NumPy array
+        or a pandas Series of strings, returning a result of the same kind
+        in `layout`:
+
+            Arrow    "list": a string array (n == 1) or a fixed size list
+                     array; "rows": a record batch of `source_index` and
+                     `text`
+            NumPy    "list": an object array of shape (len,) (n == 1) or
+                     (len, n); "rows": a tuple (source_index, texts)
+            pandas   "list": a Series with the same index; "rows": a
+                     DataFrame of the variants indexed by their source
+
+        Other sequences are handled like NumPy arrays. Keyword arguments
+        go to `Augmentor.augment_corpus` (num_workers, chunk_size...).
+        With `unique`, an input has up to `n` variants: "list" entries are
+        lists of variable size (a list array for Arrow, a (len,) object
+        array of lists for NumPy) and "rows" follow the variants found.
+    """
+    if layout not in LAYOUTS:
+        raise ValueError(f"layout must be one of {LAYOUTS}, got {layout}")
+    unique = kwargs.get("unique", False)
+    nested = n > 1 or unique
+    texts = _texts(values)
+    results = _augment(augmentor, texts, n, **kwargs)
+    if _is_arrow(values):
+        import pyarrow as pa
+        if layout == "list":
+            return pa.array(results, type=_arrow_type(n, unique))
+        src, flat = _to_rows(results, nested)
+        return pa.RecordBatch.from_arrays(
+            [pa.array(src, pa.int64()),
+             pa.array(flat, pa.string())],
+            names=["source_index", "text"])
+    if _is_pandas(values):
+        import pandas as pd
+        if layout == "list":
+            out = np.empty(len(results), dtype=object)
+            out[:] = results
+            return pd.Series(out, index=values.index, name=values.name)
+        src, flat = _to_rows(results, nested)
+        return pd.DataFrame({values.name or "text": flat},
+                            index=values.index.take(src))
+    if layout == "list":
+        fixed = n > 1 and not unique
+        out = np.empty((len(results), n) if fixed else len(results),
+                       dtype=object)
+        for i, result in enumerate(results):
+            out[i] = result
+        return out
+    src, flat = _to_rows(results, nested)
+    out = np.empty(len(flat), dtype=object)
+    out[:] = flat
+    return src, out
+
+
+def augment_record_batches(augmentor,
+                           batches: Iterable[Any],
+                           column: str,
+                           n: int = 1,
+                           layout: str = "list",
+                           **kwargs) -> Iterator[Any]:
+    """
+        Augment the `column` of a stream of Arrow record batches, e.g.
+        `pyarrow.parquet.ParquetFile(path).iter_batches()`, yielding one
+        batch per input batch. In the "list" layout the column is replaced
+        by the variants, in the "rows" layout every row is repeated once
+        per variant (`n` times, fewer with `unique`), with a
+        `source_index` column counting rows from the start of the stream.
+        Batches are read lazily and sentences of consecutive batches share
+        the chunks in flight of `augment_corpus`, so memory stays bounded
+        by the batches pending.
+    """
+    import pyarrow as pa
+    if layout not in LAYOUTS:
+        raise ValueError(f"layout must be one of {LAYOUTS}, got {layout}")
+    unique = kwargs.get("unique", False)
+    pending = deque()
+
+    def sentences():
+        for batch in batches:
+            index = batch.schema.get_field_index(column)
+            if index == -1:
+                raise KeyError(f"no column {column!r} in {batch.schema}")
+            texts = batch.column(index).to_pylist()
+            valid = [text for text in texts if text is not None]
+            pending.append((batch, texts, len(valid)))
+            yield from valid
+
+    offset = 0
+    out = []
+
+    def flush():
+        nonlocal offset, out
+        batch, texts, count = pending.popleft()
+        results = iter(out[:count])
+        out = out[count:]
+        results = [None if text is None else next(results) for text in texts]
+        offset += len(texts)
+        return _with_results(batch, column, results, n, layout,
+                             offset - len(texts), unique)
+
+    for result in augmentor.augment_corpus(sentences(), n=n, **kwargs):
+        out.append(result)
+        # the batch of a result was read before it, empty ones included
+        while pending and len(out) >= pending[0][2]:
+            yield flush()
+    # trailing batches without any text
+    while pending:
+        yield flush()
+
+
+def _with_results(batch: Any, column: str, results: List[Any], n: int,
+                  layout: str, offset: int, unique: bool):
+    import pyarrow as pa
+    index = batch.schema.get_field_index(column)
+    names = list(batch.schema.names)
+    if layout == "list":
+        arrays = list(batch.columns)
+        arrays[index] = pa.array(results, type=_arrow_type(n, unique))
+    else:
+        src, flat = _to_rows(results, n > 1 or unique)
+        arrays = list(batch.take(pa.array(src, pa.int64())).columns)
+        arrays[index] = pa.array(flat, pa.string())
+        arrays.append(pa.array(src + offset, pa.int64()))
+        names.append("source_index")
+    return pa.RecordBatch.from_arrays(arrays, names=names)
@@ -0,0 +1,150 @@
+"""
+    PyTorch datasets augmenting their samples on the fly, in DataLoader
+    workers. Requires torch.
+
+    Every worker reseeds the augmentor from the seed torch gives it, so
+    workers draw independent streams, new ones at every epoch, and a
+    seeded augmentor with `torch.manual_seed` gives reproducible epochs.
+    Samples are augmented a batch at a time. Lexicons are memory-mapped,
+    so forked (or spawned) workers share their pages read-only instead
+    of copying them.
+"""
+from typing import (Any, Hashable, Iterable, Iterator, List, Optional,
+                    Sequence, Tuple)
+from itertools import islice
+import numpy as np
+from torch.utils.data import Dataset, IterableDataset, get_worker_info
+from .augmentor import Augmentor
+
+
+def seed_augmentor_for_worker(augmentor: Augmentor,
+                              base_entropy: Any = None,
+                              spawn_key: Tuple[int, ...] = ()) -> bool:
+    """
+        In a DataLoader worker, reseed `augmentor` from the worker seed
+        mixed with `base_entropy` and `spawn_key` (those of its own seed,
+        so that spawned augmentors keep distinct streams). Return whether
+        it was reseeded. Can be called from a `worker_init_fn`.
+    """
+    info = get_worker_info()
+    if info is None:
+        return False
+    entropy = [info.seed]
+    if base_entropy is not None:
+        entropy.append(base_entropy)
+    augmentor.seed(
+        np.random.SeedSequence(entropy, spawn_key=tuple(spawn_key)))
+    return True
+
+
+class _AugmentedBase:
+    def __init__(self,
+                 augmentor: Augmentor,
+                 n: int = 1,
+                 field: Optional[Hashable] = None,
+                 id_mode: bool = False):
+        self.augmentor = augmentor
+        self.n = n
+        self.field = field
+        self.id_mode = id_mode
+        self._base_entropy = augmentor.seed_seq.entropy
+        self._base_spawn_key = augmentor.seed_seq.spawn_key
+        self._worker_seed = None
+
+    def _maybe_reseed(self):
+        info = get_worker_info()
+        if info is not None and info.seed != self._worker_seed:
+            # workers are created anew for every epoch unless persistent
+            seed_augmentor_for_worker(self.augmentor, self._base_entropy,
+                                      self._base_spawn_key)
+            self._worker_seed = info.seed
+
+    def _text(self, sample) -> str:
+        return sample if self.field is None else sample[self.field]
+
+    def _with_text(self, sample, text):
+        if self.field is None:
+            return text
+        if isinstance(sample, dict):
+            sample = dict(sample)
+            sample[self.field] = text
+            return sample
+        ret = list(sample)
+        ret[self.field] = text
+        return tuple(ret) if isinstance(sample, tuple) else ret
+
+    def augment_samples(self, samples: List[Any]) -> List[Any]:
+        """
+            Augment the text of a batch of samples. With `n > 1` the text
+            of a sample is replaced by the list of its `n` augmentations.
+        """
+        self._maybe_reseed()
+        texts = [self._text(sample) for sample in samples]
+        if self.id_mode:
+            augmented = self.augmentor.augment_ids(texts, self.n)
+        else:
+            augment = self.augmentor.augment
+            augmented = [augment(text, self.n) for text in texts]
+        return [
+            self._with_text(sample, text)
+            for sample, text in zip(samples, augmented)
+        ]
+
+
+class AugmentedDataset(_AugmentedBase, Dataset):
+    """
+        Map-style dataset augmenting the samples of `dataset`: strings, or
+        dicts/sequences whose text is at key `field`. DataLoader fetches a
+        batch through `__getitems__`, which augments it at once.
+    """
+    def __init__(self,
+                 dataset: Sequence,
+                 augmentor: Augmentor,
+                 n: int = 1,
+                 field: Optional[Hashable] = None,
+                 id_mode: bool = False):
+        super().__init__(augmentor, n, field, id_mode)
+        self.dataset = dataset
+
+    def __len__(self) -> int:
+        return len(self.dataset)
+
+    def __getitem__(self, idx: int):
+        return self.augment_samples([self.dataset[idx]])[0]
+
+    def __getitems__(self, indices: List[int]) -> List[Any]:
+        return self.augment_samples([self.dataset[idx] for idx in indices])
+
+
+class AugmentedIterableDataset(_AugmentedBase, IterableDataset):
+    """
+        Iterable dataset augmenting the samples of `iterable`, read and
+        augmented `batch_size` at a time. `iterable` may be a callable
+        returning a fresh iterator for every epoch. With `shard`, worker
+        `i` of `k` only keeps the samples `i, i + k, ...` instead of
+        seeing them all.
+    """
+    def __init__(self,
+                 iterable: Iterable,
+                 augmentor: Augmentor,
+                 n: int = 1,
+                 field: Optional[Hashable] = None,
+                 batch_size: int = 256,
+                 shard: bool = True,
+                 id_mode: bool = False):
+        super().__init__(augmentor, n, field, id_mode)
+        self.iterable = iterable
+        self.batch_size = batch_size
+        self.shard = shard
+
+    def __iter__(self) -> Iterator[Any]:
+        it = self.iterable() if callable(self.iterable) else iter(
+            self.iterable)
+        info = get_worker_info()
+        if self.shard and info is not None and info.num_workers > 1:
+            it = islice(it, info.id, None, info.num_workers)
+        while True:
+            batch = list(islice(it, self.batch_size))
+            if not batch:
+                return
+            yield from self.augment_samples(batch)
@@ -0,0 +1,232 @@
+"""
+    Streaming conversion of text word vectors (GloVe/word2vec text format,
+    one `word v1 v2 ...` per line) into a memory-mapped store:
+
+        out_dir/vectors.npy   -- N x d, float32, float16 or int8
+        out_dir/scales.npy    -- per-row float32 scales (int8 only)
+        out_dir/vocab.txt     -- the N words, one per line
+
+    The text file is parsed line by line into an `open_memmap`, so memory
+    stays flat whatever its size, and reloading is instant.
+
+        python -m fastaug.embedding glove.txt out_dir [--dtype int8]
+"""
+from typing import List, Union
+from pathlib import Path
+import argparse
+import os
+import shutil
+import numpy as np
+from .util import DownloadUtil, cache_dir
+
+DTYPES = ("float32", "float16", "int8")
+
+
+class EmbeddingStore:
+    """
+        A memory-mapped embedding matrix. Indexing it with an int, a slice
+        or an index array returns dequantized float32 rows, so it can be
+        given as is to `EmbeddingNbrUtil` or `fastaug.knn`.
+    """
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        self.vectors = np.load(self.path / "vectors.npy", mmap_mode="r")
+        self.scales = None
+        if self.vectors.dtype == np.int8:
+            self.scales = np.load(self.path / "scales.npy", mmap_mode="r")
+        with open(self.path / "vocab.txt", "r", encoding="utf-8") as f:
+            self.words = f.read().split("\n")[:len(self.vectors)]
+        self.word2idx = {word: i for i, word in enumerate(self.words)}
+        self.device = "cpu"
+
+    @staticmethod
+    def load(path: Union[str, Path]) -> "EmbeddingStore":
+        return EmbeddingStore(path)
+
+    def __len__(self) -> int:
+        return len(self.vectors)
+
+    @property
+    def shape(self):
+        return self.vectors.shape
+
+    @property
+    def dim(self) -> int:
+        return self.vectors.shape[1]
+
+    def __getitem__(self, idx) -> np.ndarray:
+        rows = np.asarray(self.vectors[idx], dtype=np.float32)
+        if self.scales is not None:
+            scales = np.asarray(self.scales[idx], dtype=np.float32)
+            rows = rows * (scales[..., None] if rows.ndim == 2 else scales)
+        return rows
+
+    def __getstate__(self):
+        return str(self.path)
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+
+class EmbeddingNeighbours:
+    """
+        A read-only mapping from a word to its neighbours in `embed` (an
+        `EmbeddingStore`), computed on the fly. It can be used as the
+        candidates of `WordDictSub`, see `WordEmbedSub`.
+    """
+    def __init__(self,
+                 embed: EmbeddingStore,
+                 topk: int = 16,
+                 dist: float = 0.25,
+                 measure: str = "cos"):
+        from .util import EmbeddingNbrUtil
+        self.embed = embed
+        self.topk = topk
+        self.dist = dist
+        self.measure = measure
+        self.util = EmbeddingNbrUtil(embed)
+        # lookups are cached per store and thresholds, see fastaug.cache
+        self.path = f"{embed.path}?measure={measure}&topk={topk}&dist={dist}"
+
+    def __contains__(self, word: str) -> bool:
+        return bool(self.get(word))
+
+    def get(self, word: str, default=None) -> List[str]:
+        if word not in self.embed.word2idx:
+            return default
+        nbrs = self.util.find_neighbours_batch([word],
+                                               measure=self.measure,
+                                               topk=self.topk + 1,
+                                               dist=self.dist,
+                                               return_words=True)[0]
+        nbrs = [nbr for nbr in nbrs if nbr != word][:self.topk]
+        return nbrs or default
+
+    def __getitem__(self, word: str) -> List[str]:
+        nbrs = self.get(word)
+        if nbrs is None:
+            raise KeyError(word)
+        return nbrs
+
+    def similarities(self, word: str, nbrs: List[str]) -> List[float]:
+        """
+            Cosine similarities of `word` with `nbrs`, floored at a small
+            positive value so that they can be used as weights.
+        """
+        word2idx = self.embed.word2idx
+        vectors = self.embed[np.array([word2idx[w] for w in [word] + nbrs])]
+        norms = np.linalg.norm(vectors, axis=1)
+        sims = vectors[1:] @ vectors[0] / np.maximum(norms[1:] * norms[0],
+                                                    1e-12)
+        return np.maximum(sims, 1e-6).tolist()
+
+
+def convert_text_vectors(txt_path: str,
+                         out_dir: str,
+                         dtype: str = "float32",
+                         encoding: str = "utf-8") -> EmbeddingStore:
+    """
+        Convert a text vector file into an `EmbeddingStore` in `out_dir`.
+        A word2vec "N d" header line is skipped, and so are the rows whose
+        dimension differs from that of the first one. int8 quantization is
+        symmetric with one scale per row. The store is written into a
+        temporary directory moved into place once complete.
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"dtype must be one of {DTYPES}, got {dtype}")
+    out_dir = Path(out_dir)
+    out_dir.parent.mkdir(parents=True, exist_ok=True)
+
+    # first pass: count the vectors and find the dimension
+    n_rows, n_skipped, dim, header = 0, 0, None, False
+    with open(txt_path, "r", encoding=encoding, errors="replace") as f:
+        for i, line in enumerate(f):
+            fields = line.rstrip().split(" ")
+            if i == 0 and len(fields) == 2:
+                header = True
+                continue
+            if len(fields) < 2:
+                continue
+            if dim is None:
+                dim = len(fields) - 1
+            if len(fields) - 1 == dim:
+                n_rows += 1
+            else:
+                n_skipped += 1
+    if dim is None:
+        raise ValueError(f"no vectors found in {txt_path}")
+    if n_skipped:
+        print(f"Skipping {n_skipped} rows of {txt_path} whose dimension is "
+              f"not {dim}")
+
+    tmp_dir = out_dir.with_name(f"{out_dir.name}.tmp{os.getpid()}")
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir()
+    vectors = np.lib.format.open_memmap(str(tmp_dir / "vectors.npy"),
+                                        mode="w+",
+                                        dtype=np.dtype(dtype),
+                                        shape=(n_rows, dim))
+    scales = None
+    if dtype == "int8":
+        scales = np.lib.format.open_memmap(str(tmp_dir / "scales.npy"),
+                                           mode="w+",
+                                           dtype=np.float32,
+                                           shape=(n_rows, ))
+    row = 0
+    with open(txt_path, "r", encoding=encoding, errors="replace") as f, \
+            open(tmp_dir / "vocab.txt", "w", encoding="utf-8") as vocab:
+        for i, line in enumerate(f):
+            if i == 0 and header:
+                continue
+            fields = line.rstrip().split(" ")
+            if len(fields) - 1 != dim:
+                continue
+            vec = np.array(fields[1:], dtype=np.float32)
+            if scales is None:
+                vectors[row] = vec
+            else:
+                scale = np.abs(vec).max() / 127.0
+                scales[row] = scale
+                if scale > 0:
+                    vectors[row] = np.round(vec / scale)
+                else:
+                    vectors[row] = 0
+            vocab.write(fields[0] + "\n")
+            row += 1
+    vectors.flush()
+    if scales is not None:
+        scales.flush()
+    del vectors, scales
+    if out_dir.exists():
+        # vocab.txt last, its presence marks a complete store
+        names = sorted(os.listdir(tmp_dir), key=lambda n: n == "vocab.txt")
+        for name in names:
+            os.replace(tmp_dir / name, out_dir / name)
+        tmp_dir.rmdir()
+    else:
+        os.replace(tmp_dir, out_dir)
+    return EmbeddingStore(out_dir)
+
+
+def load_counter_fitting(dtype: str = "float32") -> EmbeddingStore:
+    """
+        The counter-fitted GloVe vectors, downloaded and converted into
+        `cache_dir("counter-fitting")` on first use.
+    """
+    out_dir = cache_dir("counter-fitting") / f"store-{dtype}"
+    if not (out_dir / "vocab.txt").exists():
+        txt_path = DownloadUtil.download_counter_fitting_if_not_exists()
+        convert_text_vectors(str(txt_path), str(out_dir), dtype)
+    return EmbeddingStore(out_dir)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Convert text word vectors into a memory-mapped store.")
+    parser.add_argument("txt_path")
+    parser.add_argument("out_dir")
+    parser.add_argument("--dtype", default="float32", choices=DTYPES)
+    args = parser.parse_args()
+    store = convert_text_vectors(args.txt_path, args.out_dir, args.dtype)
+    print(f"{len(store)} x {store.dim} {args.dtype} vectors written to "
+          f"{args.out_dir}")
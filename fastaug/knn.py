@@ -0,0 +1,160 @@
+"""
+    Exact k nearest neighbour search on CPU with numpy only.
+
+    Queries and the data matrix are processed in blocks so that a distance
+    block never exceeds `block_size` x `block_size` floats per thread, the
+    running top-k of each query block being merged with every new block.
+    Blocks are distributed over a thread pool, numpy's matrix products
+    release the GIL.
+"""
+from typing import Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
+import os
+import numpy as np
+
+MEASURES = ("euc", "cos")
+
+
+def as_numpy(matrix) -> np.ndarray:
+    """
+        View a torch tensor or an array-like as a float32 numpy matrix.
+    """
+    if hasattr(matrix, "detach"):
+        matrix = matrix.detach().cpu().numpy()
+    return np.asarray(matrix, dtype=np.float32)
+
+
+def _rows(matrix, start: int, end: int) -> np.ndarray:
+    return as_numpy(matrix[start:end])
+
+
+def _sq_norms(matrix: np.ndarray) -> np.ndarray:
+    return np.einsum("ij,ij->i", matrix, matrix)
+
+
+def normalize(matrix: np.ndarray) -> np.ndarray:
+    """
+        L2-normalize the rows, zero rows are kept as they are.
+    """
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def blocked_topk(
+    data,
+    topk: int,
+    queries=None,
+    measure: str = "euc",
+    block_size: int = 1024,
+    num_threads: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        Return `(D, I)` of shape `(n_queries, topk)`: the distances to the
+        `topk` nearest rows of `data` and their indices, sorted by
+        increasing distance. `queries` defaults to `data` itself (all-pairs
+        search). The euclidean distance is the true distance, not its
+        square; the cosine distance is `1 - cos_sim`.
+
+        `data` may be a numpy array or memmap of any float dtype, a torch
+        tensor or anything whose row slices convert to arrays (such as a
+        quantized `fastaug.embedding.EmbeddingStore`). It is read one
+        block at a time and never converted as a whole.
+    """
+    if measure not in MEASURES:
+        raise ValueError(f"measure must be one of {MEASURES}, got {measure}")
+    n_data = len(data)
+    topk = min(topk, n_data)
+    data_sq = np.concatenate([
+        _sq_norms(_rows(data, start, start + block_size))
+        for start in range(0, n_data, block_size)
+    ]) if n_data else np.zeros(0, dtype=np.float32)
+    data_norms = np.sqrt(data_sq)
+    data_norms[data_norms == 0] = 1.0
+
+    def data_block(start, end):
+        block = _rows(data, start, end)
+        if measure == "cos":
+            block = block / data_norms[start:end, None]
+        return block
+
+    def query_block(start, end):
+        if queries is None:
+            return data_block(start, end)
+        return queries[start:end]
+
+    if queries is None:
+        n_queries = n_data
+        queries_sq = data_sq
+    else:
+        queries = as_numpy(queries)
+        if queries.ndim == 1:
+            queries = queries[None, :]
+        if measure == "cos":
+            queries = normalize(queries)
+        n_queries = len(queries)
+        queries_sq = _sq_norms(queries)
+
+    D = np.empty((n_queries, topk), dtype=np.float32)
+    I = np.empty((n_queries, topk), dtype=np.int64)
+
+    def search(q_start):
+        q_end = min(q_start + block_size, n_queries)
+        q = query_block(q_start, q_end)
+        best_d = np.full((len(q), 0), np.inf, dtype=np.float32)
+        best_i = np.empty((len(q), 0), dtype=np.int64)
+        for d_start in range(0, n_data, block_size):
+            d_end = min(d_start + block_size, n_data)
+            # distances are computed in place of the similarities
+            dist = q @ data_block(d_start, d_end).T
+            if measure == "cos":
+                np.subtract(1.0, dist, out=dist)
+            else:
+                dist *= -2.0
+                dist += queries_sq[q_start:q_end, None]
+                dist += data_sq[None, d_start:d_end]
+            if best_d.shape[1] == topk:
+                # only the few entries beating the current k-th neighbour
+                # of their row are merged, the others are discarded
+                r, c = np.nonzero(dist < best_d.max(axis=1)[:, None])
+                if len(r) == 0:
+                    continue
+                counts = np.bincount(r, minlength=len(q))
+                pos = np.arange(len(r)) - (np.cumsum(counts) - counts)[r]
+                new_d = np.full((len(q), counts.max()),
+                                np.inf,
+                                dtype=np.float32)
+                new_i = np.zeros(new_d.shape, dtype=np.int64)
+                new_d[r, pos] = dist[r, c]
+                new_i[r, pos] = c + d_start
+            else:
+                new_d = dist
+                new_i = np.broadcast_to(np.arange(d_start, d_end), dist.shape)
+            best_d, best_i = _merge(best_d, best_i, new_d, new_i, topk)
+        order = np.argsort(best_d, axis=1, kind="stable")
+        best_d = np.take_along_axis(best_d, order, axis=1)
+        if measure == "euc":
+            best_d = np.sqrt(np.maximum(best_d, 0.0))
+        D[q_start:q_end] = best_d
+        I[q_start:q_end] = np.take_along_axis(best_i, order, axis=1)
+
+    starts = range(0, n_queries, block_size)
+    if num_threads is None:
+        num_threads = os.cpu_count() or 1
+    if num_threads <= 1 or len(starts) <= 1:
+        for q_start in starts:
+            search(q_start)
+    else:
+        with ThreadPoolExecutor(num_threads) as pool:
+            list(pool.map(search, starts))
+    return D, I
+
+
+def _merge(best_d, best_i, new_d, new_i, topk):
+    cand_d = np.concatenate([best_d, new_d], axis=1)
+    cand_i = np.concatenate([best_i, new_i], axis=1)
+    if cand_d.shape[1] > topk:
+        part = np.argpartition(cand_d, topk - 1, axis=1)[:, :topk]
+        cand_d = np.take_along_axis(cand_d, part, axis=1)
+        cand_i = np.take_along_axis(cand_i, part, axis=1)
+    return cand_d, cand_i
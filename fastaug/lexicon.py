@@ -0,0 +1,294 @@
+"""
+    A compiled, memory-mapped lexicon mapping words to candidate lists.
+
+    The file holds an interned string table and CSR arrays:
+
+        str_offsets[n_str + 1], str_data      -- UTF-8 strings, by string id
+        keys[n_keys]                          -- string id of every key
+        cand_offsets[n_keys + 1], cand_ids    -- candidates of key i are
+                                                 cand_ids[cand_offsets[i]:
+                                                          cand_offsets[i+1]]
+        slots[2^m]                            -- open addressing hash table
+                                                 (crc32 of the key) -> key
+                                                 index, -1 when empty
+        cand_prob, cand_alias                 -- optional, alias tables of
+                                                 the candidate weights,
+                                                 aligned with cand_ids (see
+                                                 `fastaug.alias`)
+
+    Everything is read through `mmap`, so loading is instant and the pages
+    are shared by all processes using the same file.
+
+    Convert a json resource with:
+
+        python -m fastaug.lexicon morphs.json morphs.lex
+
+    Sources map words to lists of candidates, or to `{candidate: weight}`
+    objects for weighted sampling.
+"""
+from typing import Dict, Iterator, List, Mapping, Optional, Sequence, Tuple
+from functools import lru_cache
+import json
+import mmap
+import os
+import sys
+import zlib
+import numpy as np
+from .alias import AliasTable, alias_tables
+from .util import cache_dir, load_resource
+
+MAGIC = b"FASTLEX1"
+ALIGN = 8
+
+
+class Lexicon:
+    def __init__(self, path: str):
+        self.path = str(path)
+        with open(self.path, "rb") as f:
+            self._mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._mm[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{self.path} is not a compiled lexicon")
+        header_len = int.from_bytes(self._mm[8:16], "little")
+        header = json.loads(self._mm[16:16 + header_len])
+        self.meta = header["meta"]
+        self.arrays = {}
+        self._views = {}
+        buf = memoryview(self._mm)
+        for name, (dtype, offset, length) in header["arrays"].items():
+            arr = np.frombuffer(self._mm,
+                                dtype=dtype,
+                                count=length,
+                                offset=offset)
+            self.arrays[name] = arr
+            # memoryviews give fast scalar access for single lookups
+            self._views[name] = buf[offset:offset +
+                                    arr.nbytes].cast(arr.dtype.char)
+        self._mask = len(self._views["slots"]) - 1
+        self.weighted = "cand_prob" in self.arrays
+
+    @staticmethod
+    def load(path: str) -> "Lexicon":
+        return Lexicon(path)
+
+    @staticmethod
+    def build(mapping: Dict[str, List[str]],
+              path: str,
+              drop_empty: bool = True,
+              meta: Optional[dict] = None,
+              weights: Optional[Mapping[str, Sequence[float]]] = None
+              ) -> "Lexicon":
+        """
+            Compile `mapping` into `path` and load it. Keys without any
+            candidate are dropped unless `drop_empty` is False. `weights`
+            gives the weights of the candidates of some keys (uniform for
+            the others), compiled into alias tables.
+        """
+        str_ids = {}
+        strings = []
+
+        def intern(s):
+            if s not in str_ids:
+                str_ids[s] = len(strings)
+                strings.append(s.encode("utf-8"))
+            return str_ids[s]
+
+        keys, cand_offsets, cand_ids, cand_weights = [], [0], [], []
+        for key, cands in mapping.items():
+            if drop_empty and not cands:
+                continue
+            keys.append(intern(key))
+            cand_ids.extend(intern(cand) for cand in cands)
+            cand_offsets.append(len(cand_ids))
+            if weights is not None:
+                cand_weights.append(weights.get(key) or [1.0] * len(cands))
+
+        n_slots = 2
+        while n_slots < 2 * len(keys):
+            n_slots *= 2
+        slots = np.full(n_slots, -1, dtype=np.int32)
+        for i, key in enumerate(keys):
+            h = zlib.crc32(strings[key]) & (n_slots - 1)
+            while slots[h] != -1:
+                h = (h + 1) & (n_slots - 1)
+            slots[h] = i
+
+        arrays = {
+            "str_offsets": np.cumsum([0] + [len(s) for s in strings],
+                                     dtype=np.int64),
+            "str_data": np.frombuffer(b"".join(strings), dtype=np.uint8),
+            "keys": np.array(keys, dtype=np.int32),
+            "cand_offsets": np.array(cand_offsets, dtype=np.int64),
+            "cand_ids": np.array(cand_ids, dtype=np.int32),
+            "slots": slots,
+        }
+        if weights is not None:
+            arrays["cand_prob"], arrays["cand_alias"] = alias_tables(
+                arrays["cand_offsets"], cand_weights)
+        _write(path, arrays, meta or {})
+        return Lexicon(path)
+
+    def __getstate__(self):
+        return self.path
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+    def __len__(self) -> int:
+        return len(self._views["keys"])
+
+    def string(self, str_id: int) -> str:
+        offsets = self._views["str_offsets"]
+        data = self._views["str_data"][offsets[str_id]:offsets[str_id + 1]]
+        return data.tobytes().decode("utf-8")
+
+    def index(self, word: str) -> int:
+        """
+            Return the index of `word` among the keys, -1 if absent.
+        """
+        b = word.encode("utf-8")
+        slots = self._views["slots"]
+        keys = self._views["keys"]
+        offsets = self._views["str_offsets"]
+        data = self._views["str_data"]
+        mask = self._mask
+        h = zlib.crc32(b) & mask
+        while True:
+            i = slots[h]
+            if i == -1:
+                return -1
+            s = keys[i]
+            if data[offsets[s]:offsets[s + 1]] == b:
+                return i
+            h = (h + 1) & mask
+
+    def candidates(self, index: int) -> List[str]:
+        offsets = self._views["cand_offsets"]
+        cand_ids = self._views["cand_ids"]
+        return [
+            self.string(s)
+            for s in cand_ids[offsets[index]:offsets[index + 1]].tolist()
+        ]
+
+    def alias(self, word: str) -> Optional[AliasTable]:
+        """
+            The alias table of the weights of the candidates of `word`,
+            None when absent or when the lexicon is not weighted.
+        """
+        if not self.weighted:
+            return None
+        i = self.index(word)
+        if i == -1:
+            return None
+        offsets = self._views["cand_offsets"]
+        start, end = offsets[i], offsets[i + 1]
+        return (self._views["cand_prob"][start:end],
+                self._views["cand_alias"][start:end])
+
+    def __contains__(self, word: str) -> bool:
+        return self.index(word) != -1
+
+    def __getitem__(self, word: str) -> List[str]:
+        i = self.index(word)
+        if i == -1:
+            raise KeyError(word)
+        return self.candidates(i)
+
+    def get(self, word: str, default=None) -> Optional[List[str]]:
+        i = self.index(word)
+        if i == -1:
+            return default
+        return self.candidates(i)
+
+    def keys(self) -> Iterator[str]:
+        for s in self._views["keys"].tolist():
+            yield self.string(s)
+
+    def items(self) -> Iterator[Tuple[str, List[str]]]:
+        for i, s in enumerate(self._views["keys"].tolist()):
+            yield self.string(s), self.candidates(i)
+
+
+def _write(path: str, arrays: Dict[str, np.ndarray], meta: dict):
+    def align(x):
+        return (x + ALIGN - 1) // ALIGN * ALIGN
+
+    # the header is sized with placeholder offsets first
+    layout = {
+        name: [arr.dtype.str, 0, len(arr)]
+        for name, arr in arrays.items()
+    }
+    header_len = len(json.dumps({"arrays": layout, "meta": meta})) + 256
+    offset = align(16 + header_len)
+    for name, arr in arrays.items():
+        layout[name][1] = offset
+        offset = align(offset + arr.nbytes)
+    header = json.dumps({"arrays": layout, "meta": meta}).encode("utf-8")
+    header = header.ljust(header_len)
+
+    tmp_path = f"{path}.tmp{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(MAGIC)
+        f.write(header_len.to_bytes(8, "little"))
+        f.write(header)
+        for name, arr in arrays.items():
+            f.write(b"\0" * (layout[name][1] - f.tell()))
+            f.write(arr.tobytes())
+    # concurrent builders never expose a partially written file
+    os.replace(tmp_path, path)
+
+
+def compile_lexicon(json_paths: List[str], out_path: str) -> Lexicon:
+    """
+        Compile json files of `{word: [candidates]}` (or of `{word:
+        {candidate: weight}}`) into a lexicon, merging the candidates of
+        words found in several files; the first weight of a candidate is
+        kept.
+    """
+    merged = {}
+    weighted = False
+    for json_path in json_paths:
+        with open(json_path, "r") as f:
+            for key, cands in json.load(f).items():
+                if isinstance(cands, dict):
+                    weighted = True
+                    cands = list(cands.items())
+                else:
+                    cands = [(cand, 1.0) for cand in cands]
+                merged.setdefault(key, []).extend(cands)
+    for key, cands in merged.items():
+        unique = {}
+        for cand, weight in cands:
+            unique.setdefault(cand, weight)
+        merged[key] = unique
+    weights = None
+    if weighted:
+        weights = {key: list(cands.values()) for key, cands in merged.items()}
+    return Lexicon.build({key: list(cands)
+                          for key, cands in merged.items()},
+                         out_path,
+                         weights=weights)
+
+
+@lru_cache(maxsize=None)
+def load_resource_lexicon(*names: str) -> Lexicon:
+    """
+        Load the json resources `names` as one compiled lexicon. It is
+        compiled into `cache_dir("lexicons")` on first use and recompiled
+        whenever a source is newer. Instances are shared in a process.
+    """
+    sources = [str(load_resource(name)) for name in names]
+    out_dir = cache_dir("lexicons")
+    stem = "+".join(os.path.splitext(name)[0] for name in names)
+    out_path = out_dir / f"{stem}.lex"
+    if not out_path.exists() or out_path.stat().st_mtime < max(
+            os.path.getmtime(src) for src in sources):
+        return compile_lexicon(sources, str(out_path))
+    return Lexicon(str(out_path))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print("usage: python -m fastaug.lexicon SRC.json [SRC.json ...] OUT")
+        sys.exit(1)
+    lexicon = compile_lexicon(sys.argv[1:-1], sys.argv[-1])
+    print(f"{len(lexicon)} entries written to {sys.argv[-1]}")
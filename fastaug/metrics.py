@@ -0,0 +1,240 @@
+"""
+    Opt-in runtime instrumentation of augmentation pipelines.
+
+        metrics = aug.instrument(sample_rate=0.01)
+        ...
+        metrics.to_dict()
+        metrics.to_prometheus()
+
+    For every op of the pipeline, the number of calls and of `pipeline_p`
+    skips are always counted. Wall time and edits are only measured on
+    sampled calls, one every `1 / sample_rate`, and extrapolated to all
+    the calls. Edits are measured by comparing the tokens before and
+    after the op: an op asked to edit `aug_len` tokens which changes
+    fewer of them (e.g. a substitution without candidates) has skipped
+    the others. Lexicon hit rates come from the candidate caches of the
+    ops, see `fastaug.cache`, plus the lookups of pool workers.
+
+    Sampling is deterministic (a counter) and never touches the random
+    streams, so instrumented pipelines give the same results.
+"""
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import numpy as np
+
+COUNTERS = ("calls", "pipeline_skips", "sampled_calls", "sampled_seconds",
+            "edits_attempted", "edits_applied")
+
+
+def _cache_counts(op: Any) -> Tuple[int, int]:
+    cache = getattr(op, "cache", None)
+    if cache is None:
+        return 0, 0
+    stats = cache.stats()
+    return stats["hits"], stats["misses"]
+
+
+class OpStats:
+    # cache_hits and cache_misses count the lookups of other processes,
+    # those of this one are read from the cache
+    __slots__ = ("name", "index", "op", "cache_hits", "cache_misses",
+                 "cache_base") + COUNTERS
+
+    def __init__(self, name: str, index: int, op: Any = None):
+        self.name = name
+        self.index = index
+        self.op = op
+        for key in COUNTERS:
+            setattr(self, key, 0)
+        self.cache_hits = self.cache_misses = 0
+        self.cache_base = _cache_counts(op)
+
+    def pop_cache_counts(self) -> Tuple[int, int]:
+        """
+            The cache lookups of this process since the last call.
+        """
+        hits, misses = _cache_counts(self.op)
+        base_hits, base_misses = self.cache_base
+        self.cache_base = hits, misses
+        return hits - base_hits, misses - base_misses
+
+    def to_dict(self) -> Dict[str, Any]:
+        ret = {key: getattr(self, key) for key in COUNTERS}
+        ret["op"] = self.name
+        ret["index"] = self.index
+        scale = self.calls / self.sampled_calls if self.sampled_calls else 0.0
+        ret["seconds"] = self.sampled_seconds * scale
+        ret["edits_applied_est"] = self.edits_applied * scale
+        ret["edits_skipped_est"] = max(
+            0, self.edits_attempted - self.edits_applied) * scale
+        ret["apply_rate"] = (self.edits_applied / self.edits_attempted
+                             if self.edits_attempted else 0.0)
+        cache = getattr(self.op, "cache", None)
+        if cache is not None:
+            stats = cache.stats()
+            stats["hits"] += self.cache_hits
+            stats["misses"] += self.cache_misses
+            lookups = stats["hits"] + stats["misses"]
+            stats["hit_rate"] = stats["hits"] / lookups if lookups else 0.0
+            ret["cache"] = stats
+        return ret
+
+
+def count_edits(before: List[str], after: List[str]) -> int:
+    """
+        Number of positions which differ, plus the change of length. A
+        swap counts as two edits, which `record` caps by the attempted
+        ones.
+    """
+    return sum(a is not b and a != b
+               for a, b in zip(before, after)) + abs(len(before) - len(after))
+
+
+def count_edits_ids(before: np.ndarray, before_lengths: np.ndarray,
+                    after: np.ndarray, after_lengths: np.ndarray) -> np.ndarray:
+    """
+        `count_edits` of every row of padded arrays of token ids.
+    """
+    width = min(before.shape[1], after.shape[1])
+    common = np.minimum(before_lengths, after_lengths)
+    inside = np.arange(width) < common[:, None]
+    changed = ((before[:, :width] != after[:, :width]) & inside).sum(axis=1)
+    return changed + np.abs(before_lengths - after_lengths)
+
+
+class Instrumentation:
+    def __init__(self, sample_rate: float = 1.0):
+        if not 0 < sample_rate <= 1:
+            raise ValueError(f"sample_rate must be in (0, 1], got {sample_rate}")
+        self.sample_rate = sample_rate
+        self.period = max(1, round(1 / sample_rate))
+        self._tick = 0
+        self.ops: List[OpStats] = []
+        self.augment_calls = 0
+
+    def bind(self, aug_ops: List[Any]):
+        """
+            Track the ops of a pipeline, keeping the counts of unchanged
+            ops.
+        """
+        old = {(s.index, s.name): s for s in self.ops}
+        self.ops = []
+        for i, op in enumerate(aug_ops):
+            name = type(op).__name__
+            stats = old.get((i, name))
+            if stats is None:
+                stats = OpStats(name, i, op)
+            stats.op = op
+            self.ops.append(stats)
+
+    def sample(self) -> bool:
+        """
+            Count an augment call and tell whether it is measured.
+        """
+        self.augment_calls += 1
+        self._tick += 1
+        if self._tick >= self.period:
+            self._tick = 0
+            return True
+        return False
+
+    def count(self, keep: Optional[Sequence[bool]] = None, k: int = 1):
+        """
+            Count `k` calls of every op kept by `keep` (all of them by
+            default), and `k` `pipeline_p` skips of the others.
+        """
+        if keep is None:
+            for stats in self.ops:
+                stats.calls += k
+            return
+        for stats, kept in zip(self.ops, keep):
+            if kept:
+                stats.calls += k
+            else:
+                stats.pipeline_skips += k
+
+    def record(self, index: int, seconds: float, attempted: int,
+               applied: int, k: int = 1):
+        """
+            Record `k` measured calls of op `index`, which applied
+            `applied` of the `attempted` edits in `seconds`.
+        """
+        stats = self.ops[index]
+        stats.sampled_calls += k
+        stats.sampled_seconds += seconds
+        stats.edits_attempted += attempted
+        stats.edits_applied += min(applied, attempted)
+
+    def reset(self):
+        for stats in self.ops:
+            for key in COUNTERS:
+                setattr(stats, key, 0)
+            stats.cache_hits = stats.cache_misses = 0
+            stats.cache_base = _cache_counts(stats.op)
+        self.augment_calls = 0
+
+    def pop_counts(self) -> Dict[str, Any]:
+        """
+            Return the raw counters and reset them, to be `merge`d into
+            the instrumentation of another process.
+        """
+        counts = {
+            "augment_calls": self.augment_calls,
+            "ops": [[getattr(s, key) for key in COUNTERS] for s in self.ops],
+            "caches": [s.pop_cache_counts() for s in self.ops],
+        }
+        self.reset()
+        return counts
+
+    def merge(self, counts: Dict[str, Any]):
+        self.augment_calls += counts["augment_calls"]
+        for stats, values in zip(self.ops, counts["ops"]):
+            for key, value in zip(COUNTERS, values):
+                setattr(stats, key, getattr(stats, key) + value)
+        for stats, (hits, misses) in zip(self.ops, counts.get("caches", [])):
+            stats.cache_hits += hits
+            stats.cache_misses += misses
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "sample_rate": self.sample_rate,
+            "augment_calls": self.augment_calls,
+            "ops": [stats.to_dict() for stats in self.ops],
+        }
+
+    def to_prometheus(self, prefix: str = "fastaug") -> str:
+        """
+            Export the metrics in the Prometheus text format.
+        """
+        metrics = [
+            ("calls_total", "counter", "calls", "calls of the op"),
+            ("pipeline_skips_total", "counter", "pipeline_skips",
+             "calls skipped by pipeline_p"),
+            ("seconds_total", "counter", "seconds",
+             "estimated wall time spent in the op"),
+            ("edits_applied_total", "counter", "edits_applied_est",
+             "estimated edits applied"),
+            ("edits_skipped_total", "counter", "edits_skipped_est",
+             "estimated edits which could not be applied"),
+            ("cache_hit_rate", "gauge", None,
+             "hit rate of the candidate cache of the op"),
+        ]
+        ops = [stats.to_dict() for stats in self.ops]
+        lines = [
+            f"# HELP {prefix}_augment_calls_total calls of augment",
+            f"# TYPE {prefix}_augment_calls_total counter",
+            f"{prefix}_augment_calls_total {self.augment_calls}",
+        ]
+        for name, kind, key, doc in metrics:
+            lines.append(f"# HELP {prefix}_op_{name} {doc}")
+            lines.append(f"# TYPE {prefix}_op_{name} {kind}")
+            for op in ops:
+                if key is None:
+                    if "cache" not in op:
+                        continue
+                    value = op["cache"]["hit_rate"]
+                else:
+                    value = op[key]
+                labels = f'op="{op["op"]}",index="{op["index"]}"'
+                lines.append(f"{prefix}_op_{name}{{{labels}}} {value:g}")
+        return "\n".join(lines) + "\n"
+
@@ -0,0 +1,584 @@
+"""
+    An asyncio augmentation server hosting named pipelines, over HTTP or
+    a Unix socket, so that services share one copy of the lexicons.
+
+        python -m fastaug.server --pipeline default=spec.json \\
+            --pipeline masks=masks.json --port 8000 --workers 4
+
+    Pipelines are JSON specs, see `fastaug.cli`. Endpoints:
+
+        POST /augment/NAME  {"texts": [...], "n": 1, "unique": false}
+                            -> {"results": [...]}
+        GET  /pipelines     -> {"pipelines": [...]}
+        GET  /metrics       Prometheus text
+        GET  /health
+
+    Concurrent requests to a pipeline are coalesced into micro-batches of
+    up to `max_batch` variants (texts times `n`), waiting at most
+    `max_delay` seconds after the first one; `n` is at most `MAX_N`.
+    Batches run on a pool of forked worker processes (the lexicons,
+    loaded before forking, are shared), at most one per worker at a time:
+    while workers are busy, requests queue up and form larger batches. Every batch is augmented with its own child stream of the
+    seed of its pipeline. See `fastaug.client.AugmentClient`.
+"""
+from typing import Any, Dict, List, Optional, Tuple
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import unquote
+import argparse
+import asyncio
+import json
+import multiprocessing as mp
+import os
+import time
+import numpy as np
+from .augmentor import Augmentor
+from .cli import build_augmentor
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+# the texts, n and unique of a request
+Job = Tuple[List[str], int, bool]
+MAX_BODY = 16 * 1024 * 1024
+MAX_N = 1024
+REASONS = {
+    200: "OK",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    413: "Payload Too Large",
+    500: "Internal Server Error",
+    503: "Service Unavailable",
+}
+
+
+class HTTPError(Exception):
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class Histogram:
+    """
+        A Prometheus-style cumulative histogram.
+    """
+    def __init__(self, buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """
+            Upper bound of the bucket holding the `q` quantile.
+        """
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"), ), self.counts):
+            seen += count
+            if seen >= rank and seen > 0:
+                return bound
+        return 0.0
+
+    def lines(self, name: str, labels: str) -> List[str]:
+        ret = []
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"), ), self.counts):
+            seen += count
+            le = "+Inf" if bound == float("inf") else f"{bound:g}"
+            ret.append(f'{name}_bucket{{{labels},le="{le}"}} {seen}')
+        ret.append(f"{name}_sum{{{labels}}} {self.sum:g}")
+        ret.append(f"{name}_count{{{labels}}} {self.count}")
+        return ret
+
+
+class _Request:
+    __slots__ = ("texts", "n", "unique", "future", "arrival", "size")
+
+    def __init__(self, texts: List[str], n: int, unique: bool,
+                 future: asyncio.Future):
+        self.texts = texts
+        self.n = n
+        self.unique = unique
+        self.future = future
+        self.arrival = time.perf_counter()
+        # the load of a request is the number of variants it asks for
+        self.size = len(texts) * n
+
+
+class Batcher:
+    """
+        Coalesces the requests to one pipeline into micro-batches.
+    """
+    def __init__(self, name: str, augmentor: Augmentor,
+                 server: "AugmentServer"):
+        self.name = name
+        self.augmentor = augmentor
+        self.server = server
+        self.queue = deque()
+        self.queued = 0
+        self.running = 0
+        self.requests = 0
+        self.sentences = 0
+        self.batches = 0
+        self.rejected = 0
+        self.errors = 0
+        self.latency = Histogram()
+        self.batch_seconds = Histogram()
+        self.batch_sizes = Histogram((1, 2, 4, 8, 16, 32, 64, 128, 256, 512,
+                                      1024, 2048, 4096))
+        self._wakeup = asyncio.Event()
+
+    async def submit(self, texts: List[str], n: int = 1,
+                     unique: bool = False) -> list:
+        server = self.server
+        future = asyncio.get_running_loop().create_future()
+        request = _Request(texts, n, unique, future)
+        if request.size > server.max_queue:
+            self.rejected += 1
+            raise HTTPError(
+                413, f"{request.size} variants requested, the queue of "
+                f"pipeline {self.name!r} holds {server.max_queue}")
+        if self.queued + request.size > server.max_queue:
+            self.rejected += 1
+            raise HTTPError(503, f"queue of pipeline {self.name!r} is full")
+        self.queue.append(request)
+        self.queued += request.size
+        self._wakeup.set()
+        try:
+            return await future
+        finally:
+            self.requests += 1
+            self.latency.observe(time.perf_counter() - request.arrival)
+
+    async def run(self):
+        server = self.server
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            if not self.queue:
+                continue
+            # a full batch or the deadline of the oldest request
+            deadline = self.queue[0].arrival + server.max_delay
+            while self.queued < server.max_batch:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), remaining)
+                except asyncio.TimeoutError:
+                    break
+                self._wakeup.clear()
+            # requests keep queuing while all the workers are busy
+            await server.slots.acquire()
+            batch = [self.queue.popleft()]
+            size = batch[0].size
+            while self.queue and size + self.queue[0].size <= server.max_batch:
+                batch.append(self.queue.popleft())
+                size += batch[-1].size
+            self.queued -= size
+            if self.queue:
+                self._wakeup.set()
+            self.running += size
+            asyncio.ensure_future(self._dispatch(batch, size))
+
+    async def _dispatch(self, batch: List[_Request], size: int):
+        jobs = [(r.texts, r.n, r.unique) for r in batch]
+        seed = self.augmentor.seed_seq.spawn(1)[0]
+        start = time.perf_counter()
+        try:
+            if self.server.executor is None:
+                results = _augment_requests(self.augmentor, jobs, seed)
+            else:
+                results = await asyncio.get_running_loop().run_in_executor(
+                    self.server.executor, _augment_worker_requests,
+                    self.name, jobs, seed)
+        except Exception as e:
+            self.errors += 1
+            for request in batch:
+                if not request.future.done():
+                    request.future.set_exception(e)
+        else:
+            for request, result in zip(batch, results):
+                if request.future.done():
+                    continue
+                if isinstance(result, Exception):
+                    self.errors += 1
+                    request.future.set_exception(result)
+                else:
+                    request.future.set_result(result)
+        finally:
+            self.batches += 1
+            self.sentences += sum(len(r.texts) for r in batch)
+            self.running -= size
+            self.batch_sizes.observe(size)
+            self.batch_seconds.observe(time.perf_counter() - start)
+            self.server.slots.release()
+
+
+class AugmentServer:
+    """
+        Serves `pipelines` ({name: Augmentor}) on `workers` processes (all
+        cores by default, 0 augments in the event loop). At most
+        `max_queue` variants wait per pipeline, more are rejected with a
+        503.
+    """
+    def __init__(self,
+                 pipelines: Dict[str, Augmentor],
+                 workers: Optional[int] = None,
+                 max_batch: int = 256,
+                 max_delay: float = 0.005,
+                 max_queue: int = 65536):
+        if workers is None:
+            workers = os.cpu_count() or 1
+        self.pipelines = pipelines
+        self.workers = workers
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.max_queue = max_queue
+        self.executor = None
+        self.batchers: Dict[str, Batcher] = {}
+        self._servers = []
+        self._tasks = []
+
+    async def start(self,
+                    host: str = "127.0.0.1",
+                    port: Optional[int] = 8000,
+                    unix_path: Optional[str] = None):
+        """
+            Listen on `unix_path` if given, else on `host:port`.
+        """
+        if self.workers > 0:
+            # fork shares the already loaded lexicons with the workers
+            if "fork" in mp.get_all_start_methods():
+                ctx = mp.get_context("fork")
+            else:
+                ctx = mp.get_context()
+            self.executor = ProcessPoolExecutor(self.workers,
+                                                mp_context=ctx,
+                                                initializer=_init_worker,
+                                                initargs=(self.pipelines, ))
+        self.slots = asyncio.Semaphore(max(1, self.workers))
+        for name, augmentor in self.pipelines.items():
+            batcher = Batcher(name, augmentor, self)
+            self.batchers[name] = batcher
+            self._tasks.append(asyncio.ensure_future(batcher.run()))
+        if unix_path is not None:
+            server = await asyncio.start_unix_server(self._handle, unix_path)
+        else:
+            server = await asyncio.start_server(self._handle, host, port)
+        self._servers.append(server)
+        return server
+
+    async def close(self):
+        for server in self._servers:
+            server.close()
+            await server.wait_closed()
+        for task in self._tasks:
+            task.cancel()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def _handle(self, reader: asyncio.StreamReader,
+                      writer: asyncio.StreamWriter):
+        try:
+            while True:
+                try:
+                    request = await _read_request(reader)
+                except HTTPError as e:
+                    await _respond(writer, e.status, {"error": str(e)}, False)
+                    await _discard(reader)
+                    return
+                if request is None:
+                    return
+                method, path, headers, body = request
+                keep_alive = headers.get("connection", "").lower() != "close"
+                try:
+                    status, payload = 200, await self.route(method, path, body)
+                except HTTPError as e:
+                    status, payload = e.status, {"error": str(e)}
+                except Exception as e:
+                    status, payload = 500, {"error": f"{type(e).__name__}: {e}"}
+                await _respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    return
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def route(self, method: str, path: str, body: bytes) -> Any:
+        if path.startswith("/augment/"):
+            if method != "POST":
+                raise HTTPError(405, "use POST")
+            name = unquote(path[len("/augment/"):])
+            if name not in self.batchers:
+                raise HTTPError(404, f"unknown pipeline {name!r}")
+            texts, n, unique = _parse_augment(body)
+            results = await self.batchers[name].submit(texts, n, unique)
+            return {"results": results}
+        if method != "GET":
+            raise HTTPError(405, "use GET")
+        if path == "/pipelines":
+            return {"pipelines": list(self.pipelines)}
+        if path == "/metrics":
+            return self.metrics_text()
+        if path == "/health":
+            return {"status": "ok"}
+        raise HTTPError(404, f"no route for {path}")
+
+    def stats(self) -> Dict[str, Any]:
+        ret = {}
+        for name, b in self.batchers.items():
+            ret[name] = {
+                "queued": b.queued,
+                "running": b.running,
+                "requests": b.requests,
+                "sentences": b.sentences,
+                "batches": b.batches,
+                "rejected": b.rejected,
+                "errors": b.errors,
+                "mean_batch_size": b.batch_sizes.sum / max(1, b.batches),
+                "latency_p50": b.latency.quantile(0.5),
+                "latency_p99": b.latency.quantile(0.99),
+            }
+        return ret
+
+    def metrics_text(self, prefix: str = "fastaug_server") -> str:
+        """
+            Queue depths, counters and latency histograms of every
+            pipeline in the Prometheus text format.
+        """
+        gauges = [("queued_variants", "gauge", "queued",
+                   "variants waiting for a batch"),
+                  ("running_variants", "gauge", "running",
+                   "variants of the batches being augmented"),
+                  ("requests_total", "counter", "requests", "requests served"),
+                  ("sentences_total", "counter", "sentences",
+                   "sentences augmented"),
+                  ("batches_total", "counter", "batches", "batches run"),
+                  ("rejected_total", "counter", "rejected",
+                   "requests rejected by a full queue"),
+                  ("errors_total", "counter", "errors", "failed batches")]
+        lines = []
+        for name, kind, attr, doc in gauges:
+            lines.append(f"# HELP {prefix}_{name} {doc}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            for pipeline, b in self.batchers.items():
+                lines.append(f'{prefix}_{name}{{pipeline="{pipeline}"}} '
+                             f"{getattr(b, attr)}")
+        histograms = [("request_latency_seconds", "latency",
+                       "time from arrival to response"),
+                      ("batch_seconds", "batch_seconds",
+                       "time to augment a batch"),
+                      ("batch_size", "batch_sizes", "variants per batch")]
+        for name, attr, doc in histograms:
+            lines.append(f"# HELP {prefix}_{name} {doc}")
+            lines.append(f"# TYPE {prefix}_{name} histogram")
+            for pipeline, b in self.batchers.items():
+                lines.extend(
+                    getattr(b, attr).lines(f"{prefix}_{name}",
+                                           f'pipeline="{pipeline}"'))
+        return "\n".join(lines) + "\n"
+
+
+def _parse_augment(body: bytes) -> Tuple[List[str], int, bool]:
+    try:
+        payload = json.loads(body or b"{}")
+    except ValueError as e:
+        raise HTTPError(400, f"invalid JSON: {e}")
+    if not isinstance(payload, dict):
+        raise HTTPError(400, "expected a JSON object")
+    texts = payload.get("texts")
+    if texts is None and "text" in payload:
+        texts = [payload["text"]]
+    if not isinstance(texts, list) or not all(
+            isinstance(text, str) for text in texts):
+        raise HTTPError(400, "texts must be a list of strings")
+    n = payload.get("n", 1)
+    if not isinstance(n, int) or isinstance(n, bool) or not 1 <= n <= MAX_N:
+        raise HTTPError(400, f"n must be an integer in [1, {MAX_N}]")
+    return texts, n, bool(payload.get("unique", False))
+
+
+async def _read_line(reader: asyncio.StreamReader) -> bytes:
+    try:
+        return await reader.readline()
+    except (asyncio.LimitOverrunError, ValueError):
+        # readline raises ValueError past the limit of the stream
+        raise HTTPError(413, "request line or header too long")
+
+
+async def _discard(reader: asyncio.StreamReader, timeout: float = 1.0):
+    """
+        Read what is left of a rejected request for up to `timeout`
+        seconds, so that closing with unread data does not reset the
+        connection before the client reads the error.
+    """
+    async def drain():
+        while await reader.read(65536):
+            pass
+
+    try:
+        await asyncio.wait_for(drain(), timeout)
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+
+
+async def _read_request(reader: asyncio.StreamReader):
+    line = await _read_line(reader)
+    if not line:
+        return None
+    try:
+        method, target, _ = line.decode("latin-1").split(" ", 2)
+    except ValueError:
+        raise HTTPError(400, "malformed request line")
+    headers = {}
+    while True:
+        line = await _read_line(reader)
+        if line in (b"\r\n", b"\n", b""):
+            break
+        key, _, value = line.decode("latin-1").partition(":")
+        headers[key.strip().lower()] = value.strip()
+    try:
+        length = int(headers.get("content-length", 0) or 0)
+    except ValueError:
+        raise HTTPError(400, "invalid Content-Length")
+    if length < 0:
+        raise HTTPError(400, "invalid Content-Length")
+    if length > MAX_BODY:
+        raise HTTPError(413, f"body larger than {MAX_BODY} bytes")
+    body = await reader.readexactly(length) if length else b""
+    return method.upper(), target.split("?", 1)[0], headers, body
+
+
+async def _respond(writer: asyncio.StreamWriter, status: int, payload: Any,
+                   keep_alive: bool):
+    if isinstance(payload, str):
+        body = payload.encode("utf-8")
+        content_type = "text/plain; version=0.0.4; charset=utf-8"
+    else:
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        content_type = "application/json"
+    head = (f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+            f"Content-Type: {content_type}\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+    writer.write(head.encode("latin-1") + body)
+    await writer.drain()
+
+
+def _augment_requests(augmentor: Augmentor, jobs: List[Job],
+                      seed: np.random.SeedSequence) -> list:
+    """
+        The results of `jobs`, or the exception a job raised in its place,
+        so that a failing request does not fail its whole batch.
+    """
+    augmentor.seed(seed)
+    results = []
+    for texts, n, unique in jobs:
+        try:
+            if unique:
+                results.append(
+                    [augmentor.augment_unique(t, n) for t in texts])
+            else:
+                results.append([augmentor.augment(t, n) for t in texts])
+        except Exception as e:
+            results.append(e)
+    return results
+
+
+# The pipelines of a worker process, set once when the worker starts
+_worker_pipelines = None
+
+
+def _init_worker(pipelines: Dict[str, Augmentor]):
+    global _worker_pipelines
+    _worker_pipelines = pipelines
+
+
+def _augment_worker_requests(name: str, jobs: List[Job],
+                             seed: np.random.SeedSequence) -> list:
+    return _augment_requests(_worker_pipelines[name], jobs, seed)
+
+
+def load_pipelines(items: List[str]) -> Dict[str, Augmentor]:
+    """
+        Build pipelines from "NAME=SPEC.json" items.
+    """
+    pipelines = {}
+    for item in items:
+        name, sep, path = item.partition("=")
+        if not sep:
+            raise ValueError(f"expected NAME=SPEC.json, got {item!r}")
+        with open(path, "r") as f:
+            pipelines[name] = build_augmentor(json.load(f))
+    return pipelines
+
+
+async def serve(server: AugmentServer,
+                host: str = "127.0.0.1",
+                port: int = 8000,
+                unix_path: Optional[str] = None):
+    listening = await server.start(host, port, unix_path)
+    try:
+        await listening.serve_forever()
+    finally:
+        await server.close()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(
+        prog="python -m fastaug.server",
+        description="Serve augmentation pipelines over HTTP.")
+    parser.add_argument("--pipeline",
+                        action="append",
+                        required=True,
+                        help="NAME=SPEC.json, may be repeated")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--unix", default=None, help="listen on this socket")
+    parser.add_argument("--workers",
+                        type=int,
+                        default=None,
+                        help="worker processes, all cores by default, 0 to "
+                        "augment in the event loop")
+    parser.add_argument("--max-batch",
+                        type=int,
+                        default=256,
+                        help="variants (texts times n) per batch")
+    parser.add_argument("--max-delay-ms",
+                        type=float,
+                        default=5.0,
+                        help="how long the first request of a batch waits "
+                        "for others")
+    parser.add_argument("--max-queue",
+                        type=int,
+                        default=65536,
+                        help="variants waiting per pipeline")
+    args = parser.parse_args(argv)
+    try:
+        pipelines = load_pipelines(args.pipeline)
+    except (OSError, TypeError, ValueError, KeyError) as e:
+        parser.error(f"invalid pipeline: {e}")
+    server = AugmentServer(pipelines,
+                           workers=args.workers,
+                           max_batch=args.max_batch,
+                           max_delay=args.max_delay_ms / 1000,
+                           max_queue=args.max_queue)
+    try:
+        asyncio.run(serve(server, args.host, args.port, args.unix))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
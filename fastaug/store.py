@@ -0,0 +1,224 @@
+"""
+    Precomputed augmentations for multi-epoch training: `k` variants of
+    every example, materialized once into a memory-mapped store.
+
+        out_dir/meta.json                  -- k, encoding, shards
+        out_dir/shard-NNNNN.offsets.npy    -- n * k + 1 int64 offsets
+        out_dir/shard-NNNNN.data.npy       -- packed UTF-8 (uint8) or
+                                              token ids (int32)
+
+    Variant `j` of example `i` is `data[offsets[i * k + j]:offsets[i * k +
+    j + 1]]` in the shard holding `i`, so reading it costs a slice of a
+    memory map. Shards are written atomically and `meta.json` is updated
+    after each of them: building an existing store resumes after its last
+    full shard (or appends new examples). Shard `s` is augmented with the
+    child `s` of the seed of the augmentor, so a resumed build of a seeded
+    augmentor gives the same store as a single one.
+
+        python -m fastaug.store corpus.txt out_dir --spec spec.json -k 8
+"""
+from typing import Callable, Iterable, List, Optional, Union
+from bisect import bisect_right
+from itertools import islice
+from pathlib import Path
+import argparse
+import json
+import os
+import numpy as np
+from .augmentor import Augmentor
+
+
+class AugmentationStore:
+    def __init__(self, path: Union[str, Path]):
+        self.path = Path(path)
+        with open(self.path / "meta.json", "r") as f:
+            self.meta = json.load(f)
+        self.k = self.meta["k"]
+        self.encoding = self.meta["encoding"]
+        self.starts = [0]
+        self.offsets = []
+        self.data = []
+        for name, n in self.meta["shards"]:
+            self.offsets.append(
+                np.load(self.path / f"{name}.offsets.npy", mmap_mode="r"))
+            self.data.append(
+                np.load(self.path / f"{name}.data.npy", mmap_mode="r"))
+            self.starts.append(self.starts[-1] + n)
+
+    @staticmethod
+    def load(path: Union[str, Path]) -> "AugmentationStore":
+        return AugmentationStore(path)
+
+    def __len__(self) -> int:
+        return self.starts[-1]
+
+    def variant(self, i: int, j: int) -> Union[str, np.ndarray]:
+        """
+            Variant `j` (in `[0, k)`) of example `i`: a string, or an array
+            of token ids.
+        """
+        if not 0 <= i < len(self):
+            raise IndexError(f"example {i} out of range")
+        if not 0 <= j < self.k:
+            raise IndexError(f"variant {j} out of range")
+        s = bisect_right(self.starts, i) - 1
+        row = (i - self.starts[s]) * self.k + j
+        offsets = self.offsets[s]
+        chunk = self.data[s][offsets[row]:offsets[row + 1]]
+        if self.encoding == "utf8":
+            return chunk.tobytes().decode("utf-8")
+        return np.asarray(chunk)
+
+    def __getitem__(self, i: int) -> List[Union[str, np.ndarray]]:
+        return [self.variant(i, j) for j in range(self.k)]
+
+    def get(self, i: int, epoch: int) -> Union[str, np.ndarray]:
+        """
+            The variant of example `i` seen at `epoch`, cycling through
+            the `k` variants.
+        """
+        return self.variant(i, epoch % self.k)
+
+    def __getstate__(self):
+        return str(self.path)
+
+    def __setstate__(self, path):
+        self.__init__(path)
+
+
+def _write_shard(out_dir: Path, name: str, variants: List[List[str]],
+                 encode: Optional[Callable[[str], List[int]]]):
+    if encode is None:
+        chunks = [v.encode("utf-8") for vs in variants for v in vs]
+        data = np.frombuffer(b"".join(chunks), dtype=np.uint8)
+    else:
+        chunks = [encode(v) for vs in variants for v in vs]
+        data = np.fromiter((t for ids in chunks for t in ids),
+                           dtype=np.int32)
+    offsets = np.zeros(len(chunks) + 1, dtype=np.int64)
+    np.cumsum([len(c) for c in chunks], out=offsets[1:])
+    for suffix, arr in (("offsets", offsets), ("data", data)):
+        # np.save appends .npy to the tmp name
+        tmp = out_dir / f"{name}.{suffix}.tmp{os.getpid()}"
+        np.save(tmp, arr)
+        os.replace(f"{tmp}.npy", out_dir / f"{name}.{suffix}.npy")
+
+
+def _write_meta(out_dir: Path, meta: dict):
+    tmp = out_dir / f"meta.json.tmp{os.getpid()}"
+    with open(tmp, "w") as f:
+        json.dump(meta, f)
+    os.replace(tmp, out_dir / "meta.json")
+
+
+def _fill(variants: List[str], sent: str, k: int) -> List[str]:
+    """
+        Complete fewer than `k` unique variants by cycling through them.
+    """
+    if not variants:
+        return [sent] * k
+    return [variants[j % len(variants)] for j in range(k)]
+
+
+def build_store(out_dir: Union[str, Path],
+                augmentor: Augmentor,
+                sents: Iterable[str],
+                k: int,
+                shard_size: int = 65536,
+                num_workers: Optional[int] = None,
+                chunk_size: int = 256,
+                unique: bool = False,
+                encode: Optional[Callable[[str], List[int]]] = None
+                ) -> AugmentationStore:
+    """
+        Augment every sentence of `sents` into `k` variants and store them
+        in `out_dir`, `shard_size` examples per shard (that of the store
+        when it exists), on `num_workers`
+        processes (see `Augmentor.augment_corpus`). With `unique`, the
+        variants are those of `augment_unique`, cycled when fewer than `k`
+        were found. With `encode` (e.g. the tokenizer of a model), the
+        variants are stored as int32 token ids.
+
+        If `out_dir` already holds a store, the sentences it covers are
+        skipped and the others appended.
+    """
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    encoding = "utf8" if encode is None else "ids"
+    meta = {
+        "k": k,
+        "encoding": encoding,
+        "shard_size": shard_size,
+        "shards": []
+    }
+    if (out_dir / "meta.json").exists():
+        with open(out_dir / "meta.json", "r") as f:
+            meta = json.load(f)
+        if (meta["k"], meta["encoding"]) != (k, encoding):
+            raise ValueError(
+                f"{out_dir} holds a store with k={meta['k']} and encoding "
+                f"{meta['encoding']}, not k={k} and encoding {encoding}")
+        shard_size = meta["shard_size"]
+        # a partial last shard is rebuilt, shards keep their boundaries
+        if meta["shards"] and meta["shards"][-1][1] < shard_size:
+            meta["shards"].pop()
+    done = sum(n for _, n in meta["shards"])
+    it = islice(iter(sents), done, None)
+    base = augmentor.seed_seq
+    worker = augmentor._clone()
+    while True:
+        shard = list(islice(it, shard_size))
+        if not shard:
+            break
+        index = len(meta["shards"])
+        worker.seed(
+            np.random.SeedSequence(base.entropy,
+                                   spawn_key=base.spawn_key + (index, )))
+        variants = worker.augment_corpus(shard,
+                                         n=k,
+                                         num_workers=num_workers,
+                                         chunk_size=chunk_size,
+                                         unique=unique)
+        if unique:
+            variants = [_fill(vs, s, k) for vs, s in zip(variants, shard)]
+        elif k == 1:
+            variants = [[v] for v in variants]
+        name = f"shard-{index:05d}"
+        _write_shard(out_dir, name, list(variants), encode)
+        meta["shards"].append([name, len(shard)])
+        _write_meta(out_dir, meta)
+    _write_meta(out_dir, meta)
+    return AugmentationStore(out_dir)
+
+
+if __name__ == "__main__":
+    from .cli import build_augmentor, parse_ops
+    parser = argparse.ArgumentParser(
+        description="Precompute k augmentations of every line of a file.")
+    parser.add_argument("input", help="one sentence per line")
+    parser.add_argument("out_dir")
+    pipeline = parser.add_mutually_exclusive_group(required=True)
+    pipeline.add_argument("--ops", help="NAME:AUG_P,NAME:AUG_P,...")
+    pipeline.add_argument("--spec", help="a JSON pipeline spec file")
+    parser.add_argument("-k", type=int, default=8, help="variants per line")
+    parser.add_argument("--seed", type=int, default=None)
+    parser.add_argument("--shard-size", type=int, default=65536)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--unique", action="store_true")
+    args = parser.parse_args()
+    if args.spec is not None:
+        with open(args.spec, "r") as f:
+            spec = json.load(f)
+    else:
+        spec = {"ops": parse_ops(args.ops)}
+    if args.seed is not None:
+        spec["seed"] = args.seed
+    with open(args.input, "r", encoding="utf-8") as f:
+        store = build_store(args.out_dir,
+                            build_augmentor(spec),
+                            (line.rstrip("\r\n") for line in f),
+                            args.k,
+                            shard_size=args.shard_size,
+                            num_workers=args.workers,
+                            unique=args.unique)
+    print(f"{len(store)} x {store.k} variants stored in {args.out_dir}")
@@ -1,12 +1,26 @@
-from os import terminal_size
-from typing import List
+from typing import List, Optional, Tuple
 import re
 from functools import lru_cache
+from itertools import accumulate
 import unicodedata
 
 SPACE_NORMALIZER = re.compile(r"\s+")
 # PUNCTUATION_PATTERN = re.compile(r"([\[\]\"'“”(),.!?@#$%&+\-–:;…])")
 
+CJK_RANGES = (
+    (0x4E00, 0x9FFF),
+    (0x3400, 0x4DBF),
+    (0x20000, 0x2A6DF),
+    (0x2A700, 0x2B73F),
+    (0x2B740, 0x2B81F),
+    (0x2B820, 0x2CEAF),
+    (0xF900, 0xFAFF),
+    (0x2F800, 0x2FA1F),
+)
+MODES = ("space", "better")
+
+Span = Tuple[int, int]
+
 
 def tokenize(sent) -> List[str]:
     sent = SPACE_NORMALIZER.sub(" ", sent)
@@ -14,8 +28,106 @@ def tokenize(sent) -> List[str]:
     return sent.split()
 
 
-def detokenize(tokens: List[str]) -> str:
-    return " ".join(tokens)
+def detokenize(tokens: List[str],
+               orig: Optional[List[str]] = None,
+               gaps: Optional[List[str]] = None) -> str:
+    """
+        Join `tokens` with single spaces or, given the `orig` tokens and
+        the `gaps` between them (see `tokenize_with_spacing`), with the
+        original spacing: every token keeps the whitespace which preceded
+        it, and tokens are realigned with the original ones when some were
+        deleted or inserted.
+    """
+    if gaps is None:
+        return " ".join(tokens)
+    if len(tokens) == len(orig):
+        ret = [gap + token for gap, token in zip(gaps, tokens)]
+        ret.append(gaps[-1])
+        return "".join(ret)
+
+    n_orig, n_tokens = len(orig), len(tokens)
+    ret = []
+    j = 0
+    for i, token in enumerate(tokens):
+        # original tokens which may still have been deleted before this one
+        budget = (n_orig - j) - (n_tokens - i)
+        k = j
+        while k <= j + budget and orig[k] != token:
+            k += 1
+        if k <= j + budget:
+            if gaps[k] or _is_punctuation(token[:1]):
+                ret.append(gaps[k])
+            else:
+                ret.append(gaps[j])
+            j = k + 1
+        elif j < n_orig:
+            ret.append(gaps[j])
+            if budget >= 0:
+                j += 1
+        else:
+            ret.append(" " if ret else "")
+        ret.append(token)
+    if ret:
+        # the text starts with its leading whitespace, not with the gap
+        # before the first token kept
+        ret[0] = gaps[0]
+    ret.append(gaps[-1])
+    return "".join(ret)
+
+
+def tokenize_with_spacing(text: str,
+                          mode: str = "space",
+                          lower: bool = False
+                          ) -> Tuple[List[str], List[str]]:
+    """
+        Return the tokens of `text` and the `len(tokens) + 1` gaps around
+        them, `text` being `gaps[0] + tokens[0] + gaps[1] + ... + gaps[-1]`.
+        "space" splits on whitespace like `tokenize`, "better" also splits
+        off punctuation and every CJK character like `better_tokenize`.
+    """
+    parts = _split_pattern(mode).split(text)
+    tokens = parts[1::2]
+    if lower:
+        tokens = [token.lower() for token in tokens]
+    return tokens, parts[0::2]
+
+
+def tokenize_with_offsets(text: str,
+                          mode: str = "space",
+                          lower: bool = False
+                          ) -> Tuple[List[str], List[Span]]:
+    """
+        Return the tokens of `text` and their `(start, end)` character
+        offsets, see `tokenize_with_spacing`.
+    """
+    parts = _split_pattern(mode).split(text)
+    ends = list(accumulate(map(len, parts)))
+    tokens = parts[1::2]
+    if lower:
+        tokens = [token.lower() for token in tokens]
+    return tokens, list(zip(ends[0::2], ends[1::2]))
+
+
+def spacing(text: str, spans: List[Span]) -> List[str]:
+    """
+        The gaps around the tokens at `spans` in `text`.
+    """
+    gaps = []
+    end = 0
+    for start, stop in spans:
+        gaps.append(text[end:start])
+        end = stop
+    gaps.append(text[end:])
+    return gaps
+
+
+@lru_cache(maxsize=None)
+def _split_pattern(mode: str):
+    if mode == "space":
+        return re.compile(r"(\S+)")
+    elif mode == "better":
+        return re.compile(f"({_better_pattern().pattern})")
+    raise ValueError(f"mode must be one of {MODES}, got {mode}")
 
 
 # def better_tokenize(sent) -> List[str]:
@@ -23,29 +135,60 @@ def detokenize(tokens: List[str]) -> str:
 
 
 def better_tokenize(text, lower=False):
+    """
+        Split on whitespace, punctuation characters and CJK characters,
+        which are all single-character tokens, as are the characters out
+        of the BMP (emojis, CJK extensions...).
+
+        Up to version 20201121, whitespace did not separate tokens (it was
+        kept inside them), CJK characters were dropped and astral
+        characters were part of words.
+    """
     if lower:
         text = text.lower()
-    start_new_word = True
-    output = []
-    for char in text:
-        if _is_chinese_char(char):
-            continue
-        elif _is_punctuation(char):
-            output.append([char])
-            start_new_word = True
+    return _better_pattern().findall(text)
+
+
+@lru_cache(maxsize=None)
+def _better_pattern():
+    # Words are runs of characters which are neither spaces, punctuation
+    # nor CJK; any other character is a token of its own. The classes are
+    # restricted to the BMP, large astral ranges make sre much slower, so
+    # astral characters (CJK extensions, emojis...) are single tokens.
+    puncts = [
+        cp for cp in range(33, 0x10000)
+        if _is_punctuation.__wrapped__(chr(cp))
+    ]
+    cjks = [(lo, hi) for lo, hi in sorted(CJK_RANGES) if hi < 0x10000]
+    excluded = _char_class(_ranges(puncts) + cjks)
+    return re.compile(f"[^\\s{excluded}\U00010000-\U0010FFFF]+|\\S")
+
+
+def _ranges(cps: List[int]) -> List[Span]:
+    ranges = []
+    for cp in cps:
+        if ranges and ranges[-1][1] == cp - 1:
+            ranges[-1][1] = cp
         else:
-            if start_new_word:
-                output.append([])
-            start_new_word = False
-            output[-1].append(char)
-            
-    ret = ["".join(x) for x in output]
-    return ret
+            ranges.append([cp, cp])
+    return ranges
+
+
+def _char_class(ranges) -> str:
+    ret = []
+    for lo, hi in ranges:
+        if lo == hi:
+            ret.append(re.escape(chr(lo)))
+        else:
+            ret.append(f"{re.escape(chr(lo))}-{re.escape(chr(hi))}")
+    return "".join(ret)
 
 
 @lru_cache(maxsize=None)
 def _is_punctuation(char):
     """Checks whether `chars` is a punctuation character."""
+    if not char:
+        return False
     cp = ord(char)
     # We treat all non-letter/number ASCII as punctuation.
     # Characters such as "^", "$", and "`" are not in the Unicode
@@ -60,7 +203,6 @@ def _is_punctuation(char):
     return False
 
 
-@lru_cache(maxsize=None)
 def _is_chinese_char(char):
     """Checks whether CP is the codepoint of a CJK character."""
     # This defines a "chinese character" as anything in the CJK Unicode block:
@@ -72,14 +214,4 @@ def _is_chinese_char(char):
     # space-separated words, so they are not treated specially and handled
     # like the all of the other languages.
     cp = ord(char)
-    if ((cp >= 0x4E00 and cp <= 0x9FFF) or  #
-        (cp >= 0x3400 and cp <= 0x4DBF) or  #
-        (cp >= 0x20000 and cp <= 0x2A6DF) or  #
-        (cp >= 0x2A700 and cp <= 0x2B73F) or  #
-        (cp >= 0x2B740 and cp <= 0x2B81F) or  #
-        (cp >= 0x2B820 and cp <= 0x2CEAF) or
-        (cp >= 0xF900 and cp <= 0xFAFF) or  #
-        (cp >= 0x2F800 and cp <= 0x2FA1F)):  #
-        return True
-
-    return False
+    return any(lo <= cp <= hi for lo, hi in CJK_RANGES)
@@ -1,11 +1,19 @@
 import importlib_resources
+import hashlib
 import random
-import os, urllib, zipfile, tarfile, requests
+import os
+import tempfile
 from pathlib import Path
 from functools import lru_cache
-from typing import Union, Callable, Dict
-import torch
-import tabulate
+from typing import Union, Callable, Dict, List, Optional, TYPE_CHECKING
+from urllib.parse import urlsplit
+import numpy as np
+
+# torch, urllib and the archive modules are heavy and only needed by
+# DownloadUtil/EmbeddingNbrUtil, they are imported on first use
+if TYPE_CHECKING:
+    import torch
+    from .embedding import EmbeddingStore
 
 
 def load_resource(path: str):
@@ -17,37 +25,177 @@ def randint(a, b):
 
 
 def cache_dir(dest_dir):
-    return Path(os.environ['HOME']).expanduser() / ".cache" / "fastaug" / dest_dir
+    """
+        `~/.cache/fastaug/dest_dir`, created if needed. Without a home, or
+        when it is not writable, a directory of the temp dir is used.
+    """
+    home = os.path.expanduser("~")
+    if home != "~":
+        path = Path(home) / ".cache" / "fastaug" / dest_dir
+        try:
+            path.mkdir(parents=True, exist_ok=True)
+            if os.access(path, os.W_OK):
+                return path
+        except OSError:
+            pass
+    path = Path(tempfile.gettempdir()) / "fastaug-cache" / dest_dir
+    path.mkdir(parents=True, exist_ok=True)
+    return path
+
+
+COUNTER_FITTING_URL = "https://raw.githubusercontent.com/nmrksic/counter-fitting/master/word_vectors/glove.txt.zip"
+CHUNK_SIZE = 1 << 20
 
 
 class DownloadUtil:
     @staticmethod
-    def download_counter_fitting_if_not_exists():
-        if not cache_dir("counter-fitting").exists():
-            url = 'https://raw.githubusercontent.com/nmrksic/counter-fitting/master/word_vectors/glove.txt.zip'
+    def download_counter_fitting_if_not_exists(url: str = COUNTER_FITTING_URL,
+                                               sha256: Optional[str] = None):
+        """
+            Download the counter-fitted vectors into the cache and extract
+            glove.txt from the archive, which is removed afterwards.
+        """
+        out_dir = cache_dir("counter-fitting")
+        txt_path = out_dir / "glove.txt"
+        if not txt_path.exists():
             print(f"Downloading from {url}")
-            file_path = DownloadUtil.download(
-                url, dest_dir=str(cache_dir("counter-fitting")))
-            print("Unzip...")
-            DownloadUtil.unzip(file_path)
+            file_path = DownloadUtil.download(url,
+                                              dest_dir=str(out_dir),
+                                              sha256=sha256)
+            print("Extracting glove.txt...")
+            DownloadUtil.extract_member(file_path, "glove.txt")
+            os.remove(file_path)
         else:
             print("File exists...")
-        return cache_dir("counter-fitting") / "glove.txt"
+        return txt_path
 
     @staticmethod
-    def download(src, dest_dir, dest_file=None):
-        if not os.path.exists(dest_dir):
-            os.makedirs(dest_dir)
-
+    def download(src: str,
+                 dest_dir: str,
+                 dest_file: Optional[str] = None,
+                 sha256: Optional[str] = None,
+                 chunk_size: int = CHUNK_SIZE,
+                 retries: int = 3,
+                 timeout: float = 60.0) -> str:
+        """
+            Download `src` into `dest_dir` by chunks, so memory stays flat
+            whatever the size of the file. Data goes to a ".part" file
+            first: interrupted downloads resume from it with a range
+            request (up to `retries` times in a row, and on the next call).
+            When `sha256` is given, the file is verified before being
+            atomically renamed to its destination, and an existing file
+            that does not match is downloaded again.
+        """
+        os.makedirs(dest_dir, exist_ok=True)
         if dest_file is None:
-            dest_file = os.path.basename(src)
-
-        if not os.path.exists(dest_dir + dest_file):
+            dest_file = os.path.basename(urlsplit(src).path)
+        dest = os.path.join(dest_dir, dest_file)
+        if os.path.exists(dest):
+            if sha256 is None or file_sha256(dest) == sha256.lower():
+                return dest
+            os.remove(dest)
+
+        import http.client
+        import urllib.error
+        import urllib.request
+        part = dest + ".part"
+        failures = 0
+        while True:
+            done = os.path.getsize(part) if os.path.exists(part) else 0
             req = urllib.request.Request(src)
-            file = urllib.request.urlopen(req)
-            with open(os.path.join(dest_dir, dest_file), 'wb') as output:
-                output.write(file.read())
-        return os.path.join(dest_dir, dest_file)
+            if done:
+                req.add_header("Range", f"bytes={done}-")
+            try:
+                with urllib.request.urlopen(req, timeout=timeout) as resp:
+                    # servers ignoring the range send the whole file again
+                    mode = "ab" if resp.status == 206 else "wb"
+                    with open(part, mode) as output:
+                        while True:
+                            chunk = resp.read(chunk_size)
+                            if not chunk:
+                                break
+                            output.write(chunk)
+                    length = resp.headers.get("Content-Length")
+                    size = os.path.getsize(part)
+                    expected = int(length) + (done if mode == "ab" else 0) \
+                        if length is not None else size
+                    if size < expected:
+                        raise ConnectionError(
+                            f"incomplete download, {size} of {expected} bytes")
+                break
+            except urllib.error.HTTPError as e:
+                if e.code == 416 and done:
+                    # the part file is already complete
+                    break
+                raise
+            except (OSError, http.client.HTTPException) as e:
+                failures += 1
+                if failures > retries:
+                    raise
+                print(f"Download interrupted ({e}), resuming...")
+
+        if sha256 is not None:
+            digest = file_sha256(part)
+            if digest != sha256.lower():
+                os.remove(part)
+                raise ValueError(f"checksum mismatch for {src}: expected "
+                                 f"{sha256}, got {digest}")
+        os.replace(part, dest)
+        return dest
+
+    @staticmethod
+    def extract_member(archive: str,
+                       member: str,
+                       dest_dir: Optional[str] = None,
+                       sha256: Optional[str] = None,
+                       chunk_size: int = CHUNK_SIZE) -> str:
+        """
+            Stream the single `member` (a path or a basename) of a zip or
+            tar archive into `dest_dir` (the directory of the archive by
+            default), atomically, optionally verifying its checksum.
+            Returns the path of the extracted file.
+        """
+        import shutil
+        import tarfile
+        import zipfile
+
+        if dest_dir is None:
+            dest_dir = os.path.dirname(archive)
+        dest = os.path.join(dest_dir, os.path.basename(member))
+        tmp = f"{dest}.tmp{os.getpid()}"
+
+        def matches(name):
+            return name == member or os.path.basename(name) == member
+
+        try:
+            if zipfile.is_zipfile(archive):
+                with zipfile.ZipFile(archive) as zf:
+                    names = [n for n in zf.namelist() if matches(n)]
+                    if not names:
+                        raise KeyError(f"{member} not found in {archive}")
+                    with zf.open(names[0]) as src, open(tmp, "wb") as out:
+                        shutil.copyfileobj(src, out, chunk_size)
+            else:
+                # "r|*" reads the members sequentially, without seeking
+                with tarfile.open(archive, "r|*") as tf:
+                    for info in tf:
+                        if info.isfile() and matches(info.name):
+                            src = tf.extractfile(info)
+                            with open(tmp, "wb") as out:
+                                shutil.copyfileobj(src, out, chunk_size)
+                            break
+                    else:
+                        raise KeyError(f"{member} not found in {archive}")
+            if sha256 is not None:
+                digest = file_sha256(tmp)
+                if digest != sha256.lower():
+                    raise ValueError(f"checksum mismatch for {member}: "
+                                     f"expected {sha256}, got {digest}")
+            os.replace(tmp, dest)
+        finally:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+        return dest
 
     @staticmethod
     def unzip(file_path, dest_dir=None):
@@ -56,6 +204,8 @@ class DownloadUtil:
         >>> DownloadUtil.unzip('zip_file.zip')
         """
 
+        import zipfile, tarfile
+
         if dest_dir is None:
             dest_dir = os.path.dirname(file_path)
 
@@ -72,6 +222,14 @@ class DownloadUtil:
             tar.close()
 
 
+def file_sha256(path: str, chunk_size: int = CHUNK_SIZE) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 class EmbeddingNbrUtil:
     """
         When loading a pretrained embedding matrix, some words may not
@@ -80,34 +238,45 @@ class EmbeddingNbrUtil:
         neighbours. We assume that all words that are not found in the 
         pretrained vectors will be filled with 0. Querying these words will
         return an empty list.
+
+        Besides a torch tensor, `embed` may be a numpy array/memmap or a
+        (quantized) `fastaug.embedding.EmbeddingStore`, in which case
+        searches run on CPU with `fastaug.knn` and the vocabulary of the
+        store is used by default.
     """
     def __init__(
         self,
-        embed: torch.Tensor,
-        word2idx: Union[Callable, Dict],
-        idx2word: Union[Callable, Dict],
+        embed: Union["torch.Tensor", np.ndarray, "EmbeddingStore"],
+        word2idx: Union[Callable, Dict, None] = None,
+        idx2word: Union[Callable, Dict, None] = None,
     ):
         self.embed = embed
+        if word2idx is None:
+            word2idx = embed.word2idx
+        if idx2word is None:
+            idx2word = embed.words
         if isinstance(word2idx, dict):
             self.word2idx = word2idx.__getitem__
         else:
             self.word2idx = word2idx
-        if isinstance(idx2word, dict):
+        if isinstance(idx2word, (dict, list)):
             self.idx2word = idx2word.__getitem__
         else:
             self.idx2word = idx2word
         self._cache = {}
+        self.ann_index = None
 
     def is_pretrained(self, element: Union[int, str]):
         return not all(self.as_vector(element) == 0.0)
 
-    def as_vector(self, element: Union[int, str, torch.Tensor]):
+    def as_vector(self, element: Union[int, str, "torch.Tensor"]):
+        import torch
         if isinstance(element, int):
             idx = element
-            query_vector = self.embed[idx]
+            query_vector = self._row(idx)
         elif isinstance(element, str):
             idx = self.word2idx(element)
-            query_vector = self.embed[idx]
+            query_vector = self._row(idx)
         elif isinstance(element, torch.Tensor):
             query_vector = element
         else:
@@ -116,6 +285,12 @@ class EmbeddingNbrUtil:
                     type(element)))
         return query_vector
 
+    def _row(self, idx: int):
+        import torch
+        if isinstance(self.embed, torch.Tensor):
+            return self.embed[idx]
+        return torch.from_numpy(np.array(self.embed[idx], dtype=np.float32))
+
     def as_index(self, element: Union[int, str]):
         if isinstance(element, int):
             idx = element
@@ -129,34 +304,107 @@ class EmbeddingNbrUtil:
     # search neighbours of all words and save them into a cache,
     # this will speed up the query process.
     # The pre_search is rather fast, feel free to use it.
-    def pre_search(self, measure='euc', topk=None, gpu=True):
-        try:
-            import faiss
-        except Exception as e:
-            print("please install faiss first!")
-            return
-        data = self.embed.cpu().numpy()
-        dim = self.embed.size(1)
-        index = faiss.IndexFlatL2(dim)
+    def pre_search(self,
+                   measure='euc',
+                   topk=None,
+                   gpu=False,
+                   backend='numpy',
+                   block_size=1024,
+                   num_threads=None,
+                   nprobe=None):
+        """
+            backend='numpy' runs the blocked exact search of `fastaug.knn`
+            on CPU threads, backend='faiss' uses faiss (on a GPU if `gpu`),
+            backend='ann' queries the index of `build_ann_index`.
+            All store true euclidean (not squared) or cosine distances.
+        """
+        assert measure in ['euc', 'cos']
+        assert backend in ['numpy', 'faiss', 'ann']
+        if topk is None:
+            raise ValueError("pre_search requires topk")
+        if backend == 'faiss':
+            D, I = self._faiss_search(measure, topk, gpu)
+        elif backend == 'ann':
+            D, I = self._ann(measure).search(self.embed, topk, nprobe)
+        else:
+            from .knn import blocked_topk
+            D, I = blocked_topk(self.embed,
+                                topk,
+                                measure=measure,
+                                block_size=block_size,
+                                num_threads=num_threads)
+        self._cache[f'D-{measure}-{topk}'] = D
+        self._cache[f'I-{measure}-{topk}'] = I
+
+    def build_ann_index(self,
+                        name,
+                        measure='cos',
+                        nlist=None,
+                        nprobe=8,
+                        niter=10,
+                        rebuild=False):
+        """
+            Build an approximate IVF index of the embedding (see
+            `fastaug.ann`) saved to `cache_dir("ann") / name`, or load it
+            if it already exists and not `rebuild`. The index is
+            memory-mapped and used by `find_neighbours_batch(...,
+            approximate=True)` and `pre_search(backend='ann')`.
+        """
+        from .ann import IVFIndex
+        path = cache_dir("ann") / name
+        if rebuild or not (path / "meta.json").exists():
+            IVFIndex.build(self.embed,
+                           measure=measure,
+                           nlist=nlist,
+                           nprobe=nprobe,
+                           niter=niter).save(str(path))
+        self.ann_index = IVFIndex.load(str(path))
+        return self.ann_index
+
+    def _ann(self, measure):
+        if self.ann_index is None:
+            raise ValueError("call build_ann_index first")
+        if self.ann_index.measure != measure:
+            raise ValueError(
+                f"the ANN index was built for '{self.ann_index.measure}'")
+        return self.ann_index
+
+    def _faiss_search(self, measure, topk, gpu):
+        import faiss
+        from .knn import as_numpy, normalize
+        data = as_numpy(self.embed[:])
+        if measure == 'cos':
+            data = normalize(data)
+            index = faiss.IndexFlatIP(data.shape[1])
+        else:
+            index = faiss.IndexFlatL2(data.shape[1])
         index.add(data)
         if gpu:
             res = faiss.StandardGpuResources()  # use a single GPU
             index = faiss.index_cpu_to_gpu(res, 0, index)
         D, I = index.search(data, topk)
-        self._cache[f'D-{measure}-{topk}'] = D
-        self._cache[f'I-{measure}-{topk}'] = I
-
+        if measure == 'cos':
+            D = 1.0 - D
+        else:
+            D = np.sqrt(np.maximum(D, 0.0))
+        return D, I
 
     @lru_cache(maxsize=None)
-    @torch.no_grad()
     def find_neighbours(
             self,
-            element: Union[int, str, torch.Tensor],
+            element: Union[int, str, "torch.Tensor"],
             measure='euc',
             topk=None,
             dist=None,
             return_words=False,  # by default, return (D, I)
             ):
+        import torch
+        with torch.no_grad():
+            return self._find_neighbours(element, measure, topk, dist,
+                                         return_words)
+
+    def _find_neighbours(self, element, measure, topk, dist, return_words):
+        import torch
         # checking args
         assert measure in ['euc', 'cos']
         if dist is not None:
@@ -164,6 +412,10 @@ class EmbeddingNbrUtil:
                 measure == 'cos' and 0 < dist < 1
             ), "threshold for euc distance must be larger than 0, for cos similarity must be between 0 and 1"
 
+        if not isinstance(self.embed, torch.Tensor):
+            return self.find_neighbours_batch([element], measure, topk, dist,
+                                              return_words)[0]
+
         measure_fn = cos_dist if measure == 'cos' else euc_dist
         query_vector = self.as_vector(element)
 
@@ -174,16 +426,12 @@ class EmbeddingNbrUtil:
             else:
                 return None, None
 
-        if f'D-{measure}-{topk}' in self._cache:
+        if f'D-{measure}-{topk}' in self._cache and isinstance(
+                element, (int, str)):
             _idx = self.as_index(element)
             D = self._cache[f'D-{measure}-{topk}'][_idx]
             I = self._cache[f'I-{measure}-{topk}'][_idx]
-            tk_vals = torch.tensor(D, device=self.embed.device)
-            tk_idxs = torch.tensor(I, device=self.embed.device)
-            if return_words:
-                return [self.idx2word(ele) for ele in tk_idxs.tolist()]
-            else:
-                return tk_vals, tk_idxs
+            return self._format_neighbours(D, I, dist, return_words)
 
         if topk is None:
             _topk = self.embed.size(0)
@@ -192,7 +440,80 @@ class EmbeddingNbrUtil:
 
         dists = measure_fn(query_vector, self.embed)
         tk_vals, tk_idxs = torch.topk(dists, _topk, largest=False)
+        return self._format_neighbours(tk_vals, tk_idxs, dist, return_words)
 
+    def find_neighbours_batch(
+            self,
+            elements: List[Union[int, str, "torch.Tensor"]],
+            measure='euc',
+            topk=None,
+            dist=None,
+            return_words=False,
+            block_size=1024,
+            num_threads=None,
+            approximate=False,
+            nprobe=None,
+            ):
+        """
+            The i-th result is `find_neighbours(elements[i], ...)`. Queries
+            not answered by `pre_search` are searched together with the
+            blocked engine of `fastaug.knn`, or with the index of
+            `build_ann_index` if `approximate`.
+        """
+        import torch
+        from .knn import as_numpy, blocked_topk
+        assert measure in ['euc', 'cos']
+        n_words = len(self.embed)
+        cached = f'D-{measure}-{topk}' in self._cache
+        rows = []
+        for element in elements:
+            if isinstance(element, torch.Tensor):
+                rows.append(as_numpy(element))
+            else:
+                rows.append(as_numpy(self.embed[self.as_index(element)]))
+        if not rows:
+            return []
+        queries = np.stack(rows)
+        # Assume that a vector equals to 0 has no neighbours
+        pretrained = np.any(queries != 0.0, axis=1).tolist()
+
+        results = [None] * len(elements)
+        pending = []
+        for i, element in enumerate(elements):
+            if not pretrained[i]:
+                results[i] = [] if return_words else (None, None)
+            elif cached and isinstance(element, (int, str)):
+                _idx = self.as_index(element)
+                results[i] = self._format_neighbours(
+                    self._cache[f'D-{measure}-{topk}'][_idx],
+                    self._cache[f'I-{measure}-{topk}'][_idx], dist,
+                    return_words)
+            else:
+                pending.append(i)
+        if pending and approximate:
+            D, I = self._ann(measure).search(
+                queries[pending], n_words if topk is None else topk, nprobe)
+        elif pending:
+            D, I = blocked_topk(self.embed,
+                                n_words if topk is None else topk,
+                                queries=queries[pending],
+                                measure=measure,
+                                block_size=block_size,
+                                num_threads=num_threads)
+        for row, i in enumerate(pending):
+            results[i] = self._format_neighbours(D[row], I[row], dist,
+                                                 return_words)
+        return results
+
+    def _format_neighbours(self, tk_vals, tk_idxs, dist, return_words):
+        import torch
+        device = getattr(self.embed, 'device', 'cpu')
+        tk_vals = torch.as_tensor(tk_vals, device=device)
+        tk_idxs = torch.as_tensor(tk_idxs, device=device)
+        if (tk_idxs < 0).any():
+            # padding of approximate searches
+            tk_vals = tk_vals[tk_idxs >= 0]
+            tk_idxs = tk_idxs[tk_idxs >= 0]
         if dist is not None:
             mask_idx = tk_vals < dist
             tk_vals = tk_vals[mask_idx]
@@ -213,6 +534,7 @@ def cos_dist(qry, mem):
 
 
 def cos_sim(qry, mem):
+    import torch
     return torch.nn.functional.cosine_similarity(mem,
                                                  qry.expand(
                                                      mem.size(0), mem.size(1)),
@@ -220,4 +542,5 @@ def cos_sim(qry, mem):
 
 
 def euc_dist(qry, mem):
+    import torch
     return torch.sqrt((qry - mem).pow(2).sum(dim=1))
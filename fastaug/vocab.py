@@ -0,0 +1,134 @@
+"""
+    Integer-id token representation.
+
+    Tokens are interned once into a `Vocab`, sentences become int32 id
+    arrays and batches are padded with `PAD`. Word ops implementing
+    `apply_ids` then run as numpy operations on the arrays, and the
+    candidates of substitution ops become CSR tables keyed by id
+    (`CandidateTable`). Strings are only materialized by `Vocab.decode`.
+"""
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import numpy as np
+from .alias import AliasTable
+
+PAD = -1
+
+
+class Vocab:
+    def __init__(self, words: Iterable[str] = ()):
+        self.words: List[str] = []
+        self.word2id: Dict[str, int] = {}
+        for word in words:
+            self.add(word)
+
+    def __len__(self) -> int:
+        return len(self.words)
+
+    def __contains__(self, word: str) -> bool:
+        return word in self.word2id
+
+    def add(self, word: str) -> int:
+        """
+            Return the id of `word`, interning it if needed.
+        """
+        idx = self.word2id.get(word)
+        if idx is None:
+            idx = len(self.words)
+            self.word2id[word] = idx
+            self.words.append(word)
+        return idx
+
+    def encode(self, tokens: List[str]) -> np.ndarray:
+        word2id = self.word2id
+        try:
+            ids = [word2id[token] for token in tokens]
+        except KeyError:
+            ids = [self.add(token) for token in tokens]
+        return np.array(ids, dtype=np.int32)
+
+    def decode(self, ids: np.ndarray) -> List[str]:
+        return list(map(self.words.__getitem__, np.asarray(ids).tolist()))
+
+    def encode_batch(self,
+                     batch: List[List[str]]) -> Tuple[np.ndarray, np.ndarray]:
+        return pad([self.encode(tokens) for tokens in batch])
+
+    def decode_batch(self, ids: np.ndarray,
+                     lengths: np.ndarray) -> List[List[str]]:
+        return [self.decode(row[:n]) for row, n in zip(ids, lengths)]
+
+
+def pad(seqs: List[np.ndarray],
+        width: Optional[int] = None) -> Tuple[np.ndarray, np.ndarray]:
+    """
+        Stack id arrays into a `(len(seqs), width)` matrix padded with
+        `PAD`, return it with the lengths.
+    """
+    lengths = np.array([len(seq) for seq in seqs], dtype=np.int64)
+    if width is None:
+        width = int(lengths.max()) if len(seqs) else 0
+    ids = np.full((len(seqs), width), PAD, dtype=np.int32)
+    for row, seq in zip(ids, seqs):
+        row[:len(seq)] = seq
+    return ids, lengths
+
+
+class CandidateTable:
+    """
+        Candidates of the words of `vocab` in CSR form: the candidates of
+        id `i` are `cand_ids[offsets[i]:offsets[i + 1]]`. Rows are computed
+        with `get_cands(word)` when first needed, see `ensure`; interned
+        candidates only get a row once they appear in a sentence. With
+        `get_alias(word)`, rows also get the alias tables of the weights
+        of their candidates (uniform when it returns None) in `prob` and
+        `alias`, see `fastaug.alias`.
+    """
+    def __init__(self,
+                 vocab: Vocab,
+                 get_cands: Callable[[str], List[str]],
+                 get_alias: Optional[Callable[[str],
+                                              Optional[AliasTable]]] = None):
+        self.vocab = vocab
+        self.get_cands = get_cands
+        self.get_alias = get_alias
+        self.offsets = np.zeros(1, dtype=np.int64)
+        self.counts = np.zeros(0, dtype=np.int64)
+        self.cand_ids = np.zeros(0, dtype=np.int32)
+        self.prob = None
+        self.alias = None
+        if get_alias is not None:
+            self.prob = np.zeros(0, dtype=np.float32)
+            self.alias = np.zeros(0, dtype=np.int32)
+
+    def __len__(self) -> int:
+        return len(self.counts)
+
+    def ensure(self, n: int):
+        """
+            Compute the rows of the ids below `n`.
+        """
+        start = len(self)
+        if n <= start:
+            return
+        vocab = self.vocab
+        words = vocab.words[start:n]
+        rows = [vocab.encode(self.get_cands(word)) for word in words]
+        counts = np.array([len(row) for row in rows], dtype=np.int64)
+        self.counts = np.concatenate([self.counts, counts])
+        self.offsets = np.concatenate(
+            [self.offsets, self.offsets[-1] + np.cumsum(counts)])
+        self.cand_ids = np.concatenate([self.cand_ids] + rows)
+        if self.get_alias is not None:
+            prob = [np.ones(len(row), dtype=np.float32) for row in rows]
+            alias = [np.arange(len(row), dtype=np.int32) for row in rows]
+            for i, word in enumerate(words):
+                table = self.get_alias(word) if len(rows[i]) else None
+                if table is not None:
+                    if len(table[0]) != len(rows[i]):
+                        raise ValueError(
+                            f"{word!r} has {len(rows[i])} candidates but "
+                            f"{len(table[0])} weights")
+                    prob[i] = np.asarray(table[0], dtype=np.float32)
+                    alias[i] = np.asarray(table[1], dtype=np.int32)
+            self.prob = np.concatenate([self.prob] + prob)
+            self.alias = np.concatenate([self.alias] + alias)
@@ -0,0 +1,106 @@
+"""
+    Offline export of WordNet synonyms into a compiled lexicon, so that
+    WordNetSub does plain lookups and never needs nltk at runtime.
+
+        python -m fastaug.wordnet [--vocab VOCAB.txt] [OUT.lex]
+
+    The export is an explicit step: WordNetSub loads the default output
+    (in `cache_dir("lexicons")`) and fails if it is missing. Without a
+    vocabulary file, only the words of the shipped morphs and embedding
+    resources are exported. nltk and its WordNet corpus are only required
+    to run the export.
+"""
+from typing import Iterable, List, Optional
+from functools import lru_cache
+import argparse
+import warnings
+from .lexicon import Lexicon, load_resource_lexicon
+from .util import cache_dir
+
+
+def wordnet_synonyms(word: str, only_unigram: bool = True) -> List[str]:
+    from nltk.corpus import wordnet as wn
+    synonyms = []
+    for syn in wn.synsets(word):
+        for synonym in syn.lemma_names():
+            if "_" in synonym and only_unigram:
+                continue
+            else:
+                synonym = synonym.replace("_", " ")
+            if synonym in synonyms:
+                continue
+            synonyms.append(synonym)
+    return synonyms
+
+
+def default_vocab() -> List[str]:
+    vocab = {}
+    for name in ("morphs.json", "embed_top_16_dist_dot25.json"):
+        for word, cands in load_resource_lexicon(name).items():
+            vocab[word] = None
+            vocab.update(dict.fromkeys(cands))
+    return list(vocab)
+
+
+def build_wordnet_lexicon(out_path: str,
+                          vocab: Optional[Iterable[str]] = None,
+                          only_unigram: bool = True) -> Lexicon:
+    """
+        Export the synonyms of every word of `vocab` into a lexicon.
+        `wn.synsets` is case-insensitive, so words are lowercased.
+    """
+    if vocab is None:
+        vocab = default_vocab()
+        warnings.warn(
+            f"exporting the synonyms of the {len(vocab)} words of the "
+            "shipped resources only, give a vocabulary for more coverage")
+    synonyms = {}
+    for word in vocab:
+        word = word.lower()
+        if word not in synonyms:
+            synonyms[word] = wordnet_synonyms(word, only_unigram)
+    return Lexicon.build(synonyms,
+                         out_path,
+                         meta={
+                             "source": "wordnet",
+                             "only_unigram": only_unigram
+                         })
+
+
+@lru_cache(maxsize=None)
+def load_wordnet_lexicon() -> Lexicon:
+    """
+        Load the synonym table exported into `cache_dir("lexicons")` by
+        `python -m fastaug.wordnet`.
+    """
+    out_path = cache_dir("lexicons") / "wordnet.lex"
+    if not out_path.exists():
+        raise FileNotFoundError(
+            f"no WordNet lexicon at {out_path}, export it first with "
+            "`python -m fastaug.wordnet [--vocab VOCAB.txt]` (requires "
+            "nltk and its WordNet corpus) or give WordNetSub a lexicon")
+    return Lexicon(str(out_path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Export WordNet synonyms into a compiled lexicon.")
+    parser.add_argument("out",
+                        nargs="?",
+                        default=str(cache_dir("lexicons") / "wordnet.lex"))
+    parser.add_argument("--vocab",
+                        default=None,
+                        help="a file with one word per line")
+    parser.add_argument("--all-ngrams",
+                        action="store_true",
+                        help="keep multi-word synonyms")
+    args = parser.parse_args()
+    vocab = None
+    if args.vocab is not None:
+        with open(args.vocab, "r") as f:
+            vocab = [line.strip() for line in f if line.strip()]
+    cache_dir("lexicons").mkdir(parents=True, exist_ok=True)
+    lexicon = build_wordnet_lexicon(args.out,
+                                    vocab,
+                                    only_unigram=not args.all_ngrams)
+    print(f"{len(lexicon)} entries written to {args.out}")
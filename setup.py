@@ -23,5 +23,7 @@ setup(
     zip_safe=False,
 
     scripts=[],
-    entry_points={}
+    entry_points={
+        "console_scripts": ["fastaug=fastaug.cli:main"]
+    }
 )
\ No newline at end of file
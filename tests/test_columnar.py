@@ -0,0 +1,46 @@
+import numpy as np
+import pytest
+from fastaug import WordRandomMask
+from fastaug.augmentor import Augmentor
+
+TEXTS = ["hello big world", None, "the quick brown fox"]
+
+
+def _augmentor():
+    return Augmentor([WordRandomMask(0.5)], seed=0)
+
+
+def _reference(n):
+    results = iter(_augmentor().augment_batch(
+        [t for t in TEXTS if t is not None], n=n, num_workers=0))
+    return [None if t is None else next(results) for t in TEXTS]
+
+
+def test_numpy_rows():
+    src, texts = _augmentor().augment_array(np.array(TEXTS, dtype=object),
+                                            n=2,
+                                            layout="rows",
+                                            num_workers=0)
+    ref = _reference(2)
+    assert src.tolist() == [0, 0, 2, 2]
+    assert texts.tolist() == ref[0] + ref[2]
+
+
+def test_pandas_string_dtype_with_missing_value():
+    pd = pytest.importorskip("pandas")
+    values = pd.Series(TEXTS, index=list("abc"), dtype="string")
+    out = _augmentor().augment_array(values, num_workers=0)
+    ref = _reference(1)
+    assert list(out.index) == list("abc")
+    assert pd.isna(out["b"])
+    assert [out["a"], out["c"]] == [ref[0], ref[2]]
+
+
+def test_arrow_unique_list_sizes():
+    pa = pytest.importorskip("pyarrow")
+    out = _augmentor().augment_array(pa.array(TEXTS),
+                                     n=3,
+                                     unique=True,
+                                     num_workers=0)
+    assert out.type == pa.list_(pa.string())
+    assert out.to_pylist()[1] is None
@@ -0,0 +1,29 @@
+import pytest
+
+torch = pytest.importorskip("torch")
+
+from torch.utils.data import DataLoader
+from fastaug import WordRandomMask
+from fastaug.augmentor import Augmentor
+from fastaug.dataset import AugmentedDataset
+
+SENTS = ["the quick brown fox jumps over the lazy dog"] * 16
+
+
+def _epoch(augmentor):
+    torch.manual_seed(0)
+    loader = DataLoader(AugmentedDataset(SENTS, augmentor),
+                        batch_size=4,
+                        num_workers=2,
+                        collate_fn=list)
+    return [text for batch in loader for text in batch]
+
+
+def test_spawned_augmentors_differ_in_workers():
+    a, b = Augmentor([WordRandomMask(0.3)], seed=0).spawn(2)
+    assert _epoch(a) != _epoch(b)
+
+
+def test_seeded_epochs_are_reproducible():
+    make = lambda: Augmentor([WordRandomMask(0.3)], seed=0)
+    assert _epoch(make()) == _epoch(make())
@@ -0,0 +1,45 @@
+from fastaug.tokenizer import (better_tokenize, detokenize, tokenize,
+                               tokenize_with_offsets, tokenize_with_spacing)
+
+
+def test_better_tokenize_splits_on_whitespace_and_punctuation():
+    assert better_tokenize("Hello  world, it's me!") == [
+        "Hello", "world", ",", "it", "'", "s", "me", "!"
+    ]
+
+
+def test_better_tokenize_keeps_cjk_characters_as_tokens():
+    assert better_tokenize("我们today去") == ["我", "们", "today", "去"]
+
+
+def test_better_tokenize_splits_astral_characters():
+    assert better_tokenize("ok\U0001F600x \U00020000y") == [
+        "ok", "\U0001F600", "x", "\U00020000", "y"
+    ]
+
+
+def test_better_tokenize_lower():
+    assert better_tokenize("ABC def", lower=True) == ["abc", "def"]
+
+
+def test_tokenize_normalizes_spaces():
+    assert tokenize("  a \t b\n") == ["a", "b"]
+
+
+def test_spacing_round_trip():
+    text = "  Hello,\tworld!  我们 "
+    for mode in ("space", "better"):
+        tokens, gaps = tokenize_with_spacing(text, mode)
+        assert detokenize(tokens, tokens, gaps) == text
+
+
+def test_offsets():
+    text = "a, bc"
+    tokens, offsets = tokenize_with_offsets(text, "better")
+    assert [text[s:e] for s, e in offsets] == tokens == ["a", ",", "bc"]
+
+
+def test_detokenize_after_deleting_leading_tokens():
+    tokens, gaps = tokenize_with_spacing("hello world, foo bar.", "better")
+    assert detokenize(tokens[1:], tokens, gaps) == "world, foo bar."
+    assert detokenize(tokens[2:], tokens, gaps) == ", foo bar."